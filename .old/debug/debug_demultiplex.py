@@ -1,9 +1,9 @@
 #!/usr/bin/env python3
 """
-Purpose: Helper script to demultiplex phased primers using a subprocess wrapper.
+Purpose: Compare the output of the custom phased-primer demultiplexer with CLC-demultiplexed .fastq files.
 """
 __author__ = "Erick Samera"
-__version__ = "1.2.0"
+__version__ = "1.7.0"
 __comment__ = 'stable'
 
 # --------------------------------------------------
@@ -12,17 +12,19 @@ from argparse import (
     ArgumentParser,
     ArgumentDefaultsHelpFormatter)
 from pathlib import Path
+# --------------------------------------------------
+from concurrent.futures import ProcessPoolExecutor
 import time
 # --------------------------------------------------
 import pandas as pd
-from Bio import SeqIO
+from read_set_compare import compare_read_sets
 # --------------------------------------------------
 def get_args() -> Namespace:
     """ Get command-line arguments """
 
     parser = ArgumentParser(
         #usage='%(prog)s',
-        description="Helper script to demultiplex phased primers using a subprocess wrapper.",
+        description="Compare the output of the custom phased-primer demultiplexer with CLC-demultiplexed .fastq files.",
         epilog=f"v{__version__} : {__author__} | {__comment__}",
         formatter_class=ArgumentDefaultsHelpFormatter)
     parser.add_argument(
@@ -37,66 +39,123 @@ def get_args() -> Namespace:
         type=Path,
         required=True,
         help="REQUIRED: path of directory containing CLC-demultiplexed .fastq")
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        dest='jobs',
+        metavar='INT',
+        type=int,
+        default=4,
+        help="number of files compared in parallel")
+    parser.add_argument(
+        '--sequences',
+        dest='compare_sequences',
+        action='store_true',
+        help="also compare the sequences of reads found in both files")
+    parser.add_argument(
+        '--memory-limit',
+        dest='memory_limit',
+        metavar='MB',
+        type=int,
+        default=None,
+        help="compare on disk, using about this much memory (default: compare in memory)")
     # --------------------------------------------------
 
     args = parser.parse_args()
 
     # parser errors and processing
     # --------------------------------------------------
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1.")
+    if args.memory_limit is not None and args.memory_limit < 1:
+        parser.error("--memory-limit must be at least 1 MB.")
 
     return args
 # --------------------------------------------------
-def compare_fastq(orig_fastq_arg: Path, clc_fastq_arg: Path) -> list:
-    """
+def _index_files(input_path_arg: Path, clc_input_path_arg: Path) -> tuple:
     """
-    orig_fastq_list: list = [seq.id for seq in SeqIO.parse(orig_fastq_arg, 'fastq')]
-    clc_fastq_list: list = [seq.id for seq in SeqIO.parse(clc_fastq_arg, 'fastq')]
-
-    not_in_orig = [fastq for fastq in clc_fastq_list if not fastq in orig_fastq_list]
-    not_in_clc = [fastq for fastq in orig_fastq_list if not fastq in clc_fastq_list]
+    Function scans both directories once and pairs every custom-demultiplexed file with its CLC file (both
+    named SAMPLE_S#_L###_REGION_R#_001.fastq.gz).
 
+    Parameters:
+        input_path_arg (Path): directory of .fastq files from the custom demultiplexer
+        clc_input_path_arg (Path): directory of CLC-demultiplexed .fastq files
 
-    # print(f'There were {len(orig_fastq_list)} entries in the original fastq list.')
-    # print(f'There were {len(clc_fastq_list)} entries in the CLC genomics fastq list.')
-
-    # print(f'There are {len(not_in_orig) + len(not_in_clc)} different reads between them.')
-    # print(f'There are {len(not_in_orig)} reads not found in the original fastq list. ({100 - (len(not_in_orig)/len(orig_fastq_list)*100)} % were present)')
-    # print(f'There are {len(not_in_clc)} reads not found in the CLC fastq list. ({100 - (len(not_in_clc)/len(clc_fastq_list)*100)} % were present)')
-
-    # print(f'They are {100 - ((len(not_in_orig) + len(not_in_clc)) / (len(orig_fastq_list)+len(clc_fastq_list))*100)} % the same.')
-
-    return 1 - ((len(not_in_orig) + len(not_in_clc)) / (len(orig_fastq_list)+len(clc_fastq_list)))
+    Returns:
+        (tuple): {(sample, region, read): (custom file, CLC file)}, list of (sample, region, read, file, error) for unpaired files
+    """
+    clc_files: dict = {}
+    for clc_file in sorted(file for file in clc_input_path_arg.iterdir() if file.is_file()):
+        name_parts = clc_file.name.split('_')
+        if len(name_parts) >= 5:
+            clc_files.setdefault((name_parts[0], name_parts[3], name_parts[4][:2]), []).append(clc_file)
+    file_index: dict = {}
+    errors: list = []
+    for read_num in ('R1', 'R2'):
+        for file in sorted(input_path_arg.glob(f'*{read_num}*.fastq*')):
+            name_parts = file.name.split('_')
+            if len(name_parts) < 5:
+                errors.append(('', '', read_num, file.name, 'file name does not look like SAMPLE_S#_L###_REGION_R#_001.fastq.gz'))
+                continue
+            sample_name, region = name_parts[0], name_parts[3]
+            clc_matches: list = clc_files.get((sample_name, region, read_num), [])
+            if not clc_matches:
+                errors.append((sample_name, region, read_num, file.name, 'no matching CLC file'))
+                continue
+            if len(clc_matches) > 1:
+                errors.append((sample_name, region, read_num, file.name, f'{len(clc_matches)} matching CLC files, compared with {clc_matches[0].name}'))
+            file_index[(sample_name, region, read_num)] = (file, clc_matches[0])
+    return file_index, errors
 # --------------------------------------------------
 def main() -> None:
-    """ Insert docstring here """
+    """ Compare every custom-demultiplexed file with its CLC-demultiplexed counterpart """
 
     args = get_args()
-    reads = ['R1', 'R2']
 
     r1_r2: dict = {}
     read_similar_dict: dict = {}
-
-    for read_num in reads:
-        for file in args.input_path.glob(f'*{read_num}*'):
+    different_region_dict: dict = {}
+
+    file_index, errors = _index_files(args.input_path, args.clc_input_path)
+    # every sample and read direction is compared as a whole, region by region
+    sample_files: dict = {}
+    for (sample_name, region, read_num), (fastq_orig, fastq_clc) in file_index.items():
+        orig_files, clc_files = sample_files.setdefault((sample_name, read_num), ({}, {}))
+        orig_files[region] = [fastq_orig]
+        clc_files[region] = [fastq_clc]
+    memory_limit: int = args.memory_limit * 2**20 if args.memory_limit else None
+    print_runtime(f'Comparing {len(file_index)} files of {len(sample_files)} samples/reads using {args.jobs} workers ...')
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures: dict = {
+            key: executor.submit(compare_read_sets, orig_files, clc_files, args.compare_sequences, memory_limit)
+            # R1 files first, so the tables keep their R1-then-R2 column order
+            for key, (orig_files, clc_files) in sorted(sample_files.items(), key=lambda item: (item[0][1], item[0][0]))}
+        for (sample_name, read_num), future in futures.items():
             try:
-                sample_name = file.name.split('_')[0]
-                region = file.name.split('_')[3]
-                fastq_orig = file
-                fastq_clc = ([file for file in args.clc_input_path.glob(f'{sample_name}*{region}*{read_num}*')][0])
-                print(f'{sample_name}_{region}_{read_num}')
-                r1_r2_sample_name = f'{sample_name}_{region}'
-
-                if not sample_name in read_similar_dict:
-                    read_similar_dict[sample_name] = {}
-                if not r1_r2_sample_name in r1_r2:
-                    r1_r2[r1_r2_sample_name] = {}
-                comparison_result = compare_fastq(fastq_orig, fastq_clc)
-                r1_r2[r1_r2_sample_name][read_num] = comparison_result
-                read_similar_dict[sample_name][f'{read_num}_{region}'] = comparison_result
-            except: pass
+                comparison: dict = future.result()
+            except Exception as error:
+                for region, orig_fastqs in sorted(sample_files[(sample_name, read_num)][0].items()):
+                    errors.append((sample_name, region, read_num, orig_fastqs[0].name, f'{type(error).__name__}: {error}'))
+                print_runtime(f'ERROR: {sample_name}_{read_num} failed ({type(error).__name__}: {error})')
+                continue
+            for region, region_stats in comparison['regions'].items():
+                message = f"{sample_name}_{region}_{read_num}: {round(100 * region_stats['concordance'], 3)} % concordant, {region_stats['different_region']} reads in a different region"
+                print_runtime(message)
+                read_similar_dict.setdefault(sample_name, {})[f'{read_num}_{region}'] = region_stats['concordance']
+                different_region_dict.setdefault(sample_name, {})[f'{read_num}_{region}'] = region_stats['different_region']
+                r1_r2.setdefault(f'{sample_name}_{region}', {})[read_num] = region_stats['concordance']
+            for (orig_region, clc_region), reads in sorted(comparison['region_pairs'].items()):
+                print_runtime(f'{sample_name}_{read_num}: {reads} reads in {orig_region} were in {clc_region} for CLC')
+            if args.compare_sequences:
+                print_runtime(f"{sample_name}_{read_num}: {comparison['different_sequence']}/{comparison['shared']} shared reads with different sequences")
 
     pd.DataFrame.from_dict(read_similar_dict, orient='index').to_csv('results_by-region.csv')
     pd.DataFrame.from_dict(r1_r2, orient='index').to_csv('results_r1-r2.csv')
+    # reads of a region that are in another region on the other side, same layout as results_by-region.csv
+    pd.DataFrame.from_dict(different_region_dict, orient='index').to_csv('results_different-region.csv')
+    pd.DataFrame(errors, columns=['sample', 'region', 'read', 'file', 'error']).to_csv('results_errors.csv', index=False)
+    if errors:
+        print_runtime(f'{len(errors)} files could not be compared cleanly, see results_errors.csv .')
     return None
 def print_runtime(action) -> None:
     """ Return the time and some defined action. """
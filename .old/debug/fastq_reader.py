@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+Purpose: Batched .fastq(.gz) reader that finds records with NumPy instead of building an object per read.
+
+Files are decompressed in large chunks and record boundaries are found from the newline positions of each
+chunk. Every batch keeps a (zero-copy) view of the chunk and the offsets of its records, so ids, sequences
+and qualities are pulled out as padded NumPy arrays (same layout as iupac_matcher.encode_reads()) or
+written back out, trimmed and/or filtered, in one vectorized step:
+
+    for r1_batch, r2_batch in read_paired_fastq_batches(r1_path, r2_path):
+        reads, lengths = r1_batch.sequences()
+        output_file.write(r1_batch.to_fastq(selected_reads, trim_lengths))
+
+Copy of helper-scripts/fastq_reader.py, so the debug tools run on their own. Change both copies together.
+"""
+__author__ = "Erick Samera"
+__version__ = "1.0.0"
+__comment__ = 'stable'
+
+# --------------------------------------------------
+from pathlib import Path
+# --------------------------------------------------
+import gzip
+# --------------------------------------------------
+import numpy as np
+# --------------------------------------------------
+# number of records per batch
+BATCH_SIZE: int = 10000
+# bytes decompressed per read() call
+CHUNK_SIZE: int = 1 << 22
+# --------------------------------------------------
+class FastqBatch:
+    """
+    Batch of .fastq records, held as one buffer and the offsets of every line.
+
+    Parameters:
+        data_arg (np.ndarray): uint8 view of the buffer holding the records
+        line_starts_arg (np.ndarray): (n_records x 4) offset of the header, sequence, separator and quality lines
+        line_ends_arg (np.ndarray): (n_records x 4) offset just past the same lines (without newlines)
+        record_ends_arg (np.ndarray): offset just past the last newline of every record
+    """
+    def __init__(self, data_arg: np.ndarray, line_starts_arg: np.ndarray, line_ends_arg: np.ndarray, record_ends_arg: np.ndarray) -> None:
+        self.data = data_arg
+        self.line_starts = line_starts_arg
+        self.line_ends = line_ends_arg
+        self.record_ends = record_ends_arg
+    def __len__(self) -> int:
+        return len(self.line_starts)
+    def ids(self, width_arg: int = None) -> tuple:
+        """
+        Read ids (header up to the first whitespace, without "@" and any /1 or /2 mate suffix).
+
+        Returns:
+            (tuple): (n_records x width) zero-padded uint8 array of ids, int32 array of id lengths
+        """
+        headers, header_lengths = _gather(self.data, self.line_starts[:, 0] + 1, self.line_ends[:, 0] - self.line_starts[:, 0] - 1)
+        whitespace = (headers == ord(' ')) | (headers == ord('\t'))
+        id_lengths = np.where(whitespace.any(axis=1), whitespace.argmax(axis=1), header_lengths).astype(np.int32)
+        rows = np.arange(len(headers))
+        if headers.shape[1] >= 2:
+            mate_suffix = (id_lengths >= 2) \
+                & (headers[rows, np.maximum(id_lengths - 2, 0)] == ord('/')) \
+                & np.isin(headers[rows, np.maximum(id_lengths - 1, 0)], (ord('1'), ord('2')))
+            id_lengths[mate_suffix] -= 2
+        width = int(id_lengths.max(initial=0)) if width_arg is None else width_arg
+        ids = headers[:, :width] if headers.shape[1] >= width else np.pad(headers, ((0, 0), (0, width - headers.shape[1])))
+        ids = np.where(np.arange(width) < id_lengths[:, None], ids, 0).astype(np.uint8)
+        return ids, np.minimum(id_lengths, width)
+    def sequences(self, width_arg: int = None) -> tuple:
+        """
+        Read sequences, same as iupac_matcher.encode_reads().
+
+        Returns:
+            (tuple): (n_records x width) zero-padded uint8 array of sequences, int32 array of sequence lengths
+        """
+        return _gather(self.data, self.line_starts[:, 1], self.line_ends[:, 1] - self.line_starts[:, 1], width_arg)
+    def qualities(self, width_arg: int = None) -> tuple:
+        """
+        Read quality strings.
+
+        Returns:
+            (tuple): (n_records x width) zero-padded uint8 array of qualities, int32 array of quality lengths
+        """
+        return _gather(self.data, self.line_starts[:, 3], self.line_ends[:, 3] - self.line_starts[:, 3], width_arg)
+    def to_fastq(self, records_arg: np.ndarray = None, trim_arg: np.ndarray = None) -> bytes:
+        """
+        Some records as .fastq text, optionally with the first bases (and qualities) trimmed off.
+
+        Parameters:
+            records_arg (np.ndarray): indexes of the records to keep, in output order (default: all)
+            trim_arg (np.ndarray): number of bases to trim from the start of every kept record (default: none)
+
+        Returns:
+            (bytes): .fastq text of the records
+        """
+        records = np.arange(len(self)) if records_arg is None else np.asarray(records_arg, dtype=np.int64)
+        if not len(records):
+            return b''
+        record_starts = self.line_starts[records, 0]
+        seq_starts = self.line_starts[records, 1]
+        qual_starts = self.line_starts[records, 3]
+        record_ends = self.record_ends[records]
+        if trim_arg is not None:
+            trim = np.asarray(trim_arg, dtype=np.int64)
+            seq_starts, qual_starts = seq_starts + trim, qual_starts + trim
+        # every record is kept as three pieces: header, sequence through separator, quality
+        piece_starts = np.stack((record_starts, seq_starts, qual_starts), axis=1).ravel()
+        piece_lengths = np.stack((
+            self.line_starts[records, 1] - record_starts,
+            self.line_starts[records, 3] - seq_starts,
+            record_ends - qual_starts), axis=1).ravel()
+        output_offsets = np.cumsum(piece_lengths) - piece_lengths
+        byte_indexes = np.arange(int(piece_lengths.sum()), dtype=np.int64) + np.repeat(piece_starts - output_offsets, piece_lengths)
+        return self.data[byte_indexes].tobytes()
+# --------------------------------------------------
+def read_fastq_batches(fastq_path_arg: Path, batch_size_arg: int = BATCH_SIZE, chunk_size_arg: int = CHUNK_SIZE) -> FastqBatch:
+    """
+    Function yields the records of a .fastq(.gz) file in batches.
+
+    Parameters:
+        fastq_path_arg (Path): path of the .fastq or .fastq.gz file
+        batch_size_arg (int): number of records per batch (the last batch may be smaller)
+        chunk_size_arg (int): number of (decompressed) bytes read at a time
+
+    Returns:
+        (FastqBatch): batches of records, in file order
+    """
+    opener = gzip.open if Path(fastq_path_arg).suffix == '.gz' else open
+    with opener(fastq_path_arg, 'rb') as fastq_file:
+        leftover = b''
+        while True:
+            chunk = fastq_file.read(chunk_size_arg)
+            at_end = not chunk
+            buffer = leftover + chunk if leftover else chunk
+            if at_end and buffer and not buffer.endswith(b'\n'):
+                buffer += b'\n'
+            data = np.frombuffer(buffer, dtype=np.uint8)
+            newlines = np.flatnonzero(data == ord('\n'))
+            n_records = len(newlines) // 4
+            if at_end and len(newlines) % 4:
+                raise ValueError(f'{Path(fastq_path_arg).name} is not a complete .fastq file (truncated last record)')
+
+            # only full batches are yielded, the rest waits for the next chunk (or the end of the file)
+            n_batched = n_records if at_end else n_records - n_records % batch_size_arg
+            for first_record in range(0, n_batched, batch_size_arg):
+                last_record = min(first_record + batch_size_arg, n_batched)
+                first_byte = int(newlines[4 * first_record - 1]) + 1 if first_record else 0
+                yield _make_batch(fastq_path_arg, data, first_byte, newlines[4 * first_record:4 * last_record])
+            if at_end:
+                return
+            leftover = buffer[newlines[4 * n_batched - 1] + 1:] if n_batched else buffer
+def read_paired_fastq_batches(r1_path_arg: Path, r2_path_arg: Path, batch_size_arg: int = BATCH_SIZE, chunk_size_arg: int = CHUNK_SIZE) -> tuple:
+    """
+    Function yields the records of paired R1 and R2 .fastq(.gz) files in matching batches.
+
+    Parameters:
+        r1_path_arg (Path): path of the R1 file
+        r2_path_arg (Path): path of the R2 file
+        batch_size_arg (int): number of read pairs per batch
+        chunk_size_arg (int): number of (decompressed) bytes read at a time
+
+    Returns:
+        (tuple): R1 batch, R2 batch with the mates of the same reads (ValueError if the files are out of sync)
+    """
+    r1_batches = read_fastq_batches(r1_path_arg, batch_size_arg, chunk_size_arg)
+    r2_batches = read_fastq_batches(r2_path_arg, batch_size_arg, chunk_size_arg)
+    n_pairs: int = 0
+    for r1_batch in r1_batches:
+        r2_batch = next(r2_batches, None)
+        if r2_batch is None or len(r1_batch) != len(r2_batch):
+            raise ValueError(f'{Path(r1_path_arg).name} has more reads than {Path(r2_path_arg).name}')
+        r1_ids, r1_id_lengths = r1_batch.ids()
+        r2_ids, r2_id_lengths = r2_batch.ids(r1_ids.shape[1])
+        mismatched = np.flatnonzero((r1_id_lengths != r2_id_lengths) | (r1_ids != r2_ids).any(axis=1))
+        if len(mismatched):
+            raise ValueError(
+                f'{Path(r1_path_arg).name} and {Path(r2_path_arg).name} are out of sync at read pair {n_pairs + mismatched[0] + 1} '
+                f'({r1_ids[mismatched[0], :r1_id_lengths[mismatched[0]]].tobytes().decode(errors="replace")} != '
+                f'{r2_ids[mismatched[0], :r2_id_lengths[mismatched[0]]].tobytes().decode(errors="replace")})')
+        n_pairs += len(r1_batch)
+        yield r1_batch, r2_batch
+    if next(r2_batches, None) is not None:
+        raise ValueError(f'{Path(r2_path_arg).name} has more reads than {Path(r1_path_arg).name}')
+def _make_batch(fastq_path_arg: Path, data_arg: np.ndarray, first_byte_arg: int, newlines_arg: np.ndarray) -> FastqBatch:
+    """
+    Function builds a batch from the newline positions of its records.
+
+    Parameters:
+        fastq_path_arg (Path): path of the file, for error messages
+        data_arg (np.ndarray): uint8 view of the buffer
+        first_byte_arg (int): offset of the first record in the buffer
+        newlines_arg (np.ndarray): positions of the 4 newlines of every record in the batch
+
+    Returns:
+        (FastqBatch): batch of records (ValueError if a record is malformed)
+    """
+    # the batch only keeps (a view of) the part of the buffer it covers
+    line_ends = newlines_arg.reshape(-1, 4).astype(np.int64)
+    line_starts = np.empty_like(line_ends)
+    line_starts.ravel()[1:] = line_ends.ravel()[:-1] + 1
+    line_starts.ravel()[:1] = first_byte_arg
+    record_ends = line_ends[:, 3] + 1
+    data = data_arg[first_byte_arg:record_ends[-1]] if len(line_ends) else data_arg[:0]
+    line_starts -= first_byte_arg
+    line_ends -= first_byte_arg
+    record_ends -= first_byte_arg
+    # drop the \r of \r\n line endings from the line lengths
+    if len(line_ends):
+        line_ends -= (data[np.maximum(line_ends - 1, 0)] == ord('\r')) & (line_ends > line_starts)
+
+    malformed = np.flatnonzero((data[line_starts[:, 0]] != ord('@')) | (data[line_starts[:, 2]] != ord('+'))
+        | (line_ends[:, 1] - line_starts[:, 1] != line_ends[:, 3] - line_starts[:, 3]))
+    if len(malformed):
+        bad_header = data[line_starts[malformed[0], 0]:line_ends[malformed[0], 0]].tobytes().decode(errors='replace')
+        raise ValueError(f'{Path(fastq_path_arg).name} is not a valid .fastq file (malformed record "{bad_header[:80]}")')
+    return FastqBatch(data, line_starts, line_ends, record_ends)
+def _gather(data_arg: np.ndarray, starts_arg: np.ndarray, lengths_arg: np.ndarray, width_arg: int = None) -> tuple:
+    """
+    Function copies one slice per record out of a buffer into a zero-padded 2-D array.
+
+    Parameters:
+        data_arg (np.ndarray): uint8 buffer
+        starts_arg (np.ndarray): offset of every slice
+        lengths_arg (np.ndarray): length of every slice
+        width_arg (int): number of columns to keep, longer slices are truncated (default: longest slice)
+
+    Returns:
+        (tuple): (n x width) uint8 array, int32 array of (truncated) lengths
+    """
+    lengths = np.asarray(lengths_arg, dtype=np.int32)
+    width = int(lengths.max(initial=0)) if width_arg is None else width_arg
+    lengths = np.minimum(lengths, width)
+    columns = np.arange(width)
+    in_slice = columns < lengths[:, None]
+    byte_indexes = np.where(in_slice, starts_arg[:, None] + columns, 0)
+    return np.where(in_slice, data_arg[byte_indexes], 0).astype(np.uint8), lengths
@@ -3,7 +3,7 @@
 Purpose: Helper script to create consistent OTU tables and taxonomy to the species level.
 """
 __author__ = "Erick Samera"
-__version__ = "2.0.0"
+__version__ = "2.8.1"
 __comments__ = "very stable"
 
 # --------------------------------------------------
@@ -15,8 +15,49 @@ from pathlib import Path
 # --------------------------------------------------
 import time
 import csv
-import pandas as pd
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import numpy as np
 from rapidfuzz import process, fuzz
+# BIOM output is optional
+try:
+    from biom import Table
+    from biom.util import biom_open
+    from scipy import sparse
+except ImportError:
+    Table = None
+from ncbi_taxonomy import (
+    DEFAULT_CACHE_DIR,
+    NcbiTaxonomy,
+    load_taxonomy)
+from taxon_match_cache import (
+    DEFAULT_MATCH_CACHE_PATH,
+    DEFAULT_MAX_ENTRIES,
+    TaxonMatchCache)
+TAXONOMY_LEVELS: dict = {
+    6: ['species', 'strain'],
+    5: ['genus'],
+    4: ['family'],
+    3: ['order'],
+    2: ['class'],
+    1: ['phylum'],
+    0: ['kingdom', 'superkingdom']
+}
+SCORERS: dict = {
+    'ratio': fuzz.ratio,
+    'QRatio': fuzz.QRatio,
+    'partial_ratio': fuzz.partial_ratio
+}
+# taxonomy column of unmatched OTUs (the characters of 'N/A' joined like a lineage)
+UNMATCHED_TAXONOMY: str = '; '.join('N/A')
+# OTUs read, matched and written at a time
+CHUNK_SIZE: int = 10000
+# state of worker processes (see _init_worker())
+_WORKER_STATE: dict = {}
+# queries are scored against a rank in chunks of about this many scores (8 bytes each)
+CDIST_CELLS: int = 1 << 24
 # --------------------------------------------------
 def get_args() -> Namespace:
     """ Get command-line arguments """
@@ -37,6 +78,18 @@ def get_args() -> Namespace:
         metavar='FILEPATH',
         type=Path,
         help="path of output OTU file (.csv)")
+    parser.add_argument(
+        '--biom',
+        dest='biom_path',
+        metavar='FILEPATH',
+        type=Path,
+        help="also write the OTU table as a sparse BIOM (HDF5) table, with the taxonomy as observation metadata")
+    parser.add_argument(
+        '--biom-collapsed',
+        dest='biom_collapsed_path',
+        metavar='FILEPATH',
+        type=Path,
+        help="also write a sparse BIOM (HDF5) table of the abundances summed by taxonomy")
     # --------------------------------------------------
     group_custom_regions = parser.add_argument_group(
         title='NCBI taxonomy database information (required)')
@@ -54,6 +107,39 @@ def get_args() -> Namespace:
         type=Path,
         required=True,
         help='path of NCBI names.dmp file')
+    group_custom_regions.add_argument(
+        '--taxonomy-cache',
+        dest='taxonomy_cache_path',
+        metavar='PATH',
+        type=Path,
+        default=DEFAULT_CACHE_DIR,
+        help='directory of the parsed NCBI taxonomy cache')
+    group_custom_regions.add_argument(
+        '--no-taxonomy-cache',
+        dest='taxonomy_cache_path',
+        action='store_const',
+        const=None,
+        help='parse the .dmp files without reading or writing the cache')
+    group_custom_regions.add_argument(
+        '--match-cache',
+        dest='match_cache_path',
+        metavar='FILEPATH',
+        type=Path,
+        default=DEFAULT_MATCH_CACHE_PATH,
+        help='path of the cache of taxon string matches, shared between runs')
+    group_custom_regions.add_argument(
+        '--no-match-cache',
+        dest='match_cache_path',
+        action='store_const',
+        const=None,
+        help='match every taxon string without reading or writing the match cache')
+    group_custom_regions.add_argument(
+        '--match-cache-size',
+        dest='match_cache_size',
+        metavar='INT',
+        type=int,
+        default=DEFAULT_MAX_ENTRIES,
+        help='number of matches kept in the match cache, least recently used ones are evicted first')
     group_debug = parser.add_argument_group(
         title='debugging arguments')
     group_debug.add_argument(
@@ -61,7 +147,7 @@ def get_args() -> Namespace:
         dest='output_mismatches_path',
         metavar='FILEPATH',
         type=Path,
-        help='path to output taxonomic values that did not pass threshold')
+        help='path to output taxonomic values that did not pass threshold, with their closest name')
     group_debug.add_argument(
         '--scorer',
         dest='scorer',
@@ -78,6 +164,38 @@ def get_args() -> Namespace:
         type=str,
         default='taxonomy',
         help='taxonomy: match species against species db, etc.; all: search everything (use ratio scorer, very computationally intensive)')
+    group_debug.add_argument(
+        '--chunk-size',
+        dest='chunk_size',
+        metavar='INT',
+        type=int,
+        default=CHUNK_SIZE,
+        help='number of OTUs read, matched and written at a time')
+    group_debug.add_argument(
+        '-p',
+        '--processes',
+        dest='processes',
+        metavar='INT',
+        type=int,
+        default=1,
+        help='number of processes matching chunks of OTUs (consider lowering --workers)')
+    group_debug.add_argument(
+        '--workers',
+        dest='workers',
+        metavar='INT',
+        type=int,
+        default=-1,
+        help='number of threads for fuzzy matching (-1: all cores)')
+    group_debug.add_argument(
+        '--no-candidate-index',
+        dest='candidate_index',
+        action='store_false',
+        help='score taxon strings against every name instead of the trigram index candidates')
+    group_debug.add_argument(
+        '--check-recall',
+        dest='check_recall',
+        action='store_true',
+        help='also match every taxon string by brute force and report where the trigram index differs (disables the match cache)')
     group_debug.add_argument(
         '--match-threshold',
         dest='match_threshold',
@@ -92,79 +210,387 @@ def get_args() -> Namespace:
     # --------------------------------------------------
     if not args.input_path.resolve().exists():
         parser.error("Input doesn't exist.")
+    if (args.biom_path or args.biom_collapsed_path) and Table is None:
+        parser.error("BIOM output needs the biom-format and scipy packages.")
+    if args.chunk_size < 1:
+        parser.error("--chunk-size must be at least 1.")
+    if args.processes < 1:
+        parser.error("--processes must be at least 1.")
+    if args.check_recall:
+        args.match_cache_path = None
 
     return args
 # --------------------------------------------------
-def _process_csv(args, path_arg: Path, txid_dict_arg: dict) -> dict:
+def _taxon_queries(taxonomy_str_arg: str) -> list:
     """
-    Function processes a (.csv) file and returns dictionary of processed data.
+    Function lists the taxon strings of a CLC taxonomy worth matching, from the most specific one.
 
     Parameters:
-        path_arg (Path): path of the OTU .csv file
-        txid_dict_arg: NCBI txid dict
+        taxonomy_str_arg (str): CLC taxonomy ("kingdom; phylum; ...; species")
 
     Returns:
-        (dict): processed dictionary to be output as DataFrame
+        (list): (cleaned taxon string, taxon level) queries, in the order they are tried
+    """
+    taxonomy = [taxon.strip() for taxon in taxonomy_str_arg.split(';')]
+    taxon_queries: list = []
+
+    # starting from the most narrowed taxonomy, try to find a match
+    for taxonomy_i, taxonomy_level_str in enumerate(taxonomy[::-1]):
+        # counting backwards from the list, also make the numbers count down
+        actual_taxonomy_level = len(taxonomy) - taxonomy_i - 1
+
+        # don't match taxonomy if it doesn't even pass the string filtering
+        filtered_strings = any((
+            ('uncultured' in taxonomy_level_str.lower()),
+            ('metagenome' in taxonomy_level_str.lower()),
+            ('unknown' in taxonomy_level_str.lower()),
+            ('unclassified' in taxonomy_level_str.lower()),
+            ('unidentified' in taxonomy_level_str.lower()),
+            (not taxonomy_level_str)
+            ))
+        if not filtered_strings:
+            taxonomy_level_str = taxonomy_level_str.split('(')[0].strip()
+            taxonomy_level_str = taxonomy_level_str.replace('[', '').replace(']', '')
+            taxon_queries.append((taxonomy_level_str, actual_taxonomy_level))
+    return taxon_queries
+def _match_ranks(args, taxon_level_arg: int) -> list:
     """
+    Function lists the ranks a taxon string is matched against.
 
-    start_time = time.time()
-    _processed_otus: list = []
-
-    taxonomy_levels: dict = {
-        6: ['species', 'strain'],
-        5: ['genus'],
-        4: ['family'],
-        3: ['order'],
-        2: ['class'],
-        1: ['phylum'],
-        0: ['kingdom', 'superkingdom']
-    }
-    scorer: dict = {
-        'ratio': fuzz.ratio,
-        'QRatio': fuzz.QRatio,
-        'partial_ratio': fuzz.partial_ratio
-    }
-
-    def _compare_with_dict(taxon_str_arg: str, taxon_level_arg: int) -> dict:
-        """
-        Function takes a taxon name and compares it to a dictionary of txid at a given taxonomy level to get the txid.
+    Parameters:
+        taxon_level_arg (int): taxon level, [0, 6], 6 being the most specific
 
-        Parameters:
-            taxon_str_arg (str): taxon name
-            taxon_level_arg (int): taxon level, [0, 6], 6 being the most specific
+    Returns:
+        (list): NCBI ranks, in order of preference
+    """
+    if args.match_db == 'taxonomy':
+        return TAXONOMY_LEVELS[taxon_level_arg]
+    return [rank for i in range(7) for rank in TAXONOMY_LEVELS[i]]
+def _compare_with_dict(args, taxonomy_arg: NcbiTaxonomy, queries_arg: list) -> dict:
+    """
+    Function finds the best matching txid of many taxon strings at once.
 
-        Returns:
-            best_match (dict): dictionary of best matched txid
-                score:  match score
-                txid:   txid from NCBI txid_dict_arg
-                name:   scientific name of match
-        """
+    Names that are the same after normalization are matched directly, the rest are fuzzy matched
+    (see _fuzzy_matches()).
+
+    Parameters:
+        taxonomy_arg (NcbiTaxonomy): NCBI taxonomy
+        queries_arg (list): distinct (taxon string, taxon level) queries
+
+    Returns:
+        (dict): best match of every query (None if there were no names to compare with)
+            score:  match score
+            txid:   txid from the NCBI taxonomy
+            name:   scientific name of match
+    """
+    best_matches: dict = {}
+    queries_by_ranks: dict = {}
+    for query in queries_arg:
+        queries_by_ranks.setdefault(tuple(_match_ranks(args, query[1])), []).append(query)
+
+    for match_db, queries in queries_by_ranks.items():
+        fuzzy_queries: list = []
+        for query in queries:
+            exact_match = taxonomy_arg.lookup_normalized(query[0], match_db)
+            if exact_match:
+                best_matches[query] = {'score': 100.0, 'txid': exact_match['txid'], 'name': exact_match['name']}
+            else:
+                fuzzy_queries.append(query)
+        if not fuzzy_queries:
+            continue
+
+        fuzzy_matches = _fuzzy_matches(args, taxonomy_arg, match_db, fuzzy_queries, args.candidate_index)
+        if args.check_recall:
+            _check_recall(args, fuzzy_queries, fuzzy_matches, _fuzzy_matches(args, taxonomy_arg, match_db, fuzzy_queries, False))
+        best_matches.update(fuzzy_matches)
+    return best_matches
+def _fuzzy_matches(args, taxonomy_arg: NcbiTaxonomy, match_db_arg: tuple, queries_arg: list, candidate_index_arg: bool) -> dict:
+    """
+    Function fuzzy matches taxon strings against the names of some ranks.
+
+    With the candidate index, every taxon string is only scored against the names that can reach
+    --match-threshold (see NcbiTaxonomy.candidates()), so matches below the threshold can differ from brute
+    force. Without it, the taxon strings are scored against every name of a rank in one rapidfuzz cdist call
+    (chunked to bound memory), as are the taxon strings without candidates when --output-mismatches is given
+    (so their closest name is still reported). Scoring runs on --workers threads.
+
+    Parameters:
+        taxonomy_arg (NcbiTaxonomy): NCBI taxonomy
+        match_db_arg (tuple): ranks to search, in order of preference
+        queries_arg (list): distinct (taxon string, taxon level) queries
+        candidate_index_arg (bool): only score the candidates of the trigram index
+
+    Returns:
+        (dict): best match of every query (None if there were no names to compare with)
+    """
+    best_matches: dict = {query: None for query in queries_arg}
+
+    # best score so far of every query, a later rank only wins with a higher score
+    best_scores = np.full(len(queries_arg), -1.0)
+    for taxonomy_synonym in match_db_arg:
+        rank_names, rank_txids = taxonomy_arg.names_at_rank(taxonomy_synonym)
+        if not rank_names:
+            continue
+        # (indexes of the queries, queries, names, indexes of the names in the rank) scored at once
+        chunks: list = []
+        brute_force_queries: list = list(range(len(queries_arg)))
+        if candidate_index_arg:
+            brute_force_queries = []
+            for query_i, query in enumerate(queries_arg):
+                candidates = taxonomy_arg.candidates(query[0], taxonomy_synonym, args.match_threshold, args.scorer == 'partial_ratio')
+                if candidates.size:
+                    chunks.append(([query_i], [query], [rank_names[candidate] for candidate in candidates.tolist()], candidates))
+                elif args.output_mismatches_path:
+                    brute_force_queries.append(query_i)
+        chunk_size = max(1, CDIST_CELLS // len(rank_names))
+        for chunk_start in range(0, len(brute_force_queries), chunk_size):
+            chunk_query_indexes: list = brute_force_queries[chunk_start:chunk_start + chunk_size]
+            chunks.append((chunk_query_indexes, [queries_arg[query_i] for query_i in chunk_query_indexes], rank_names, np.arange(len(rank_names))))
+
+        for chunk_query_indexes, chunk_queries, chunk_names, chunk_indexes in chunks:
+            scores = process.cdist(
+                [query[0] for query in chunk_queries], chunk_names,
+                scorer=SCORERS[args.scorer], dtype=np.float64, workers=args.workers)
+            # argmax keeps the first of equally good names, same as process.extract
+            match_indexes = scores.argmax(axis=1)
+            match_scores = scores[np.arange(len(chunk_queries)), match_indexes]
+            for query_i in np.flatnonzero(match_scores > best_scores[chunk_query_indexes]).tolist():
+                best_scores[chunk_query_indexes[query_i]] = match_scores[query_i]
+                best_matches[chunk_queries[query_i]] = {
+                    'score': float(match_scores[query_i]),
+                    'txid': int(rank_txids[chunk_indexes[match_indexes[query_i]]]),
+                    'name': chunk_names[match_indexes[query_i]]}
+    return best_matches
+def _check_recall(args, queries_arg: list, index_matches_arg: dict, brute_force_matches_arg: dict) -> None:
+    """
+    Function reports taxon strings the candidate index matched differently than brute force at --match-threshold.
+
+    Parameters:
+        queries_arg (list): (taxon string, taxon level) queries
+        index_matches_arg (dict): best matches found with the candidate index
+        brute_force_matches_arg (dict): best matches found by scoring every name
 
-        total_matches: list = []
-        match_db: list = []
-
-        if args.match_db == 'taxonomy':
-            match_db = taxonomy_levels[taxon_level_arg]
-        elif args.match_db == 'all':
-            for i in range(7):
-                match_db += taxonomy_levels[i]
-
-        for taxonomy_synonym in match_db:
-            fuzzy_match = process.extract(taxon_str_arg, list(txid_dict_arg['names'][taxonomy_synonym].keys()), scorer=scorer[args.scorer], limit=1)
-            match_name = fuzzy_match[0][0]
-            match_score = fuzzy_match[0][1]
-            match_txid = txid_dict_arg['names'][taxonomy_synonym][match_name]
-            match = {'score': match_score, 'txid': match_txid, 'name': match_name}
-            total_matches.append(match)
-        best_match = sorted(total_matches, key=lambda match: match['score'], reverse=True)[0]
-        
-        if round(best_match['score']) >= args.match_threshold:
-            return best_match
+    Returns:
+        None
+    """
+    def _accepted(match_arg: dict) -> tuple:
+        """ Match that passes the threshold, as (txid, score) (None if it doesn't). """
+        if match_arg and round(match_arg['score']) >= args.match_threshold:
+            return (match_arg['txid'], match_arg['score'])
+        return None
+
+    missed_queries: list = [query for query in queries_arg if _accepted(index_matches_arg[query]) != _accepted(brute_force_matches_arg[query])]
+    print_runtime(f'Recall check: {len(queries_arg) - len(missed_queries)}/{len(queries_arg)} candidate index matches agree with brute force.')
+    for query in missed_queries:
+        print_runtime(f'Recall check: "{query[0]}" (level {query[1]}) matched {_accepted(index_matches_arg[query])}, brute force {_accepted(brute_force_matches_arg[query])}')
+    return None
+def _match_otus(args, taxonomy_arg: NcbiTaxonomy, match_cache_arg: TaxonMatchCache, otu_queries_arg: list) -> tuple:
+    """
+    Function matches the taxonomy of every OTU, one taxon level at a time for the whole table.
+
+    Every round collects the distinct queries of the OTUs that are still unmatched, so each taxon string is
+    only compared once per round, and OTUs that did not pass the threshold move on to their next query.
+    Matches in the match cache are not compared again.
+
+    Parameters:
+        taxonomy_arg (NcbiTaxonomy): NCBI taxonomy
+        match_cache_arg (TaxonMatchCache): cache of taxon string matches (None to match everything)
+        otu_queries_arg (list): queries of every OTU, from _taxon_queries()
+
+    Returns:
+        (tuple): best match of every OTU (False if none passed the threshold), mismatch lines in OTU order
+    """
+    otu_matches: list = [False] * len(otu_queries_arg)
+    otu_mismatches: list = [[] for _ in otu_queries_arg]
+    next_queries: list = [0] * len(otu_queries_arg)
+    # matches of the candidate index are only complete down to the threshold, brute force ones down to 0
+    min_score: int = args.match_threshold if args.candidate_index else 0
+    unmatched: list = [otu_i for otu_i, otu_queries in enumerate(otu_queries_arg) if otu_queries]
+    while unmatched:
+        round_queries: list = list(dict.fromkeys(otu_queries_arg[otu_i][next_queries[otu_i]] for otu_i in unmatched))
+        best_matches: dict = {}
+        if match_cache_arg is not None:
+            # the cache is keyed by ranks, taxon levels of --match-db all share them
+            cache_queries: dict = {query: (query[0], tuple(_match_ranks(args, query[1]))) for query in round_queries}
+            cached_matches = match_cache_arg.get(list(cache_queries.values()), args.scorer, min_score)
+            # cached taxon strings without a match may have had no index candidates, they get their closest name
+            # for --output-mismatches
+            best_matches = {
+                query: cached_matches[cache_query] for query, cache_query in cache_queries.items()
+                if cache_query in cached_matches and (cached_matches[cache_query] or not args.output_mismatches_path)}
+        new_matches = _compare_with_dict(args, taxonomy_arg, [query for query in round_queries if query not in best_matches])
+        if match_cache_arg is not None:
+            match_cache_arg.put({cache_queries[query]: match for query, match in new_matches.items()}, args.scorer, min_score)
+        best_matches.update(new_matches)
+        still_unmatched: list = []
+        for otu_i in unmatched:
+            taxon_str, taxon_level = otu_queries_arg[otu_i][next_queries[otu_i]]
+            best_match = best_matches[(taxon_str, taxon_level)]
+            if best_match and round(best_match['score']) >= args.match_threshold:
+                otu_matches[otu_i] = best_match
+                continue
+            if best_match:
+                otu_mismatches[otu_i].append(f"{taxon_str}\t{taxon_level}\t{best_match['name']}\t{best_match['txid']}\t{best_match['score']}\n")
+            else:
+                # no names at its ranks: still listed, without a best match
+                otu_mismatches[otu_i].append(f"{taxon_str}\t{taxon_level}\tN/A\tN/A\t0\n")
+            next_queries[otu_i] += 1
+            if next_queries[otu_i] < len(otu_queries_arg[otu_i]):
+                still_unmatched.append(otu_i)
+        print_runtime(f'Matched {len(best_matches)} distinct taxon strings ({len(best_matches) - len(new_matches)} cached), {len(still_unmatched)} OTUs left unmatched.')
+        unmatched = still_unmatched
+    return otu_matches, [mismatch for mismatches in otu_mismatches for mismatch in mismatches]
+def _process_csv(args, path_arg: Path, output_path_arg: Path, taxonomy_arg: NcbiTaxonomy, match_cache_arg: TaxonMatchCache) -> int:
+    """
+    Function processes a (.csv) file into the output OTU table, --chunk-size OTUs at a time.
+
+    Parameters:
+        path_arg (Path): path of the OTU .csv file
+        output_path_arg (Path): path of the output OTU .csv file
+        taxonomy_arg (NcbiTaxonomy): NCBI taxonomy
+        match_cache_arg (TaxonMatchCache): cache of taxon string matches (None to match everything)
+
+    Returns:
+        (int): number of OTUs processed
+    """
+
+    start_time = time.time()
+    result_count: int = 0
+    write_biom: bool = bool(args.biom_path or args.biom_collapsed_path)
+    # non-zero abundances as (OTU, sample, abundance) triplets, and the id and taxonomy of every OTU
+    abundance_chunks: list = []
+    otu_names: list = []
+    otu_taxonomies: list = []
+
+    with open(path_arg, 'r', encoding='utf8', newline='') as otu_csv_file, open(output_path_arg, 'w', encoding='utf8', newline='') as output_csv_file:
+        otu_reader = csv.DictReader(otu_csv_file)
+
+        # output columns are fixed by the header: name, taxonomy, abundance of every sample, sequence
+        samples: list = [column.replace("Abundance", "").strip() for column in (otu_reader.fieldnames or []) if "Abundance" in column and not "Combined" in column]
+        output_writer = csv.writer(output_csv_file, lineterminator='\n')
+        output_writer.writerow(['Name', 'Taxonomy'] + samples + ['Sequence'])
+
+        otu_chunks = iter(lambda: list(islice(otu_reader, args.chunk_size)), [])
+        if args.processes > 1:
+            chunk_results = _process_chunks_parallel(args, otu_chunks, samples, taxonomy_arg)
         else:
+            chunk_results = (_process_chunk(args, chunk_lines, samples, taxonomy_arg, match_cache_arg) for chunk_lines in otu_chunks)
+
+        # chunk results come back in input order, only this process writes the outputs
+        for output_rows, mismatches in chunk_results:
             if args.output_mismatches_path:
                 with open(args.output_mismatches_path, 'a', encoding='utf8') as mismatches_file:
-                    mismatches_file.write(f"{taxon_str_arg}\t{taxon_level_arg}\t{best_match['name']}\t{best_match['txid']}\t{best_match['score']}\n")
-            return False
+                    mismatches_file.writelines(mismatches)
+            output_writer.writerows(output_rows)
+            if write_biom and output_rows:
+                chunk_abundances = np.asarray([row[2:-1] for row in output_rows], dtype=np.int64).reshape(len(output_rows), len(samples))
+                chunk_otus, chunk_samples = np.nonzero(chunk_abundances)
+                abundance_chunks.append((chunk_otus + result_count, chunk_samples, chunk_abundances[chunk_otus, chunk_samples]))
+                otu_names += [row[0] for row in output_rows]
+                otu_taxonomies += [row[1] for row in output_rows]
+            result_count += len(output_rows)
+            elapsed_time = time.time() - start_time
+            print_runtime(f'Completed: {result_count} OTUs | ({round(elapsed_time, 3)} s. elapsed, {round(result_count / max(elapsed_time, 1e-9))} rows/s)')
+
+    if write_biom:
+        otu_abundances = sparse.coo_matrix(
+            (np.concatenate([chunk[2] for chunk in abundance_chunks] or [np.zeros(0, dtype=np.int64)]),
+             (np.concatenate([chunk[0] for chunk in abundance_chunks] or [np.zeros(0, dtype=np.int64)]),
+              np.concatenate([chunk[1] for chunk in abundance_chunks] or [np.zeros(0, dtype=np.int64)]))),
+            shape=(result_count, len(samples))).tocsr()
+        if args.biom_path:
+            _write_biom(args.biom_path, otu_abundances, otu_names, otu_taxonomies, samples)
+        if args.biom_collapsed_path:
+            # group-by taxonomy: an indicator matrix (taxonomy x OTU) times the abundances, taxonomies in order of appearance
+            unique_taxonomies, first_otus, taxonomy_indexes = np.unique(np.asarray(otu_taxonomies, dtype=object), return_index=True, return_inverse=True)
+            appearance_order = np.argsort(first_otus, kind='stable')
+            taxonomy_ranks = np.empty_like(appearance_order)
+            taxonomy_ranks[appearance_order] = np.arange(len(appearance_order))
+            taxonomy_indicator = sparse.csr_matrix(
+                (np.ones(result_count, dtype=np.int64), (taxonomy_ranks[taxonomy_indexes.ravel()], np.arange(result_count))),
+                shape=(len(unique_taxonomies), result_count))
+            collapsed_taxonomies: list = unique_taxonomies[appearance_order].tolist()
+            _write_biom(
+                args.biom_collapsed_path, (taxonomy_indicator @ otu_abundances).tocsr(),
+                ['Unassigned' if taxonomy == UNMATCHED_TAXONOMY else taxonomy for taxonomy in collapsed_taxonomies], collapsed_taxonomies, samples)
+    return result_count
+def _write_biom(path_arg: Path, abundances_arg, observation_ids_arg: list, taxonomies_arg: list, samples_arg: list) -> None:
+    """
+    Function writes a sparse abundance matrix as a BIOM (HDF5) table.
+
+    Parameters:
+        path_arg (Path): path of the output .biom file
+        abundances_arg (scipy.sparse.csr_matrix): abundance of every observation (rows) in every sample (columns)
+        observation_ids_arg (list): observation ids
+        taxonomies_arg (list): taxonomy column of every observation
+        samples_arg (list): sample ids
+
+    Returns:
+        None
+    """
+    observation_metadata: list = [
+        {'taxonomy': ['Unassigned'] if taxonomy == UNMATCHED_TAXONOMY else taxonomy.split('; ')}
+        for taxonomy in taxonomies_arg]
+    biom_table = Table(abundances_arg, observation_ids_arg, samples_arg, observation_metadata, type='OTU table')
+    with biom_open(str(path_arg), 'w') as biom_file:
+        biom_table.to_hdf5(biom_file, f'fuzzy_collapse_otu.py v{__version__}')
+    return None
+def _process_chunks_parallel(args, chunks_arg, samples_arg: list, taxonomy_arg: NcbiTaxonomy):
+    """
+    Function processes chunks of OTUs in --processes worker processes.
+
+    Forked workers inherit the (memory-mapped) taxonomy, spawned ones load it from the taxonomy cache. Every
+    worker opens its own connection to the match cache. At most two chunks per worker are in flight.
+
+    Parameters:
+        chunks_arg (iterable): chunks of OTU .csv rows (dicts)
+        samples_arg (list): sample names, in output order
+        taxonomy_arg (NcbiTaxonomy): NCBI taxonomy
+
+    Returns:
+        (generator): results of _process_chunk(), in input order
+    """
+    _WORKER_STATE['taxonomy'] = taxonomy_arg
+    mp_context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    with ProcessPoolExecutor(max_workers=args.processes, mp_context=mp_context, initializer=_init_worker, initargs=(args,)) as executor:
+        pending_chunks: deque = deque()
+        for chunk_lines in chunks_arg:
+            pending_chunks.append(executor.submit(_process_worker_chunk, chunk_lines, samples_arg))
+            if len(pending_chunks) >= 2 * args.processes:
+                yield pending_chunks.popleft().result()
+        while pending_chunks:
+            yield pending_chunks.popleft().result()
+def _init_worker(args) -> None:
+    """
+    Function sets up a worker process of _process_chunks_parallel().
+
+    Parameters:
+        args (Namespace): command-line arguments
+
+    Returns:
+        None
+    """
+    if 'taxonomy' not in _WORKER_STATE:
+        _WORKER_STATE['taxonomy'] = load_taxonomy(args.names_path, args.nodes_path, args.taxonomy_cache_path)
+    _WORKER_STATE['match_cache'] = TaxonMatchCache(args.match_cache_path, _WORKER_STATE['taxonomy'].key, args.match_cache_size) if args.match_cache_path else None
+    _WORKER_STATE['args'] = args
+    return None
+def _process_worker_chunk(lines_arg: list, samples_arg: list) -> tuple:
+    """ _process_chunk() in a worker process. """
+    return _process_chunk(_WORKER_STATE['args'], lines_arg, samples_arg, _WORKER_STATE['taxonomy'], _WORKER_STATE['match_cache'])
+def _process_chunk(args, lines_arg: list, samples_arg: list, taxonomy_arg: NcbiTaxonomy, match_cache_arg: TaxonMatchCache) -> tuple:
+    """
+    Function matches the taxonomy of a chunk of OTUs and produces their output rows.
+
+    Parameters:
+        lines_arg (list): OTU .csv rows (dicts)
+        samples_arg (list): sample names, in output order
+        taxonomy_arg (NcbiTaxonomy): NCBI taxonomy
+        match_cache_arg (TaxonMatchCache): cache of taxon string matches (None to match everything)
+
+    Returns:
+        (tuple): output rows (name, taxonomy, abundance of every sample, sequence), mismatch lines
+    """
     def _convert_taxonomy(taxonomy_list_arg: list) -> tuple:
         """
         Function produces a tuple of taxonomy.
@@ -175,159 +601,57 @@ def _process_csv(args, path_arg: Path, txid_dict_arg: dict) -> dict:
         Returns:
             (tuple): tuple of txid translated to scientific name and rank
         """
-        return tuple({'name': txid_dict_arg['nodes'][txid]['name'], 'rank': txid_dict_arg['nodes'][txid]['rank']} for txid in taxonomy_list_arg)
-    with open(path_arg, 'r', encoding='utf8') as otu_csv_file:
-
-        # skip the header
-        all_lines: list = [value for value in csv.DictReader(otu_csv_file)]
-
-        # initialize the result counter for printing
-        result_count: int  = 0
-
-        for line in all_lines:
-            otu_entry_dict: dict = {'Name': line['Name']}
-
-            result_count += 1
-            taxonomy = [taxon.strip() for taxon in line["Taxonomy"].split(';')]
-            samples = [sample.replace("Abundance", "").strip() for sample in list(line.keys()) if "Abundance" in sample and not "Combined" in sample]
-
-            # initialize the matched taxonomy result
-            matched_taxonomy_result: str = ''
-
-            # starting from the most narrowed taxonomy, try to find a match
-            for taxonomy_i, taxonomy_level_str in enumerate(taxonomy[::-1]):
-                # counting backwards from the list, also make the numbers count down
-                actual_taxonomy_level = len(taxonomy) - taxonomy_i - 1
-
-                # don't match taxonomy if it doesn't even pass the string filtering
-                filtered_strings = any((
-                    ('uncultured' in taxonomy_level_str.lower()),
-                    ('metagenome' in taxonomy_level_str.lower()),
-                    ('unknown' in taxonomy_level_str.lower()),
-                    ('unclassified' in taxonomy_level_str.lower()),
-                    ('unidentified' in taxonomy_level_str.lower()),
-                    (not taxonomy_level_str)
-                    ))
-                if not filtered_strings:
-                    taxonomy_level_str = taxonomy_level_str.split('(')[0].strip()
-                    taxonomy_level_str = taxonomy_level_str.replace('[', '').replace(']', '')
-                    matched_taxonomy_result = _compare_with_dict(taxonomy_level_str, actual_taxonomy_level)
-                    if matched_taxonomy_result:
-                        break
-                else:
-                    continue
-
-            if matched_taxonomy_result:
-                taxonomy_list = _convert_taxonomy(txid_dict_arg['nodes'][matched_taxonomy_result['txid']]['taxonomy'][::-1])
-
-                # eukaryotes are classified in superkingdom eukaryota
-                # bacteria and archaea are classified into kingdom prokaryota
-
-                if 'superkingdom' in [taxon['rank'] for taxon in taxonomy_list]:
-                    allowed_taxonomy = ('superkingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species')
-                else:
-                    allowed_taxonomy = ('kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species')
-
-                pre_processed_taxonomy = [taxon['name'] for taxon in taxonomy_list if taxon['rank'] in allowed_taxonomy]
-
-                # add 'unclassified' taxonomy entries
-                if len(pre_processed_taxonomy) < len(allowed_taxonomy):
-                    processed_taxonomy = pre_processed_taxonomy
-                    highest_level = pre_processed_taxonomy[-1]
-                    for i in range(len(allowed_taxonomy) - len(processed_taxonomy)):
-                        processed_taxonomy.append(f'Unclassified {highest_level}')
-                else:
-                    processed_taxonomy = pre_processed_taxonomy
-            elif not matched_taxonomy_result:
-                processed_taxonomy = 'N/A'
-
-            otu_entry_dict['Taxonomy'] = '; '.join(processed_taxonomy)
-            otu_entry_dict['Sequence'] = line['Sequence']
-
-            for sample in samples:
-                sample_key = f"{sample} Abundance"
-                otu_entry_dict[sample] = int(line[sample_key])
-
-            if result_count % 500 == 0:
-                print_runtime(f'Completed: {result_count}/{len(all_lines)} | ({round(time.time() - start_time, 3)} s. elapsed)')
-
-            _processed_otus.append(otu_entry_dict)
-    return _processed_otus
-def _create_txid_dict(names_dmp_path_arg: Path, nodes_dmp_path_arg: Path) -> dict:
-    """
-    Function creates a dictionary based on NCBI names and nodes.
-
-    Parameters:
-        names_dmp_path_arg (Path): path of names.dmp file
-        nodes_dmp_path_arg (Path): path of nodes.dmp file
-
-    Returns:
-        (dict): processed txid dictionary
-            nodes: node dictionary, keys are txid
-            names: names dictionary, keys are taxonomic ranks, subkeys are scientific names
-    """
-    # initialize txid_name and node dictionaries
-    _names_dict: dict = {}
-    _nodes_dict: dict = {}
-    with open(names_dmp_path_arg, 'r', encoding='utf8') as names_dmp_file, \
-         open(nodes_dmp_path_arg, 'r', encoding='utf8') as nodes_dmp_file:
-
-        # for each line in the node file, create a txid entry with taxonomy info
-        for line in nodes_dmp_file.readlines():
-            line_args = [line_arg.strip() for line_arg in line.split('|')]
-            txid = int(line_args[0])
-            _nodes_dict[txid] = {
-                'rank': line_args[2],
-                'parent_node': int(line_args[1])
-                }
-
-        # for the scientific or equivalent names in name file, create an entry with txid
-        for line in names_dmp_file.readlines():
-            line_args = [line_arg.strip() for line_arg in line.split('|')]
-            name_check = any((
-                'scientific name' in line_args,
-                'equivalent name' in line_args,
-                'synonym' in line_args))
-            if name_check:
-                taxon_name = line_args[1]
-                txid = int(line_args[0])
-                if 'scientific name' in line_args:
-                    _nodes_dict[txid]['name'] = taxon_name
-                try:
-
-                    _names_dict[_nodes_dict[txid]['rank']][taxon_name] = txid
-                except KeyError:
-                    _names_dict[_nodes_dict[txid]['rank']] = {}
-                    _names_dict[_nodes_dict[txid]['rank']][taxon_name] = txid
-
-    # post-processing of the node dictionary to create taxonomy
-    for entry, _ in _nodes_dict.items():
-        _nodes_dict[entry]['taxonomy']: list = [entry]
-
-        current_level = _nodes_dict[entry]['parent_node']
-        while _nodes_dict[entry]['taxonomy'][-1] != 1:
-            _nodes_dict[entry]['taxonomy'].append(current_level)
-            current_level = _nodes_dict[current_level]['parent_node']
-    print_runtime(f'Created NCBI txid database .')
-    return {'nodes': _nodes_dict, 'names': _names_dict}
+        return tuple({'name': taxonomy_arg.name(txid), 'rank': taxonomy_arg.rank(txid)} for txid in taxonomy_list_arg)
+
+    # match the distinct taxon strings of the whole chunk first
+    otu_matches, mismatches = _match_otus(args, taxonomy_arg, match_cache_arg, [_taxon_queries(line['Taxonomy']) for line in lines_arg])
+
+    output_rows: list = []
+    for line, matched_taxonomy_result in zip(lines_arg, otu_matches):
+        if matched_taxonomy_result:
+            taxonomy_list = _convert_taxonomy(taxonomy_arg.lineage(matched_taxonomy_result['txid'])[::-1])
+
+            # eukaryotes are classified in superkingdom eukaryota
+            # bacteria and archaea are classified into kingdom prokaryota
+
+            if 'superkingdom' in [taxon['rank'] for taxon in taxonomy_list]:
+                allowed_taxonomy = ('superkingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species')
+            else:
+                allowed_taxonomy = ('kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species')
+
+            pre_processed_taxonomy = [taxon['name'] for taxon in taxonomy_list if taxon['rank'] in allowed_taxonomy]
+
+            # add 'unclassified' taxonomy entries
+            if len(pre_processed_taxonomy) < len(allowed_taxonomy):
+                processed_taxonomy = pre_processed_taxonomy
+                highest_level = pre_processed_taxonomy[-1]
+                for i in range(len(allowed_taxonomy) - len(processed_taxonomy)):
+                    processed_taxonomy.append(f'Unclassified {highest_level}')
+            else:
+                processed_taxonomy = pre_processed_taxonomy
+        elif not matched_taxonomy_result:
+            processed_taxonomy = 'N/A'
+
+        output_rows.append(
+            [line['Name'], '; '.join(processed_taxonomy)]
+            + [int(line[f"{sample} Abundance"]) for sample in samples_arg]
+            + [line['Sequence']])
+    return output_rows, mismatches
 # --------------------------------------------------
 def main() -> None:
     """ Insert docstring here """
 
     args = get_args()
-    txid_dict = _create_txid_dict(args.names_path, args.nodes_path)
+    taxonomy = load_taxonomy(args.names_path, args.nodes_path, args.taxonomy_cache_path)
+    print_runtime(f'Loaded NCBI taxonomy ({len(taxonomy)} txids) .')
+    match_cache = TaxonMatchCache(args.match_cache_path, taxonomy.key, args.match_cache_size) if args.match_cache_path else None
 
     if args.output_mismatches_path:
         with open(args.output_mismatches_path, 'w', encoding='utf8') as mismatches_file:
             mismatches_file.write(f"taxon_query\ttaxon_level\tbest_match\tbest_match_score\tbest_match_score\n")
-    otu_DataFrame = pd.DataFrame(_process_csv(args, args.input_path, txid_dict))
-    otu_DataFrame_columns = ['Name', 'Taxonomy'] \
-        + [column for column in otu_DataFrame.columns.to_list() if not column in ('Name', 'Taxonomy', 'Sequence')]\
-        + ['Sequence']
-    if args.output_path:
-        otu_DataFrame[otu_DataFrame_columns].to_csv(args.output_path, index=False)
-    else:
-        otu_DataFrame[otu_DataFrame_columns].to_csv('output.csv', index=False)
+    _process_csv(args, args.input_path, args.output_path if args.output_path else Path('output.csv'), taxonomy, match_cache)
+    if match_cache is not None:
+        match_cache.close()
     print_runtime(f'Produced resulting OTU table .')
     return None
 def print_runtime(action) -> None:
@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+"""
+Purpose: NCBI taxonomy (nodes.dmp/names.dmp) parsed once into a memory-mapped binary cache.
+
+The first run parses the .dmp files into NumPy arrays (parent, rank and depth of every node, scientific
+names and per-rank name lookups) and writes them as .npy files to a cache directory keyed by the size,
+modification time and a sampled hash of both .dmp files. Later runs memory-map the cached arrays, so
+loading takes about a second and only the parts of the taxonomy that are used are read from disk.
+
+Matchable names are also indexed by a 64-bit hash of their normalized form (see normalize_name()), so a
+taxon string can be resolved exactly before falling back to fuzzy matching. For fuzzy matching, every
+matchable name is also listed in a trigram inverted index (see NcbiTaxonomy.candidates()), which narrows a
+rank down to the names that can reach a match threshold.
+
+Strings are kept as string tables: one uint8 array of newline-terminated UTF-8 strings, and an int64 array
+of the offset of every string. Lineages are not stored, they are walked up the parent array when needed.
+"""
+__author__ = "Erick Samera"
+__version__ = "1.1.0"
+__comment__ = 'stable'
+
+# --------------------------------------------------
+from pathlib import Path
+# --------------------------------------------------
+import hashlib
+import shutil
+import json
+import os
+# --------------------------------------------------
+import numpy as np
+# --------------------------------------------------
+# bump when the cached layout changes, older caches are rebuilt
+TAXONOMY_CACHE_VERSION: int = 4
+DEFAULT_CACHE_DIR: Path = Path(os.environ.get('XDG_CACHE_HOME', Path.home().joinpath('.cache'))).joinpath('metagenomics', 'ncbi-taxonomy')
+# name classes of names.dmp that can be matched
+NAME_CLASSES: tuple = ('scientific name', 'equivalent name', 'synonym')
+# bytes hashed from the start and the end of each .dmp file for the cache key
+_HASHED_BYTES: int = 1 << 20
+_ARRAY_NAMES: tuple = (
+    'txids', 'parents', 'ranks', 'depths',
+    'name_data', 'name_offsets',
+    'lookup_data', 'lookup_offsets', 'lookup_nodes', 'lookup_order', 'rank_bounds',
+    'normalized_hashes', 'normalized_order',
+    'lookup_lengths', 'trigram_keys', 'trigram_offsets', 'trigram_names', 'trigram_counts')
+# --------------------------------------------------
+class NcbiTaxonomy:
+    """
+    Read-only NCBI taxonomy backed by (memory-mapped) arrays. Taxa are given and returned as NCBI txids.
+
+    Parameters:
+        arrays_arg (dict): taxonomy arrays, see _ARRAY_NAMES
+        metadata_arg (dict): rank names (indexed by rank code) and cache key
+    """
+    def __init__(self, arrays_arg: dict, metadata_arg: dict) -> None:
+        self.arrays = arrays_arg
+        self.rank_names: list = metadata_arg['rank_names']
+        self.key: str = metadata_arg['key']
+        self._rank_codes: dict = {rank: rank_code for rank_code, rank in enumerate(self.rank_names)}
+        self._rank_choices: dict = {}
+        self._txid_limits: tuple = (int(np.iinfo(arrays_arg['txids'].dtype).min), int(np.iinfo(arrays_arg['txids'].dtype).max))
+    def __len__(self) -> int:
+        return len(self.arrays['txids'])
+    def __contains__(self, txid_arg: int) -> bool:
+        return self._search_txid(txid_arg) is not None
+    def _search_txid(self, txid_arg: int) -> int:
+        """ Array index of a txid (None if the txid is not in the taxonomy). """
+        txids = self.arrays['txids']
+        if not self._txid_limits[0] <= txid_arg <= self._txid_limits[1]:
+            return None
+        # searching with the dtype of the array avoids casting (copying) the whole array
+        node = int(np.searchsorted(txids, txids.dtype.type(txid_arg)))
+        return node if node < len(self) and int(txids[node]) == txid_arg else None
+    def node(self, txid_arg: int) -> int:
+        """ Array index of a txid (KeyError if the txid is not in the taxonomy). """
+        node = self._search_txid(txid_arg)
+        if node is None:
+            raise KeyError(txid_arg)
+        return node
+    def name(self, txid_arg: int) -> str:
+        """ Scientific name of a txid. """
+        return _string_at(self.arrays['name_data'], self.arrays['name_offsets'], self.node(txid_arg))
+    def rank(self, txid_arg: int) -> str:
+        """ Rank of a txid (ex: "species", "no rank"). """
+        return self.rank_names[self.arrays['ranks'][self.node(txid_arg)]]
+    def lineage(self, txid_arg: int) -> list:
+        """ Lineage of a txid, from the txid itself up to the root (txid 1). """
+        parents = self.arrays['parents']
+        lineage_nodes: list = [self.node(txid_arg)]
+        for _ in range(int(self.arrays['depths'][lineage_nodes[0]])):
+            lineage_nodes.append(int(parents[lineage_nodes[-1]]))
+        return self.arrays['txids'][lineage_nodes].tolist()
+    def lookup(self, name_arg: str, rank_arg: str) -> int:
+        """ txid of a scientific name, equivalent name or synonym at a rank (None if there is none). """
+        if rank_arg not in self._rank_codes:
+            return None
+        rank_code = self._rank_codes[rank_arg]
+        low, high = int(self.arrays['rank_bounds'][rank_code]), int(self.arrays['rank_bounds'][rank_code + 1])
+        name = name_arg.encode('utf8')
+        # binary search through the names of the rank in sorted (as bytes) order
+        lookup_order = self.arrays['lookup_order']
+        while low < high:
+            middle = (low + high) // 2
+            if _bytes_at(self.arrays['lookup_data'], self.arrays['lookup_offsets'], lookup_order[middle]) < name:
+                low = middle + 1
+            else:
+                high = middle
+        if low < int(self.arrays['rank_bounds'][rank_code + 1]) and _bytes_at(self.arrays['lookup_data'], self.arrays['lookup_offsets'], lookup_order[low]) == name:
+            return int(self.arrays['txids'][self.arrays['lookup_nodes'][lookup_order[low]]])
+        return None
+    def lookup_normalized(self, name_arg: str, ranks_arg: list) -> dict:
+        """
+        Matchable name that is the same as a taxon string after normalize_name(), at the first rank that has one.
+
+        Among names with the same normalized form, an exact match is preferred, then the first one in names.dmp.
+
+        Parameters:
+            name_arg (str): taxon string
+            ranks_arg (list): ranks to search, in order of preference
+
+        Returns:
+            (dict): match (None if there is none)
+                txid:   NCBI txid
+                name:   matched name
+                rank:   rank of the match
+        """
+        normalized_name = normalize_name(name_arg)
+        name_hash = np.uint64(_name_hash(normalized_name))
+        low = int(np.searchsorted(self.arrays['normalized_hashes'], name_hash, side='left'))
+        high = int(np.searchsorted(self.arrays['normalized_hashes'], name_hash, side='right'))
+        if low == high:
+            return None
+        candidates = np.sort(self.arrays['normalized_order'][low:high])
+        candidate_ranks = np.searchsorted(self.arrays['rank_bounds'], candidates, side='right') - 1
+        for rank in ranks_arg:
+            if rank not in self._rank_codes:
+                continue
+            rank_candidates: list = [
+                (candidate_name, candidate) for candidate in candidates[candidate_ranks == self._rank_codes[rank]].tolist()
+                if normalize_name(candidate_name := _string_at(self.arrays['lookup_data'], self.arrays['lookup_offsets'], candidate)) == normalized_name]
+            if rank_candidates:
+                match_name, match_index = next((candidate for candidate in rank_candidates if candidate[0] == name_arg), rank_candidates[0])
+                return {'txid': int(self.arrays['txids'][self.arrays['lookup_nodes'][match_index]]), 'name': match_name, 'rank': rank}
+        return None
+    def candidates(self, name_arg: str, rank_arg: str, threshold_arg: float, partial_arg: bool = False) -> np.ndarray:
+        """
+        Names at a rank that can score at least a threshold against a taxon string, found in the trigram index.
+
+        A name is a candidate when it shares enough trigrams (counted with multiplicity) with the taxon string:
+        every Indel edit destroys at most three trigrams, and a ratio (or partial_ratio) of at least the threshold
+        bounds the number of edits. The filter is lossless, every name that reaches the threshold with
+        ratio/QRatio (partial_ratio if partial_arg) is a candidate; names below it may be left out.
+
+        Parameters:
+            name_arg (str): taxon string
+            rank_arg (str): rank to search
+            threshold_arg (float): 0..100, minimum score
+            partial_arg (bool): the score is a partial_ratio
+
+        Returns:
+            (np.ndarray): indexes of the candidates in names_at_rank(), in order
+        """
+        if rank_arg not in self._rank_codes:
+            return np.zeros(0, dtype=np.int64)
+        rank_code = self._rank_codes[rank_arg]
+        low, high = int(self.arrays['rank_bounds'][rank_code]), int(self.arrays['rank_bounds'][rank_code + 1])
+
+        # trigrams the taxon string shares with every name of the rank
+        query_trigrams, query_counts = np.unique(_trigram_hashes(_code_points(name_arg)), return_counts=True)
+        trigram_indexes = np.searchsorted(self.arrays['trigram_keys'], query_trigrams)
+        found = trigram_indexes < len(self.arrays['trigram_keys'])
+        found[found] = self.arrays['trigram_keys'][trigram_indexes[found]] == query_trigrams[found]
+        shared = np.zeros(high - low, dtype=np.int64)
+        for trigram_index, query_count in zip(trigram_indexes[found].tolist(), query_counts[found].tolist()):
+            posting_start, posting_end = int(self.arrays['trigram_offsets'][trigram_index]), int(self.arrays['trigram_offsets'][trigram_index + 1])
+            posting_names = self.arrays['trigram_names'][posting_start:posting_end]
+            rank_start, rank_end = np.searchsorted(posting_names, np.asarray((low, high), dtype=posting_names.dtype)) + posting_start
+            # a name is listed once per trigram, so no index repeats
+            shared[self.arrays['trigram_names'][rank_start:rank_end] - low] += np.minimum(self.arrays['trigram_counts'][rank_start:rank_end], query_count)
+
+        # Indel distance allowed by the threshold (round(score) passes at threshold - 0.5), and the
+        # trigrams that have to survive it
+        query_length = len(name_arg)
+        name_lengths = self.arrays['lookup_lengths'][low:high].astype(np.int64)
+        if partial_arg:
+            aligned_lengths = np.minimum(name_lengths, query_length)
+            max_distances = np.floor((1 - (threshold_arg - 0.5) / 100) * 2 * aligned_lengths + 1e-9)
+            needed = aligned_lengths - 2 - 3 * max_distances
+            is_candidate = shared >= needed
+        else:
+            max_distances = np.floor((1 - (threshold_arg - 0.5) / 100) * (name_lengths + query_length) + 1e-9)
+            needed = np.maximum(name_lengths, query_length) - 2 - 3 * max_distances
+            is_candidate = (shared >= needed) & (np.abs(name_lengths - query_length) <= max_distances)
+        return np.flatnonzero(is_candidate)
+    def names_at_rank(self, rank_arg: str) -> tuple:
+        """
+        Every matchable name at a rank, decoded once and kept for later calls.
+
+        Returns:
+            (tuple): list of names (str), int array of their txids
+        """
+        if rank_arg not in self._rank_choices:
+            if rank_arg not in self._rank_codes:
+                self._rank_choices[rank_arg] = ([], np.zeros(0, dtype=np.int32))
+            else:
+                rank_code = self._rank_codes[rank_arg]
+                low, high = int(self.arrays['rank_bounds'][rank_code]), int(self.arrays['rank_bounds'][rank_code + 1])
+                names_data = self.arrays['lookup_data'][self.arrays['lookup_offsets'][low]:self.arrays['lookup_offsets'][high]]
+                names: list = names_data.tobytes().decode('utf8').split('\n')[:-1] if high > low else []
+                self._rank_choices[rank_arg] = (names, self.arrays['txids'][self.arrays['lookup_nodes'][low:high]])
+        return self._rank_choices[rank_arg]
+# --------------------------------------------------
+def normalize_name(name_arg: str) -> str:
+    """
+    Function normalizes a taxon name for exact matching: the cleaning fuzzy_collapse_otu.py applies to CLC
+    taxonomy strings (drop a trailing parenthetical and square brackets), case folding and single spaces.
+
+    Parameters:
+        name_arg (str): taxon name
+
+    Returns:
+        (str): normalized name
+    """
+    return ' '.join(name_arg.split('(')[0].replace('[', '').replace(']', '').casefold().split())
+def load_taxonomy(names_dmp_path_arg: Path, nodes_dmp_path_arg: Path, cache_dir_arg: Path = DEFAULT_CACHE_DIR) -> NcbiTaxonomy:
+    """
+    Function loads the NCBI taxonomy from the cache, or parses the .dmp files and caches the result.
+
+    Parameters:
+        names_dmp_path_arg (Path): path of names.dmp file
+        nodes_dmp_path_arg (Path): path of nodes.dmp file
+        cache_dir_arg (Path): directory of cached taxonomies (None to disable caching)
+
+    Returns:
+        (NcbiTaxonomy): taxonomy
+    """
+    key = _cache_key(names_dmp_path_arg, nodes_dmp_path_arg)
+    cache_path = cache_dir_arg.joinpath(key) if cache_dir_arg else None
+
+    if cache_path and cache_path.joinpath('metadata.json').exists():
+        try:
+            return _load_cached_taxonomy(cache_path)
+        except (OSError, ValueError, KeyError):
+            pass
+
+    arrays, rank_names = _parse_dmp(names_dmp_path_arg, nodes_dmp_path_arg)
+    metadata: dict = {'version': TAXONOMY_CACHE_VERSION, 'key': key, 'rank_names': rank_names}
+    if cache_path:
+        try:
+            _save_cached_taxonomy(cache_path, arrays, metadata)
+            return _load_cached_taxonomy(cache_path)
+        except OSError:
+            pass
+    return NcbiTaxonomy(arrays, metadata)
+def _cache_key(names_dmp_path_arg: Path, nodes_dmp_path_arg: Path) -> str:
+    """
+    Function derives the cache key of a pair of .dmp files from their size, modification time and sampled content.
+
+    Parameters:
+        names_dmp_path_arg (Path): path of names.dmp file
+        nodes_dmp_path_arg (Path): path of nodes.dmp file
+
+    Returns:
+        (str): sha256 hex digest
+    """
+    key_hash = hashlib.sha256(f'ncbi-taxonomy {TAXONOMY_CACHE_VERSION}'.encode())
+    for dmp_path in (names_dmp_path_arg, nodes_dmp_path_arg):
+        dmp_stat = dmp_path.stat()
+        key_hash.update(f'{dmp_stat.st_size} {dmp_stat.st_mtime_ns}'.encode())
+        # the first and last MiB catch re-downloads that kept the size and modification time
+        with open(dmp_path, 'rb') as dmp_file:
+            key_hash.update(dmp_file.read(_HASHED_BYTES))
+            dmp_file.seek(max(0, dmp_stat.st_size - _HASHED_BYTES))
+            key_hash.update(dmp_file.read(_HASHED_BYTES))
+    return key_hash.hexdigest()
+def _parse_dmp(names_dmp_path_arg: Path, nodes_dmp_path_arg: Path) -> tuple:
+    """
+    Function parses nodes.dmp and names.dmp into taxonomy arrays.
+
+    Parameters:
+        names_dmp_path_arg (Path): path of names.dmp file
+        nodes_dmp_path_arg (Path): path of nodes.dmp file
+
+    Returns:
+        (tuple): taxonomy arrays (see _ARRAY_NAMES), rank names indexed by rank code
+    """
+    node_txids: list = []
+    parent_txids: list = []
+    node_ranks: list = []
+    rank_codes: dict = {}
+    with open(nodes_dmp_path_arg, 'r', encoding='utf8') as nodes_dmp_file:
+        for line in nodes_dmp_file:
+            line_args = line.split('\t|\t', 3)
+            node_txids.append(int(line_args[0]))
+            parent_txids.append(int(line_args[1]))
+            node_ranks.append(rank_codes.setdefault(line_args[2].strip(), len(rank_codes)))
+
+    order = np.argsort(np.asarray(node_txids, dtype=np.int64), kind='stable')
+    txids = np.asarray(node_txids, dtype=np.int32)[order]
+    parents = np.searchsorted(txids, np.asarray(parent_txids, dtype=np.int32)[order]).astype(np.int32)
+    ranks = np.asarray(node_ranks, dtype=np.int16)[order]
+    rank_names: list = list(rank_codes)
+
+    # scientific names of every node, and {name: node} of the matchable names of every rank
+    # (the last entry of a name wins, same as building a dict from names.dmp)
+    name_txids: list = []
+    names: list = []
+    is_scientific: list = []
+    with open(names_dmp_path_arg, 'r', encoding='utf8') as names_dmp_file:
+        for line in names_dmp_file:
+            line_args = line.split('\t|\t')
+            name_class = line_args[3].rstrip('\t|\r\n')
+            if name_class in NAME_CLASSES:
+                name_txids.append(int(line_args[0]))
+                names.append(line_args[1].strip())
+                is_scientific.append(name_class == 'scientific name')
+    name_nodes: list = np.searchsorted(txids, np.asarray(name_txids, dtype=np.int32)).tolist()
+    name_ranks: list = ranks[name_nodes].tolist()
+
+    scientific_names: list = [''] * len(txids)
+    rank_lookups: list = [{} for _ in rank_names]
+    for node, rank_code, name, scientific in zip(name_nodes, name_ranks, names, is_scientific):
+        if scientific:
+            scientific_names[node] = name
+        rank_lookups[rank_code][name] = node
+
+    # lookup names keep the names.dmp order (it breaks ties between equally good fuzzy matches),
+    # lookup_order sorts them (as bytes) within every rank for exact lookups
+    lookup_names: list = []
+    lookup_nodes: list = []
+    lookup_order: list = []
+    rank_bounds: list = [0]
+    for rank_lookup in rank_lookups:
+        rank_start = len(lookup_names)
+        rank_encoded: list = [name.encode('utf8') for name in rank_lookup]
+        lookup_order += sorted(range(rank_start, rank_start + len(rank_encoded)), key=lambda index: rank_encoded[index - rank_start])
+        lookup_names += rank_lookup
+        lookup_nodes += rank_lookup.values()
+        rank_bounds.append(len(lookup_names))
+
+    arrays: dict = {'txids': txids, 'parents': parents, 'ranks': ranks, 'depths': _depths(parents)}
+    arrays['name_data'], arrays['name_offsets'] = _string_table(scientific_names)
+    arrays['lookup_data'], arrays['lookup_offsets'] = _string_table(lookup_names)
+    arrays['lookup_nodes'] = np.asarray(lookup_nodes, dtype=np.int32)
+    arrays['lookup_order'] = np.asarray(lookup_order, dtype=np.int32)
+    normalized_hashes = np.fromiter((_name_hash(normalize_name(name)) for name in lookup_names), dtype=np.uint64, count=len(lookup_names))
+    arrays['normalized_order'] = np.argsort(normalized_hashes, kind='stable').astype(np.int32)
+    arrays['normalized_hashes'] = normalized_hashes[arrays['normalized_order']]
+    arrays['rank_bounds'] = np.asarray(rank_bounds, dtype=np.int64)
+    arrays.update(_trigram_index(lookup_names))
+    return arrays, rank_names
+def _depths(parents_arg: np.ndarray) -> np.ndarray:
+    """
+    Function computes the depth of every node below the root, one tree level at a time.
+
+    Parameters:
+        parents_arg (np.ndarray): parent node of every node (the root is its own parent)
+
+    Returns:
+        (np.ndarray): int16 depth of every node (0 for the root)
+    """
+    depths = np.full(len(parents_arg), -1, dtype=np.int16)
+    depths[parents_arg == np.arange(len(parents_arg))] = 0
+    while (unknown := np.flatnonzero(depths < 0)).size:
+        resolved = unknown[depths[parents_arg[unknown]] >= 0]
+        if not resolved.size:
+            raise ValueError(f'nodes.dmp has {unknown.size} nodes that do not lead to the root')
+        depths[resolved] = depths[parents_arg[resolved]] + 1
+    return depths
+def _trigram_index(names_arg: list) -> dict:
+    """
+    Function builds the trigram inverted index of the matchable names.
+
+    Parameters:
+        names_arg (list): matchable names, in lookup order
+
+    Returns:
+        (dict): index arrays
+            lookup_lengths:     int32 length (in characters) of every name
+            trigram_keys:       sorted uint32 trigram hashes
+            trigram_offsets:    int64 offset of the postings of every trigram (n + 1)
+            trigram_names:      int32 names containing each trigram, in order
+            trigram_counts:     uint8 number of times the name contains the trigram (at most 255)
+    """
+    lookup_lengths = np.fromiter((len(name) for name in names_arg), dtype=np.int32, count=len(names_arg))
+    # code points of every name, separated by newlines (names have none)
+    code_points = _code_points('\n'.join(names_arg) + '\n' if names_arg else '')
+    trigrams = _trigram_hashes(code_points)
+    is_trigram = (code_points[:-2] != 10) & (code_points[1:-1] != 10) & (code_points[2:] != 10) if code_points.size >= 3 else np.zeros(0, dtype=bool)
+    trigram_names = np.repeat(np.arange(len(names_arg), dtype=np.uint64), lookup_lengths.astype(np.int64) + 1)[:trigrams.size]
+
+    # (trigram, name) pairs sorted by trigram then name, with how often each occurs
+    pairs, pair_counts = np.unique((trigrams[is_trigram].astype(np.uint64) << np.uint64(32)) | trigram_names[is_trigram], return_counts=True)
+    pair_trigrams = (pairs >> np.uint64(32)).astype(np.uint32)
+    trigram_keys, trigram_starts = np.unique(pair_trigrams, return_index=True)
+    return {
+        'lookup_lengths': lookup_lengths,
+        'trigram_keys': trigram_keys,
+        'trigram_offsets': np.append(trigram_starts, pairs.size).astype(np.int64),
+        'trigram_names': (pairs & np.uint64(0xFFFFFFFF)).astype(np.int32),
+        'trigram_counts': np.minimum(pair_counts, 255).astype(np.uint8)}
+def _code_points(string_arg: str) -> np.ndarray:
+    """ Unicode code points of a string, as a uint32 array. """
+    return np.frombuffer(string_arg.encode('utf-32-le'), dtype=np.uint32)
+def _trigram_hashes(code_points_arg: np.ndarray) -> np.ndarray:
+    """ 32-bit hash of every trigram of a code point array (hash collisions only add candidates). """
+    if code_points_arg.size < 3:
+        return np.zeros(0, dtype=np.uint32)
+    return (code_points_arg[:-2] * np.uint32(0x9E3779B1)) ^ (code_points_arg[1:-1] * np.uint32(0x85EBCA77)) ^ code_points_arg[2:]
+def _string_table(strings_arg: list) -> tuple:
+    """
+    Function packs strings into a string table.
+
+    Parameters:
+        strings_arg (list): strings without newlines
+
+    Returns:
+        (tuple): uint8 array of newline-terminated UTF-8 strings, int64 array of string offsets (n + 1)
+    """
+    encoded: list = [string.encode('utf8') for string in strings_arg]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter((len(string) + 1 for string in encoded), dtype=np.int64, count=len(encoded)), out=offsets[1:])
+    return np.frombuffer(b'\n'.join(encoded) + b'\n' if encoded else b'', dtype=np.uint8), offsets
+def _name_hash(name_arg: str) -> int:
+    """ 64-bit hash of a (normalized) name. """
+    return int.from_bytes(hashlib.blake2b(name_arg.encode('utf8'), digest_size=8).digest(), 'little')
+def _bytes_at(data_arg: np.ndarray, offsets_arg: np.ndarray, index_arg: int) -> bytes:
+    """ One string of a string table, as bytes. """
+    return data_arg[offsets_arg[index_arg]:offsets_arg[index_arg + 1] - 1].tobytes()
+def _string_at(data_arg: np.ndarray, offsets_arg: np.ndarray, index_arg: int) -> str:
+    """ One string of a string table. """
+    return _bytes_at(data_arg, offsets_arg, index_arg).decode('utf8')
+def _save_cached_taxonomy(cache_path_arg: Path, arrays_arg: dict, metadata_arg: dict) -> None:
+    """
+    Function writes taxonomy arrays to a cache directory (atomically, so parallel runs can share it).
+
+    Parameters:
+        cache_path_arg (Path): cache directory of this taxonomy
+        arrays_arg (dict): taxonomy arrays
+        metadata_arg (dict): rank names and cache key
+
+    Returns:
+        None
+    """
+    temp_path = cache_path_arg.parent.joinpath(f'{cache_path_arg.name}.{os.getpid()}.partial')
+    temp_path.mkdir(parents=True, exist_ok=True)
+    for array_name in _ARRAY_NAMES:
+        np.save(temp_path.joinpath(f'{array_name}.npy'), arrays_arg[array_name])
+    # metadata.json is written last, it marks a complete cache
+    with open(temp_path.joinpath('metadata.json'), 'w', encoding='utf8') as metadata_file:
+        json.dump(metadata_arg, metadata_file)
+    try:
+        os.replace(temp_path, cache_path_arg)
+    except OSError:
+        # another run finished the same cache first
+        shutil.rmtree(temp_path, ignore_errors=True)
+        if not cache_path_arg.joinpath('metadata.json').exists():
+            raise
+def _load_cached_taxonomy(cache_path_arg: Path) -> NcbiTaxonomy:
+    """
+    Function memory-maps the taxonomy arrays of a cache directory.
+
+    Parameters:
+        cache_path_arg (Path): cache directory of this taxonomy
+
+    Returns:
+        (NcbiTaxonomy): taxonomy
+    """
+    with open(cache_path_arg.joinpath('metadata.json'), 'r', encoding='utf8') as metadata_file:
+        metadata: dict = json.load(metadata_file)
+    if metadata.get('version') != TAXONOMY_CACHE_VERSION:
+        raise ValueError(f'{cache_path_arg} is a version {metadata.get("version")} taxonomy cache')
+    arrays: dict = {
+        array_name: np.load(cache_path_arg.joinpath(f'{array_name}.npy'), mmap_mode='r', allow_pickle=False)
+        for array_name in _ARRAY_NAMES}
+    return NcbiTaxonomy(arrays, metadata)
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Purpose: Compare the reads of two sets of .fastq(.gz) files by 64-bit hashes of their ids (and sequences).
+
+Every read is reduced to a fixed-size record (id hash, sequence hash, region), so comparing two read sets is
+a sort and an intersection of NumPy arrays instead of a search through lists of ids. Reads present on both
+sides are also checked for being assigned to different regions and, optionally, for differing sequences
+(ex: trimmed differently). With a memory limit, records are first partitioned by hash prefix into bucket
+files on disk and compared one bucket at a time (buckets that are still too big are split again).
+
+Hash collisions between different ids are possible but negligible (about n^2 / 2^65 for n reads).
+"""
+__author__ = "Erick Samera"
+__version__ = "1.1.1"
+__comment__ = 'stable'
+
+# --------------------------------------------------
+from pathlib import Path
+import tempfile
+# --------------------------------------------------
+import numpy as np
+from fastq_reader import read_fastq_batches
+# --------------------------------------------------
+RECORD_DTYPE: np.dtype = np.dtype([('id', '<u8'), ('sequence', '<u8'), ('region', '<i2')])
+# bits of the id hash used per level of bucket partitioning (external-memory mode)
+BUCKET_BITS: int = 8
+# --------------------------------------------------
+def hash_rows(rows_arg: np.ndarray, lengths_arg: np.ndarray) -> np.ndarray:
+    """
+    Function hashes every row of a zero-padded uint8 array (ex: ids or sequences from fastq_reader).
+
+    Parameters:
+        rows_arg (np.ndarray): (n x width) zero-padded uint8 array
+        lengths_arg (np.ndarray): length of every row
+
+    Returns:
+        (np.ndarray): uint64 hash of every row
+    """
+    n_rows, width = rows_arg.shape
+    padded_width = -(-width // 8) * 8
+    rows = np.pad(rows_arg, ((0, 0), (0, padded_width - width))) if padded_width != width else np.ascontiguousarray(rows_arg)
+    # the rows are hashed 8 bytes at a time, seeded with their length so padding cannot collide
+    words = rows.view('<u8')
+    hashes = _mix64(np.asarray(lengths_arg, dtype=np.uint64) + np.uint64(0x9E3779B97F4A7C15))
+    for column in range(words.shape[1]):
+        hashes = _mix64(hashes ^ words[:, column])
+    return hashes
+def hash_fastq(fastq_path_arg: Path, region_code_arg: int = 0, sequences_arg: bool = False) -> np.ndarray:
+    """
+    Function yields the hashed reads of a .fastq(.gz) file, one array per batch.
+
+    Parameters:
+        fastq_path_arg (Path): path of the .fastq(.gz) file
+        region_code_arg (int): region code stored with every read
+        sequences_arg (bool): also hash the sequences (otherwise the sequence hash is 0)
+
+    Returns:
+        (np.ndarray): RECORD_DTYPE records of the batch
+    """
+    for batch in read_fastq_batches(fastq_path_arg):
+        records = np.zeros(len(batch), dtype=RECORD_DTYPE)
+        records['id'] = hash_rows(*batch.ids())
+        if sequences_arg:
+            records['sequence'] = hash_rows(*batch.sequences())
+        records['region'] = region_code_arg
+        yield records
+def compare_read_sets(left_files_arg: dict, right_files_arg: dict, sequences_arg: bool = False, memory_limit_arg: int = None, temp_dir_arg: Path = None) -> dict:
+    """
+    Function compares the reads of two sets of .fastq(.gz) files.
+
+    Parameters:
+        left_files_arg (dict): {region: [paths]} of the first read set
+        right_files_arg (dict): {region: [paths]} of the second read set
+        sequences_arg (bool): also compare the sequences of reads found on both sides
+        memory_limit_arg (int): approximate memory limit in bytes, partitions the reads on disk (default: in memory)
+        temp_dir_arg (Path): directory for the bucket files of the external-memory mode (default: system temp)
+
+    Returns:
+        (dict): comparison
+            left_reads, right_reads:    number of reads on each side
+            shared:                     reads (ids) found on both sides
+            left_only, right_only:      reads found on one side only
+            different_region:           shared reads assigned to different regions
+            different_sequence:         shared reads with different sequences (if sequences_arg)
+            region_pairs:               {(left region, right region): reads} of the reads in different regions
+            concordance:                1 - one-sided reads / all reads
+            regions:                    {region: counts of the reads of that region}
+                left_reads, right_reads:    reads of the region on each side
+                left_only, right_only:      reads of the region found on one side only
+                different_region:           reads of the region found in another region on the other side
+                concordance:                1 - reads not in the region on the other side / reads of the region
+    """
+    regions: list = sorted(set(left_files_arg) | set(right_files_arg))
+    sides: list = [
+        [(fastq_path, regions.index(region)) for region, fastq_paths in files.items() for fastq_path in fastq_paths]
+        for files in (left_files_arg, right_files_arg)]
+
+    if memory_limit_arg is None:
+        left_records, right_records = (
+            np.concatenate([records for fastq_path, region_code in side for records in hash_fastq(fastq_path, region_code, sequences_arg)] or [np.zeros(0, dtype=RECORD_DTYPE)])
+            for side in sides)
+        counts = _compare_records(left_records, right_records, len(regions))
+    else:
+        with tempfile.TemporaryDirectory(dir=temp_dir_arg) as temp_dir:
+            bucket_paths: list = []
+            for side_name, side in zip(('left', 'right'), sides):
+                records = (records for fastq_path, region_code in side for records in hash_fastq(fastq_path, region_code, sequences_arg))
+                bucket_paths.append(_partition(records, Path(temp_dir), side_name, 0, memory_limit_arg))
+            counts = _new_counts(len(regions))
+            for left_path, right_path in zip(*bucket_paths):
+                _add_counts(counts, _compare_buckets(left_path, right_path, 1, memory_limit_arg, len(regions)))
+
+    region_pairs = counts.pop('region_pairs').reshape(len(regions), len(regions))
+    counts['region_pairs'] = {
+        (regions[left_code], regions[right_code]): int(region_pairs[left_code, right_code])
+        for left_code, right_code in zip(*np.nonzero(region_pairs))}
+    region_counts: dict = {key: counts.pop(f'region_{key}') for key in ('left_reads', 'right_reads', 'left_only', 'right_only')}
+    counts['regions'] = {}
+    for region_code, region in enumerate(regions):
+        region_stats: dict = {key: int(values[region_code]) for key, values in region_counts.items()}
+        # region_pairs only holds reads in different regions, its diagonal is 0
+        region_stats['different_region'] = int(region_pairs[region_code].sum() + region_pairs[:, region_code].sum())
+        region_reads = region_stats['left_reads'] + region_stats['right_reads']
+        one_sided = region_stats['left_only'] + region_stats['right_only'] + region_stats['different_region']
+        region_stats['concordance'] = 1 - one_sided / region_reads if region_reads else 1.0
+        counts['regions'][region] = region_stats
+    all_reads = counts['left_reads'] + counts['right_reads']
+    counts['concordance'] = 1 - (counts['left_only'] + counts['right_only']) / all_reads if all_reads else 1.0
+    return counts
+# --------------------------------------------------
+def _mix64(values_arg: np.ndarray) -> np.ndarray:
+    """ splitmix64 finalizer, spreads every input bit over the whole (uint64) output. """
+    values = (values_arg ^ (values_arg >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+def _new_counts(n_regions_arg: int) -> dict:
+    """ Empty comparison counts. """
+    return {
+        'left_reads': 0, 'right_reads': 0, 'shared': 0, 'left_only': 0, 'right_only': 0,
+        'different_region': 0, 'different_sequence': 0,
+        'region_pairs': np.zeros(n_regions_arg * n_regions_arg, dtype=np.int64),
+        'region_left_reads': np.zeros(n_regions_arg, dtype=np.int64), 'region_right_reads': np.zeros(n_regions_arg, dtype=np.int64),
+        'region_left_only': np.zeros(n_regions_arg, dtype=np.int64), 'region_right_only': np.zeros(n_regions_arg, dtype=np.int64)}
+def _add_counts(counts_arg: dict, other_counts_arg: dict) -> None:
+    """ Add the comparison counts of one bucket to the totals. """
+    for key, value in other_counts_arg.items():
+        counts_arg[key] += value
+def _compare_records(left_records_arg: np.ndarray, right_records_arg: np.ndarray, n_regions_arg: int) -> dict:
+    """
+    Function compares two arrays of hashed reads in memory.
+
+    Parameters:
+        left_records_arg (np.ndarray): RECORD_DTYPE records of the first read set
+        right_records_arg (np.ndarray): RECORD_DTYPE records of the second read set
+        n_regions_arg (int): number of region codes
+
+    Returns:
+        (dict): comparison counts, see compare_read_sets()
+    """
+    counts = _new_counts(n_regions_arg)
+    counts['left_reads'], counts['right_reads'] = len(left_records_arg), len(right_records_arg)
+    left_only = ~np.isin(left_records_arg['id'], right_records_arg['id'])
+    right_only = ~np.isin(right_records_arg['id'], left_records_arg['id'])
+    counts['left_only'], counts['right_only'] = int(left_only.sum()), int(right_only.sum())
+    for side, records, one_sided in (('left', left_records_arg, left_only), ('right', right_records_arg, right_only)):
+        region_codes = records['region'].astype(np.int64)
+        counts[f'region_{side}_reads'] = np.bincount(region_codes, minlength=n_regions_arg)
+        counts[f'region_{side}_only'] = np.bincount(region_codes[one_sided], minlength=n_regions_arg)
+
+    shared_ids, left_indexes, right_indexes = np.intersect1d(left_records_arg['id'], right_records_arg['id'], return_indices=True)
+    left_shared, right_shared = left_records_arg[left_indexes], right_records_arg[right_indexes]
+    different_region = left_shared['region'] != right_shared['region']
+    counts['shared'] = len(shared_ids)
+    counts['different_region'] = int(different_region.sum())
+    counts['different_sequence'] = int((left_shared['sequence'] != right_shared['sequence']).sum())
+    counts['region_pairs'] = np.bincount(
+        left_shared['region'][different_region].astype(np.int64) * n_regions_arg + right_shared['region'][different_region],
+        minlength=n_regions_arg * n_regions_arg)
+    return counts
+def _partition(record_batches_arg, directory_arg: Path, name_arg: str, level_arg: int, memory_limit_arg: int) -> list:
+    """
+    Function writes hashed reads to bucket files by the id hash bits of one partitioning level.
+
+    Parameters:
+        record_batches_arg: iterable of RECORD_DTYPE arrays
+        directory_arg (Path): directory of the bucket files
+        name_arg (str): prefix of the bucket file names
+        level_arg (int): partitioning level, selects the hash bits
+        memory_limit_arg (int): approximate memory limit in bytes, bounds the write buffer
+
+    Returns:
+        (list): paths of the 2^BUCKET_BITS bucket files (some may be empty)
+    """
+    n_buckets = 1 << BUCKET_BITS
+    shift = np.uint64(64 - BUCKET_BITS * (level_arg + 1))
+    bucket_paths: list = [directory_arg.joinpath(f'{name_arg}_{bucket:03d}.bin') for bucket in range(n_buckets)]
+    for bucket_path in bucket_paths:
+        bucket_path.touch()
+
+    buffered: list = []
+    buffered_bytes: int = 0
+    def _flush() -> None:
+        records = np.concatenate(buffered)
+        buckets = ((records['id'] >> shift) & np.uint64(n_buckets - 1)).astype(np.int64)
+        order = np.argsort(buckets, kind='stable')
+        bounds = np.searchsorted(buckets[order], np.arange(n_buckets + 1))
+        for bucket, bucket_path in enumerate(bucket_paths):
+            if bounds[bucket + 1] > bounds[bucket]:
+                with open(bucket_path, 'ab') as bucket_file:
+                    records[order[bounds[bucket]:bounds[bucket + 1]]].tofile(bucket_file)
+        buffered.clear()
+
+    for records in record_batches_arg:
+        buffered.append(records)
+        buffered_bytes += records.nbytes
+        # the flush needs about three times the buffer (concatenated copy and sorted copy)
+        if buffered_bytes * 4 >= memory_limit_arg:
+            _flush()
+            buffered_bytes = 0
+    if buffered:
+        _flush()
+    return bucket_paths
+def _compare_buckets(left_path_arg: Path, right_path_arg: Path, level_arg: int, memory_limit_arg: int, n_regions_arg: int) -> dict:
+    """
+    Function compares a pair of bucket files, splitting them further if they do not fit the memory limit.
+
+    Parameters:
+        left_path_arg (Path): bucket file of the first read set
+        right_path_arg (Path): matching bucket file of the second read set
+        level_arg (int): partitioning level of a further split
+        memory_limit_arg (int): approximate memory limit in bytes
+        n_regions_arg (int): number of region codes
+
+    Returns:
+        (dict): comparison counts, see compare_read_sets()
+    """
+    bucket_bytes = left_path_arg.stat().st_size + right_path_arg.stat().st_size
+    # comparing needs about four times the records (sorted copies and masks), every hash bit is used by the last level
+    if bucket_bytes * 4 <= memory_limit_arg or BUCKET_BITS * (level_arg + 1) > 64:
+        counts = _compare_records(np.fromfile(left_path_arg, dtype=RECORD_DTYPE), np.fromfile(right_path_arg, dtype=RECORD_DTYPE), n_regions_arg)
+    else:
+        sub_directory = left_path_arg.parent.joinpath(f'{left_path_arg.stem}_{level_arg}')
+        sub_directory.mkdir()
+        sub_paths: list = [
+            _partition(_read_bucket(bucket_path, memory_limit_arg), sub_directory, side_name, level_arg, memory_limit_arg)
+            for side_name, bucket_path in (('left', left_path_arg), ('right', right_path_arg))]
+        counts = _new_counts(n_regions_arg)
+        for left_path, right_path in zip(*sub_paths):
+            _add_counts(counts, _compare_buckets(left_path, right_path, level_arg + 1, memory_limit_arg, n_regions_arg))
+    left_path_arg.unlink()
+    right_path_arg.unlink()
+    return counts
+def _read_bucket(bucket_path_arg: Path, memory_limit_arg: int) -> np.ndarray:
+    """ Yield the records of a bucket file in chunks that fit the memory limit. """
+    chunk_records = max(1, memory_limit_arg // (8 * RECORD_DTYPE.itemsize))
+    n_records = bucket_path_arg.stat().st_size // RECORD_DTYPE.itemsize
+    for first_record in range(0, n_records, chunk_records):
+        yield np.fromfile(bucket_path_arg, dtype=RECORD_DTYPE, count=min(chunk_records, n_records - first_record), offset=first_record * RECORD_DTYPE.itemsize)
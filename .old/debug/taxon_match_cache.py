@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Purpose: On-disk (SQLite) cache of taxon string matches, shared by runs of fuzzy_collapse_otu.py.
+
+Every entry is the best match of a cleaned taxon string against a set of NCBI ranks with a given scorer,
+among the names that can reach a minimum score (the match threshold with the trigram candidate index, 0 for
+brute force), for one NCBI taxonomy (the cache key of ncbi_taxonomy.load_taxonomy()). Entries of any other
+taxonomy are dropped when the cache is opened, so updating the .dmp files invalidates the cache.
+
+The cache holds at most max_entries matches, the least recently used ones are evicted first.
+"""
+__author__ = "Erick Samera"
+__version__ = "1.1.0"
+__comment__ = 'stable'
+
+# --------------------------------------------------
+from pathlib import Path
+# --------------------------------------------------
+import sqlite3
+import time
+# --------------------------------------------------
+from ncbi_taxonomy import DEFAULT_CACHE_DIR
+# --------------------------------------------------
+# bump when the table layout changes, older caches are cleared
+MATCH_CACHE_VERSION: int = 2
+DEFAULT_MATCH_CACHE_PATH: Path = DEFAULT_CACHE_DIR.parent.joinpath('taxon-matches.sqlite')
+DEFAULT_MAX_ENTRIES: int = 1_000_000
+# --------------------------------------------------
+class TaxonMatchCache:
+    """
+    Best matches of taxon strings, keyed by (taxon string, ranks, scorer, minimum score) for one NCBI taxonomy.
+
+    Parameters:
+        path_arg (Path): path of the SQLite database
+        taxonomy_key_arg (str): cache key of the NCBI taxonomy (NcbiTaxonomy.key)
+        max_entries_arg (int): number of matches kept
+    """
+    def __init__(self, path_arg: Path, taxonomy_key_arg: str, max_entries_arg: int = DEFAULT_MAX_ENTRIES) -> None:
+        path_arg.parent.mkdir(parents=True, exist_ok=True)
+        self.taxonomy_key = taxonomy_key_arg
+        self.max_entries = max_entries_arg
+        self._connection = sqlite3.connect(path_arg, timeout=60)
+        with self._connection:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            if self._connection.execute('PRAGMA user_version').fetchone()[0] != MATCH_CACHE_VERSION:
+                self._connection.execute('DROP TABLE IF EXISTS matches')
+                self._connection.execute(f'PRAGMA user_version={MATCH_CACHE_VERSION}')
+            self._connection.execute('''
+                CREATE TABLE IF NOT EXISTS matches (
+                    query TEXT NOT NULL,
+                    ranks TEXT NOT NULL,
+                    scorer TEXT NOT NULL,
+                    min_score INTEGER NOT NULL,
+                    taxonomy_key TEXT NOT NULL,
+                    txid INTEGER,
+                    name TEXT,
+                    score REAL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (query, ranks, scorer, min_score, taxonomy_key))''')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS matches_last_used ON matches (last_used)')
+            self._connection.execute('DELETE FROM matches WHERE taxonomy_key != ?', (self.taxonomy_key,))
+    def __len__(self) -> int:
+        return self._connection.execute('SELECT COUNT(*) FROM matches').fetchone()[0]
+    def get(self, queries_arg: list, scorer_arg: str, min_score_arg: int) -> dict:
+        """
+        Function looks up the cached best matches of taxon strings.
+
+        Parameters:
+            queries_arg (list): (taxon string, ranks) queries
+            scorer_arg (str): name of the scorer
+            min_score_arg (int): minimum score the matches were searched down to
+
+        Returns:
+            (dict): best match of every cached query ({'score', 'txid', 'name'}, or None if there was none)
+        """
+        cached_matches: dict = {}
+        for query in queries_arg:
+            row = self._connection.execute(
+                'SELECT txid, name, score FROM matches WHERE query = ? AND ranks = ? AND scorer = ? AND min_score = ? AND taxonomy_key = ?',
+                (query[0], ','.join(query[1]), scorer_arg, min_score_arg, self.taxonomy_key)).fetchone()
+            if row:
+                cached_matches[query] = {'score': row[2], 'txid': row[0], 'name': row[1]} if row[0] is not None else None
+        if cached_matches:
+            now = time.time()
+            with self._connection:
+                self._connection.executemany(
+                    'UPDATE matches SET last_used = ? WHERE query = ? AND ranks = ? AND scorer = ? AND min_score = ? AND taxonomy_key = ?',
+                    [(now, query[0], ','.join(query[1]), scorer_arg, min_score_arg, self.taxonomy_key) for query in cached_matches])
+        return cached_matches
+    def put(self, matches_arg: dict, scorer_arg: str, min_score_arg: int) -> None:
+        """
+        Function stores best matches of taxon strings and evicts the least recently used ones over max_entries.
+
+        Parameters:
+            matches_arg (dict): best match of every (taxon string, ranks) query (None if there was none)
+            scorer_arg (str): name of the scorer
+            min_score_arg (int): minimum score the matches were searched down to
+
+        Returns:
+            None
+        """
+        if not matches_arg:
+            return None
+        now = time.time()
+        with self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO matches VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(query[0], ','.join(query[1]), scorer_arg, min_score_arg, self.taxonomy_key,
+                  match['txid'] if match else None, match['name'] if match else None, match['score'] if match else None, now)
+                 for query, match in matches_arg.items()])
+            excess_entries = len(self) - self.max_entries
+            if excess_entries > 0:
+                self._connection.execute(
+                    'DELETE FROM matches WHERE rowid IN (SELECT rowid FROM matches ORDER BY last_used LIMIT ?)',
+                    (excess_entries,))
+        return None
+    def close(self) -> None:
+        self._connection.close()
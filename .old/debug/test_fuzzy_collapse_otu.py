@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Purpose: Regression tests for fuzzy_collapse_otu.py (run with pytest).
+"""
+__author__ = "Erick Samera"
+__version__ = "1.0.0"
+__comment__ = 'stable'
+
+# --------------------------------------------------
+from argparse import Namespace
+from pathlib import Path
+# --------------------------------------------------
+from ncbi_taxonomy import (
+    NcbiTaxonomy,
+    load_taxonomy)
+from taxon_match_cache import TaxonMatchCache
+from fuzzy_collapse_otu import _match_otus
+# --------------------------------------------------
+# taxon string that shares no trigram with 'Escherichia' (so the index has no candidates for it)
+NO_TRIGRAM_QUERY: str = 'Eshcerihcia'
+# --------------------------------------------------
+def _taxonomy(tmp_path: Path) -> NcbiTaxonomy:
+    """ Return a taxonomy of one genus under Bacteria. """
+    (tmp_path / 'names.dmp').write_text(
+        '1\t|\troot\t|\t\t|\tscientific name\t|\n'
+        '2\t|\tBacteria\t|\t\t|\tscientific name\t|\n'
+        '561\t|\tEscherichia\t|\t\t|\tscientific name\t|\n', encoding='utf8')
+    (tmp_path / 'nodes.dmp').write_text(
+        '1\t|\t1\t|\tno rank\t|\t\t|\n'
+        '2\t|\t1\t|\tsuperkingdom\t|\t\t|\n'
+        '561\t|\t2\t|\tgenus\t|\t\t|\n', encoding='utf8')
+    return load_taxonomy(tmp_path / 'names.dmp', tmp_path / 'nodes.dmp', None)
+def _args(output_mismatches_path_arg: Path) -> Namespace:
+    """ Return matching arguments with the trigram candidate index. """
+    return Namespace(
+        match_db='taxonomy', match_threshold=99, scorer='partial_ratio', workers=1,
+        candidate_index=True, check_recall=False, output_mismatches_path=output_mismatches_path_arg)
+# --------------------------------------------------
+def test_mismatch_without_candidates(tmp_path: Path) -> None:
+    """ A taxon string without trigram index candidates is still reported with its closest name """
+    taxonomy = _taxonomy(tmp_path)
+    assert taxonomy.candidates(NO_TRIGRAM_QUERY, 'genus', 99, True).size == 0
+    otu_matches, mismatches = _match_otus(_args(tmp_path / 'mismatches.tsv'), taxonomy, None, [[(NO_TRIGRAM_QUERY, 5)]])
+    assert otu_matches == [False]
+    taxon_str, taxon_level, name, txid, score = mismatches[0].rstrip('\n').split('\t')
+    assert (taxon_str, taxon_level, name, txid) == (NO_TRIGRAM_QUERY, '5', 'Escherichia', '561')
+    assert 0 < float(score) < 99
+def test_mismatch_without_candidates_cached(tmp_path: Path) -> None:
+    """ A cached taxon string without a match (from a run without --output-mismatches) gets its closest name """
+    taxonomy = _taxonomy(tmp_path)
+    match_cache = TaxonMatchCache(tmp_path / 'matches.sqlite', taxonomy.key)
+    _, mismatches = _match_otus(_args(None), taxonomy, match_cache, [[(NO_TRIGRAM_QUERY, 5)]])
+    assert mismatches == [f'{NO_TRIGRAM_QUERY}\t5\tN/A\tN/A\t0\n']
+    _, mismatches = _match_otus(_args(tmp_path / 'mismatches.tsv'), taxonomy, match_cache, [[(NO_TRIGRAM_QUERY, 5)]])
+    assert mismatches[0].split('\t')[2] == 'Escherichia'
+    match_cache.close()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Purpose: Benchmark the compiled IUPAC primer matcher against cutadapt on synthetic reads.
+"""
+__author__ = "Erick Samera"
+__version__ = "1.0.0"
+__comment__ = 'stable'
+
+# --------------------------------------------------
+from argparse import (
+    Namespace,
+    ArgumentParser,
+    ArgumentDefaultsHelpFormatter)
+from pathlib import Path
+# --------------------------------------------------
+import subprocess
+import tempfile
+import random
+import time
+# --------------------------------------------------
+from iupac_matcher import (
+    IUPAC_CODES,
+    compile_primer,
+    encode_reads,
+    find_primer_ends)
+# --------------------------------------------------
+def get_args() -> Namespace:
+    """ Get command-line arguments """
+
+    parser = ArgumentParser(
+        description="Benchmark the compiled IUPAC primer matcher against cutadapt on synthetic reads.",
+        epilog=f"v{__version__} : {__author__} | {__comment__}",
+        formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '-p',
+        '--primer',
+        dest='primer',
+        metavar='SEQ',
+        type=str,
+        default='GTGYCAGCMGCCGCGGTAA',
+        help="(degenerate) primer to search for")
+    parser.add_argument(
+        '-n',
+        '--reads',
+        dest='n_reads',
+        metavar='INT',
+        type=int,
+        default=200000,
+        help="number of synthetic reads")
+    parser.add_argument(
+        '-l',
+        '--length',
+        dest='read_length',
+        metavar='INT',
+        type=int,
+        default=150,
+        help="length of synthetic reads")
+    parser.add_argument(
+        '--primed-fraction',
+        dest='primed_fraction',
+        metavar='FLOAT',
+        type=float,
+        default=0.8,
+        help="fraction of reads that start with the primer")
+    parser.add_argument(
+        '--error-fraction',
+        dest='error_fraction',
+        metavar='FLOAT',
+        type=float,
+        default=0.1,
+        help="fraction of primed reads with a substitution or indel in the primer")
+    parser.add_argument(
+        '--seed',
+        dest='seed',
+        metavar='INT',
+        type=int,
+        default=1,
+        help="random seed")
+
+    args = parser.parse_args()
+
+    return args
+# --------------------------------------------------
+def _simulate_reads(args: Namespace) -> list:
+    """
+    Function simulates reads that start with a random instance of the primer (some with errors).
+
+    Parameters:
+        args (Namespace): benchmark arguments
+
+    Returns:
+        (list): read sequences (bytes)
+    """
+    rng = random.Random(args.seed)
+    reads: list = []
+    for _ in range(args.n_reads):
+        if rng.random() < args.primed_fraction:
+            primer = [rng.choice(IUPAC_CODES[base]) for base in args.primer]
+            if rng.random() < args.error_fraction:
+                position = rng.randrange(len(primer))
+                error_type = rng.choice(('substitution', 'insertion', 'deletion'))
+                if error_type == 'substitution':
+                    primer[position] = rng.choice('ACGT')
+                elif error_type == 'insertion':
+                    primer.insert(position, rng.choice('ACGT'))
+                else:
+                    del primer[position]
+            prefix = ''.join(rng.choice('ACGT') for _ in range(rng.randint(0, 3)))
+            seq = prefix + ''.join(primer)
+        else:
+            seq = ''
+        seq += ''.join(rng.choice('ACGT') for _ in range(args.read_length - len(seq)))
+        reads.append(seq.encode())
+    return reads
+def _run_cutadapt(args: Namespace, reads_arg: list) -> tuple:
+    """
+    Function trims the reads with cutadapt the way demultiplex_phased.py used to.
+
+    Parameters:
+        args (Namespace): benchmark arguments
+        reads_arg (list): read sequences (bytes)
+
+    Returns:
+        (tuple): run time (s), list of trimmed read lengths (-1 if untrimmed)
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        input_path = Path(temp_dir).joinpath('reads.fastq')
+        output_path = Path(temp_dir).joinpath('trimmed.fastq')
+        with open(input_path, 'wb') as input_file:
+            for index, seq in enumerate(reads_arg):
+                input_file.write(b'@%d\n%s\n+\n%s\n' % (index, seq, b'I' * len(seq)))
+
+        start_time = time.time()
+        subprocess.run([
+            'cutadapt', '-j', '1', '--quiet',
+            '--match-read-wildcards',
+            '-g', args.primer,
+            '--untrimmed-output', '/dev/null',
+            '-o', str(output_path), str(input_path)], check=True)
+        run_time = time.time() - start_time
+
+        trimmed_lengths: list = [-1] * len(reads_arg)
+        with open(output_path, 'rb') as output_file:
+            lines = output_file.read().split(b'\n')
+            for line_index in range(0, len(lines) - 1, 4):
+                trimmed_lengths[int(lines[line_index][1:])] = len(lines[line_index + 1])
+    return run_time, trimmed_lengths
+# --------------------------------------------------
+def main() -> None:
+    """ Benchmark the matcher and report the agreement with cutadapt """
+
+    args = get_args()
+    reads = _simulate_reads(args)
+    primer = compile_primer(args.primer)
+
+    start_time = time.time()
+    encoded_reads, read_lengths = encode_reads(reads)
+    primer_ends, _ = find_primer_ends(primer, encoded_reads, read_lengths)
+    matcher_time = time.time() - start_time
+    matcher_lengths = [len(seq) - end if end >= 0 else -1 for seq, end in zip(reads, primer_ends.tolist())]
+
+    try:
+        cutadapt_time, cutadapt_lengths = _run_cutadapt(args, reads)
+    except FileNotFoundError:
+        print_runtime('cutadapt is not installed, only the matcher was timed.')
+        cutadapt_time, cutadapt_lengths = None, None
+
+    print_runtime(f'Matcher:  {args.n_reads} reads in {round(matcher_time, 3)} s. ({round(args.n_reads / matcher_time)} reads/s), {sum(length >= 0 for length in matcher_lengths)} matched')
+    if cutadapt_lengths:
+        both_matched = sum(1 for a, b in zip(matcher_lengths, cutadapt_lengths) if a >= 0 and b >= 0)
+        same_trim = sum(1 for a, b in zip(matcher_lengths, cutadapt_lengths) if a == b)
+        print_runtime(f'cutadapt: {args.n_reads} reads in {round(cutadapt_time, 3)} s. ({round(args.n_reads / cutadapt_time)} reads/s), {sum(length >= 0 for length in cutadapt_lengths)} matched')
+        print_runtime(f'Agreement: {both_matched} matched by both, {same_trim}/{args.n_reads} ({round(100 * same_trim / args.n_reads, 2)} %) with identical trimming')
+def print_runtime(action) -> None:
+    """ Return the time and some defined action. """
+    print(f'[{time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())}] {action}')
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Purpose: Benchmark the neighbor joining engine against skbio.tree.nj() on synthetic AMR gene profiles.
+"""
+__author__ = "Erick Samera"
+__version__ = "1.0.0"
+__comment__ = 'stable'
+
+# --------------------------------------------------
+from argparse import (
+    Namespace,
+    ArgumentParser,
+    ArgumentDefaultsHelpFormatter)
+# --------------------------------------------------
+import time
+import warnings
+# --------------------------------------------------
+import numpy as np
+from scipy.spatial.distance import pdist
+# --------------------------------------------------
+from neighbor_joining import neighbor_joining
+# --------------------------------------------------
+def get_args() -> Namespace:
+    """ Get command-line arguments """
+
+    parser = ArgumentParser(
+        description="Benchmark the neighbor joining engine against skbio.tree.nj() on synthetic AMR gene profiles.",
+        epilog=f"v{__version__} : {__author__} | {__comment__}",
+        formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '-n',
+        '--samples',
+        dest='n_samples',
+        metavar='INT',
+        type=int,
+        nargs='+',
+        default=[1000, 5000, 10000],
+        help="numbers of synthetic isolates")
+    parser.add_argument(
+        '-g',
+        '--genes',
+        dest='n_genes',
+        metavar='INT',
+        type=int,
+        default=300,
+        help="number of AMR genes")
+    parser.add_argument(
+        '--mutation-rate',
+        dest='mutation_rate',
+        metavar='FLOAT',
+        type=float,
+        default=0.01,
+        help="probability that an isolate gains/loses a gene of the isolate it descends from")
+    parser.add_argument(
+        '--skbio-max',
+        dest='skbio_max',
+        metavar='INT',
+        type=int,
+        default=5000,
+        help="largest number of isolates to also run skbio on (its run time grows with the cube)")
+    parser.add_argument(
+        '--seed',
+        dest='seed',
+        metavar='INT',
+        type=int,
+        default=1,
+        help="random seed")
+
+    args = parser.parse_args()
+
+    return args
+# --------------------------------------------------
+def _simulate_profiles(args: Namespace, n_samples_arg: int) -> np.ndarray:
+    """
+    Function simulates AMR gene profiles of isolates, every isolate descending from an earlier one with a few
+    genes gained or lost (so there are clades and identical profiles, like real collections).
+
+    Parameters:
+        args (Namespace): benchmark arguments
+        n_samples_arg (int): number of isolates
+
+    Returns:
+        (np.ndarray): isolates x genes presence/absence matrix
+    """
+    rng = np.random.default_rng(args.seed)
+    profiles = np.empty((n_samples_arg, args.n_genes), dtype=bool)
+    profiles[0] = rng.random(args.n_genes) < 0.3
+    parents = rng.integers(0, np.arange(1, n_samples_arg))
+    for sample, parent in enumerate(parents.tolist(), start=1):
+        profiles[sample] = profiles[parent] ^ (rng.random(args.n_genes) < args.mutation_rate)
+    return profiles
+def _run_skbio(distances_arg: np.ndarray, ids_arg: list) -> tuple:
+    """
+    Function builds the tree with skbio.tree.nj().
+
+    Parameters:
+        distances_arg (np.ndarray): condensed distance matrix
+        ids_arg (list): isolate names
+
+    Returns:
+        (tuple): run time (s), tree in Newick format
+    """
+    from skbio import DistanceMatrix
+    from skbio.tree import nj
+
+    start_time = time.time()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', DeprecationWarning)
+        newick_tree = str(nj(DistanceMatrix(distances_arg, ids_arg)))
+    return time.time() - start_time, newick_tree
+# --------------------------------------------------
+def main() -> None:
+    """ Time both engines on every collection size and compare the trees """
+
+    args = get_args()
+    for n_samples in args.n_samples:
+        distances = pdist(_simulate_profiles(args, n_samples), 'cityblock')
+        ids = [f'isolate_{sample}' for sample in range(n_samples)]
+
+        start_time = time.time()
+        newick_tree = neighbor_joining(distances, ids)
+        engine_time = time.time() - start_time
+        print_runtime(f'Engine: {n_samples} isolates in {round(engine_time, 2)} s.')
+
+        if n_samples > args.skbio_max:
+            continue
+        try:
+            skbio_time, skbio_tree = _run_skbio(distances, ids)
+        except ImportError:
+            print_runtime('scikit-bio is not installed, only the engine was timed.')
+            continue
+        print_runtime(f'skbio:  {n_samples} isolates in {round(skbio_time, 2)} s. ({round(skbio_time / engine_time, 2)}x), {"identical" if newick_tree == skbio_tree else "DIFFERENT"} tree')
+def print_runtime(action) -> None:
+    """ Return the time and some defined action. """
+    print(f'[{time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())}] {action}')
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Purpose: Multithreaded block-gzip (BGZF) writer shared by the tools that write .fastq.gz files.
+
+Output is cut into independent blocks of at most 64 KiB, each compressed on a thread pool (zlib releases
+the GIL) and written in order as its own gzip member with the BGZF extra field. Any gzip reader (QIIME,
+cutadapt, gzip -d, Python's gzip) reads it as normal multi-member gzip; htslib tools can also seek in it.
+"""
+__author__ = "Erick Samera"
+__version__ = "1.0.0"
+__comment__ = 'stable'
+
+# --------------------------------------------------
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from pathlib import Path
+import struct
+import zlib
+# --------------------------------------------------
+# uncompressed bytes per block, small enough that a deflated block always fits the 64 KiB BGZF limit
+BLOCK_SIZE: int = 65280
+DEFAULT_COMPRESSION_LEVEL: int = 1
+# empty block that marks the end of a BGZF file
+BGZF_EOF: bytes = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+# --------------------------------------------------
+def compress_block(data_arg: bytes, compresslevel_arg: int = DEFAULT_COMPRESSION_LEVEL) -> bytes:
+    """
+    Function compresses up to BLOCK_SIZE bytes into a single BGZF block.
+
+    Parameters:
+        data_arg (bytes): uncompressed data
+        compresslevel_arg (int): zlib compression level, 0..9
+
+    Returns:
+        (bytes): gzip member with the BGZF extra field
+    """
+    compressor = zlib.compressobj(compresslevel_arg, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data_arg) + compressor.flush()
+    # 18 byte header with the BC extra subfield holding the total block size - 1, 8 byte footer
+    header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(deflated) + 25)
+    return header + deflated + struct.pack('<2I', zlib.crc32(data_arg), len(data_arg))
+class BgzfWriter:
+    """
+    Binary file-like writer of BGZF (.gz) files that compresses blocks on a thread pool.
+
+    Parameters:
+        path_arg (Path): path of the output file
+        compresslevel_arg (int): zlib compression level, 0..9 (lower is faster, higher is smaller)
+        threads_arg (int): number of compression threads, used if no executor is given
+        executor_arg (ThreadPoolExecutor): thread pool to share between writers (not shut down on close)
+    """
+    def __init__(self, path_arg: Path, compresslevel_arg: int = DEFAULT_COMPRESSION_LEVEL, threads_arg: int = 1, executor_arg: ThreadPoolExecutor = None) -> None:
+        self.name = str(path_arg)
+        self.compresslevel = compresslevel_arg
+        self._file = open(path_arg, 'wb')
+        self._own_executor = executor_arg is None
+        self._executor = ThreadPoolExecutor(max_workers=threads_arg) if executor_arg is None else executor_arg
+        self._max_pending = 4 * max(1, getattr(self._executor, '_max_workers', threads_arg))
+        self._buffer = bytearray()
+        self._pending = deque()
+        self.closed = False
+    def write(self, data_arg: bytes) -> int:
+        """ Buffer data, compressing every full block in the background. """
+        self._buffer += data_arg
+        while len(self._buffer) >= BLOCK_SIZE:
+            self._submit(bytes(self._buffer[:BLOCK_SIZE]))
+            del self._buffer[:BLOCK_SIZE]
+        return len(data_arg)
+    def flush(self) -> None:
+        """ Compress and write everything written so far. """
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        self._drain(0)
+        self._file.flush()
+    def close(self) -> None:
+        """ Write the remaining blocks and the BGZF end-of-file marker. """
+        if self.closed:
+            return
+        try:
+            self.flush()
+            self._file.write(BGZF_EOF)
+        finally:
+            self._file.close()
+            if self._own_executor:
+                self._executor.shutdown()
+            self.closed = True
+    def _submit(self, block_arg: bytes) -> None:
+        """ Queue a block for compression, writing finished blocks in order to bound memory. """
+        self._pending.append(self._executor.submit(compress_block, block_arg, self.compresslevel))
+        self._drain(self._max_pending)
+    def _drain(self, max_pending_arg: int) -> None:
+        """ Write finished blocks (in order) until at most max_pending_arg are still queued. """
+        while len(self._pending) > max_pending_arg or (self._pending and self._pending[0].done()):
+            self._file.write(self._pending.popleft().result())
+    def __enter__(self):
+        return self
+    def __exit__(self, *_) -> None:
+        self.close()
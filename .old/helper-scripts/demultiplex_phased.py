@@ -1,11 +1,10 @@
 #!/usr/bin/env python3
 """
-Purpose: Helper script to demultiplex phased primers using a subprocess wrapper.
+Purpose: Helper script to demultiplex phased primers in a single pass.
 """
 __author__ = "Erick Samera"
-__version__ = "1.2.1"
+__version__ = "1.11.1"
 __comment__ = 'stable'
-# TODO: implement support for custom primers
 
 # --------------------------------------------------
 from argparse import (
@@ -14,16 +13,64 @@ from argparse import (
     ArgumentDefaultsHelpFormatter)
 from pathlib import Path
 # --------------------------------------------------
-import subprocess
-import os
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor)
+from contextlib import ExitStack
+import json
 import time
+import os
+import sys
+# --------------------------------------------------
+import numpy as np
+from iupac_matcher import (
+    find_primer_ends,
+    prefix_candidates)
+from fastq_reader import (
+    FastqBatch,
+    read_paired_fastq_batches)
+from bgzf_writer import (
+    BgzfWriter,
+    DEFAULT_COMPRESSION_LEVEL)
+from primer_panel import (
+    DEFAULT_CACHE_DIR,
+    load_panel,
+    compile_panel,
+    select_regions)
+# --------------------------------------------------
+# cutadapt default used by the old per-region cascade
+MAX_ERROR_RATE: float = 0.1
+# number of read pairs matched together
+BATCH_SIZE: int = 10000
+# primer prefix index: k-mer length, and how far into a read a primer may start (phasing spacer)
+PREFIX_K: int = 6
+PREFIX_MAX_OFFSET: int = 8
+# bump when the manifest layout changes, older manifests are ignored
+MANIFEST_VERSION: int = 2
+# default primer panel, use --panel for others
+QIASEQ_PANEL: dict = {
+    'primers': {
+        "V1V2": {'forward': "AGRGTTTGATYMTGGCTC",'reverse': "CTGCTGCCTYCCGTA"},
+        "V2V3": {'forward': "GGCGNACGGGTGAGTAA",'reverse': "WTTACCGCGGCTGCTGG"},
+        "V3V4": {'forward': "CCTACGGGNGGCWGCAG",'reverse': "GACTACHVGGGTATCTAATCC"},
+        "V4V5": {'forward': "GTGYCAGCMGCCGCGGTAA",'reverse': "CCGYCAATTYMTTTRAGTTT"},
+        "V5V7": {'forward': "GGATTAGATACCCBRGTAGTC",'reverse': "ACGTCRTCCCCDCCTTCCTC"},
+        "V7V9": {'forward': "YAACGAGCGMRACCC",'reverse': "TACGGYTACCTTGTTAYGACTT"},
+        "ITS1": {'forward': "CTTGGTCATTTAGAGGAAGTAA",'reverse': "GCTGCGTTCTTCATCGATGC"},
+        },
+    'pools': {
+        '1': ['V1V2', 'V4V5', 'ITS1'],
+        '2': ['V2V3', 'V5V7'],
+        '3': ['V3V4', 'V7V9']
+        }
+    }
 # --------------------------------------------------
 def get_args() -> Namespace:
     """ Get command-line arguments """
 
     parser = ArgumentParser(
         #usage='%(prog)s',
-        description="Helper script to demultiplex phased primers using a subprocess wrapper.",
+        description="Helper script to demultiplex phased primers in a single pass.",
         epilog=f"v{__version__} : {__author__} | {__comment__}",
         formatter_class=ArgumentDefaultsHelpFormatter)
     parser.add_argument(
@@ -43,7 +90,12 @@ def get_args() -> Namespace:
         dest='concatenate_path',
         metavar='PATH',
         type=Path,
-        help="path of directory to output concatenated fastq(.gz), set this to concatenate 16S regions after processing")
+        help="path of directory to output concatenated fastq(.gz), set this to concatenate 16S regions while demultiplexing")
+    parser.add_argument(
+        '--cat-only',
+        dest='cat_only',
+        action='store_true',
+        help="only write the concatenated 16S fastq(.gz), skip the per-region 16S files (ITS1 and ungrouped are still written)")
     parser.add_argument(
         '-j',
         '--jobs',
@@ -51,10 +103,45 @@ def get_args() -> Namespace:
         metavar='INT',
         type=int,
         default=4,
-        help="number of jobs to generate in parallel")
+        help="number of samples to demultiplex in parallel")
+    parser.add_argument(
+        '-t',
+        '--threads',
+        dest='threads',
+        metavar='INT',
+        type=int,
+        default=2,
+        help="number of compression threads per sample")
+    parser.add_argument(
+        '-l',
+        '--compression-level',
+        dest='compression_level',
+        metavar='INT',
+        type=int,
+        choices=range(0, 10),
+        default=DEFAULT_COMPRESSION_LEVEL,
+        help="gzip compression level of the outputs, 0..9 (lower is faster, higher is smaller)")
+    parser.add_argument(
+        '--force',
+        dest='force',
+        action='store_true',
+        help="redo every sample, even those recorded as complete in the output's demultiplex_manifest.json")
     # --------------------------------------------------
     group_custom_regions = parser.add_argument_group(
         title='custom region options')
+    group_custom_regions.add_argument(
+        '--panel',
+        dest='panel_path',
+        metavar='PATH',
+        type=Path,
+        help='primer panel (.tsv with region/forward/reverse/pool columns, or .toml), default: QIAseq 16S/ITS')
+    group_custom_regions.add_argument(
+        '--panel-cache',
+        dest='panel_cache_path',
+        metavar='PATH',
+        type=Path,
+        default=DEFAULT_CACHE_DIR,
+        help='path of directory to cache compiled primer panels')
     mut_ex_custom = group_custom_regions.add_mutually_exclusive_group()
     mut_ex_custom.add_argument(
         '-r',
@@ -62,14 +149,14 @@ def get_args() -> Namespace:
         dest='specific_regions',
         metavar='V-REGIONS',
         type=str,
-        help='save computation time: enter specific QIAseq regions (ex: "V1V2;V2V3;V4V5") to only use specific primers')
+        help='save computation time: enter specific panel regions (ex: "V1V2;V2V3;V4V5") to only use specific primers')
     mut_ex_custom.add_argument(
         '-p',
         '--pools',
         dest='specific_pools',
         metavar='POOLS',
         type=str,
-        help='save computation time: enter specific QIAseq pools (ex: "1;2") to only use specific primer pools')
+        help='save computation time: enter specific panel pools (ex: "1;2") to only use specific primer pools')
 
     args = parser.parse_args()
 
@@ -77,114 +164,438 @@ def get_args() -> Namespace:
     # --------------------------------------------------
     if not args.input_path.resolve().exists():
         parser.error("Input directory doesn't exist.")
+    if args.cat_only and not args.concatenate_path:
+        parser.error("--cat-only requires --cat.")
+    if args.panel_path:
+        if not args.panel_path.exists():
+            parser.error("Primer panel doesn't exist.")
+        try:
+            args.panel = load_panel(args.panel_path)
+        except (ValueError, KeyError, IndexError) as error:
+            parser.error(f"Couldn't process primer panel ({error}).")
+    else:
+        args.panel = QIASEQ_PANEL
     if args.specific_regions:
-        args.specific_regions = [region.strip() for region in args.specific_regions.upper().split(';') if region in ("V1V2","V2V3","V3V4","V4V5","V5V7","V7V9","ITS1")]
+        args.specific_regions = _panel_keys(args.specific_regions, args.panel['primers'])
         if not args.specific_regions:
             parser.error("Couldn't process variable region input.")
     if args.specific_pools:
-        args.specific_pools = [pool.strip() for pool in args.specific_pools.upper().split(';') if pool in ("1","2",)]
+        args.specific_pools = _panel_keys(args.specific_pools, args.panel['pools'])
         if not args.specific_pools:
             parser.error("Couldn't process primer pool input.")
 
     return args
 # --------------------------------------------------
-def perform_trim(args: Namespace, file_arg: Path, output_path_arg: Path, demux_primers_dict_arg: dict) -> None:
+def _panel_keys(selection_arg: str, panel_keys_arg) -> list:
     """
-    Function performs fastq trimming in parallel with cutadapt.
+    Function matches a ";"-separated selection (ex: "v1v2;V2V3") to region or pool names of the panel,
+    ignoring case unless the exact name is in the panel.
 
     Parameters:
-        file_arg (Path): path to the input .fastq(.gz) file
+        selection_arg (str): selected names
+        panel_keys_arg (dict): regions or pools of the panel
+
+    Returns:
+        (list): panel names of the selection (names not in the panel are left out)
+    """
+    upper_keys: dict = {}
+    for key in panel_keys_arg:
+        upper_keys.setdefault(key.upper(), key)
+    selected_keys: list = []
+    for name in (name.strip() for name in selection_arg.split(';')):
+        key = name if name in panel_keys_arg else upper_keys.get(name.upper())
+        if key is not None:
+            selected_keys.append(key)
+    return selected_keys
+def _region_output_name(file_arg: Path, region_arg: str) -> str:
+    """
+    Function inserts the region into the name of an Illumina .fastq.gz file.
+
+    Parameters:
+        file_arg (Path): path of the input .fastq.gz file
+        region_arg (str): region name to insert (ex: "V1V2", "ungrouped")
+
+    Returns:
+        (str): name of the region output file
+    """
+    name_parts: list = str(Path(file_arg.stem).stem).split('_')
+    name_parts.insert(3, region_arg)
+    return f"{'_'.join(name_parts)}.fastq.gz"
+def _route_batch(r1_batch_arg: FastqBatch, r2_batch_arg: FastqBatch, compiled_primers_arg: list, prefix_index_arg: dict) -> dict:
+    """
+    Function finds the region of each read pair in a batch.
+
+    Parameters:
+        r1_batch_arg (FastqBatch): R1 records from read_paired_fastq_batches()
+        r2_batch_arg (FastqBatch): R2 records from read_paired_fastq_batches(), in the same order
+        compiled_primers_arg (list): (region, forward, reverse) compiled primers, in matching order
+        prefix_index_arg (dict): prefix indexes of the forward and reverse primers, from build_prefix_index()
+
+    Returns:
+        (dict): arrays with one value per read pair
+            regions:    region index (-1 for ungrouped)
+            r1_ends:    R1 position just past the forward primer
+            r2_ends:    R2 position just past the reverse primer
+            r1_lengths: R1 length
+            r2_lengths: R2 length
+            too_short:  routed pairs where a primer was the whole read (dropped, cutadapt --minimum-length 1)
+            r1_orphans: for ungrouped pairs, first region whose forward primer matched R1 only (-1 for none)
+            r2_orphans: for ungrouped pairs, first region whose reverse primer matched R2 only (-1 for none)
+    """
+    r1_reads, r1_lengths = r1_batch_arg.sequences()
+    r2_reads, r2_lengths = r2_batch_arg.sequences()
+    routed_regions = np.full(len(r1_batch_arg), -1, dtype=np.int16)
+    r1_orphans = np.full(len(r1_batch_arg), -1, dtype=np.int16)
+    r2_orphans = np.full(len(r1_batch_arg), -1, dtype=np.int16)
+    r1_ends = np.zeros(len(r1_batch_arg), dtype=np.int32)
+    r2_ends = np.zeros(len(r1_batch_arg), dtype=np.int32)
+
+    # regions are tried in panel order, a pair goes to the first one whose primers match anywhere in both reads
+    # (same as the old cascade). Pairs whose primer prefixes start both reads are first searched at the start
+    # of the reads only: an exact match there is also the best and first one of the whole read. Every other
+    # pair (a prefix can match by chance while the primer is further into the read) is searched in full.
+    candidates = prefix_candidates(prefix_index_arg['forward'], r1_reads, r1_lengths, PREFIX_MAX_OFFSET) \
+        & prefix_candidates(prefix_index_arg['reverse'], r2_reads, r2_lengths, PREFIX_MAX_OFFSET)
+    for region_index, (_, forward_primer, reverse_primer) in enumerate(compiled_primers_arg):
+        unrouted = np.flatnonzero(routed_regions < 0)
+        if not unrouted.size:
+            break
+
+        prefixed = unrouted[candidates[unrouted, region_index]]
+        forward_width = PREFIX_MAX_OFFSET + forward_primer['length'] + forward_primer['max_errors']
+        reverse_width = PREFIX_MAX_OFFSET + reverse_primer['length'] + reverse_primer['max_errors']
+        # (a match ending at the last searched base could still have extended by one base in the whole read)
+        forward_ends, forward_errors = find_primer_ends(forward_primer, r1_reads[prefixed], r1_lengths[prefixed], forward_width)
+        forward_exact = (forward_errors == 0) & (forward_ends < forward_width)
+        reverse_ends, reverse_errors = find_primer_ends(reverse_primer, r2_reads[prefixed[forward_exact]], r2_lengths[prefixed[forward_exact]], reverse_width)
+        reverse_exact = (reverse_errors == 0) & (reverse_ends < reverse_width)
+        exact = prefixed[forward_exact][reverse_exact]
+        routed_regions[exact] = region_index
+        r1_ends[exact] = forward_ends[forward_exact][reverse_exact]
+        r2_ends[exact] = reverse_ends[reverse_exact]
+
+        searched = unrouted[routed_regions[unrouted] < 0]
+        forward_ends, _ = find_primer_ends(forward_primer, r1_reads[searched], r1_lengths[searched])
+        primed = searched[forward_ends >= 0]
+        reverse_ends, _ = find_primer_ends(reverse_primer, r2_reads[primed], r2_lengths[primed])
+        routed = primed[reverse_ends >= 0]
+        orphaned = primed[(reverse_ends < 0) & (r1_orphans[primed] < 0)]
+
+        routed_regions[routed] = region_index
+        r1_orphans[orphaned] = region_index
+        r1_ends[routed] = forward_ends[forward_ends >= 0][reverse_ends >= 0]
+        r2_ends[routed] = reverse_ends[reverse_ends >= 0]
+    unrouted = np.flatnonzero(routed_regions < 0)
+
+    # pairs that are still ungrouped: was R2 primed on its own?
+    r1_orphans[routed_regions >= 0] = -1
+    for region_index, (_, _, reverse_primer) in enumerate(compiled_primers_arg):
+        candidates = unrouted[r2_orphans[unrouted] < 0]
+        if not candidates.size:
+            break
+        reverse_ends, _ = find_primer_ends(reverse_primer, r2_reads[candidates], r2_lengths[candidates])
+        r2_orphans[candidates[reverse_ends >= 0]] = region_index
+
+    too_short = (routed_regions >= 0) & ((r1_ends >= r1_lengths) | (r2_ends >= r2_lengths))
+    return {
+        'regions': routed_regions, 'r1_ends': r1_ends, 'r2_ends': r2_ends,
+        'r1_lengths': r1_lengths, 'r2_lengths': r2_lengths, 'too_short': too_short,
+        'r1_orphans': r1_orphans, 'r2_orphans': r2_orphans}
+def _new_stats(compiled_primers_arg: list) -> dict:
+    """
+    Function initializes the demultiplexing statistics of a sample.
+
+    Parameters:
+        compiled_primers_arg (list): (region, forward, reverse) compiled primers
+
+    Returns:
+        (dict): statistics keyed by region, plus ungrouped and too_short read pair counts
+    """
+    stats: dict = {}
+    for region, _, _ in compiled_primers_arg:
+        stats[region] = {
+            'read_pairs': 0, 'orphaned_r1': 0, 'orphaned_r2': 0,
+            'r1_primer_offsets': [], 'r2_primer_offsets': [],
+            'r1_lengths': [], 'r2_lengths': []}
+    stats['ungrouped'] = {'read_pairs': 0}
+    stats['too_short'] = {'read_pairs': 0}
+    return stats
+def _add_histogram(histogram_arg: list, values_arg: np.ndarray) -> list:
+    """
+    Function adds values to a histogram kept as a list of counts indexed by value.
+
+    Parameters:
+        histogram_arg (list): counts so far
+        values_arg (np.ndarray): non-negative integer values to add
+
+    Returns:
+        (list): updated counts
+    """
+    counts = np.bincount(values_arg, minlength=len(histogram_arg))
+    counts[:len(histogram_arg)] += np.asarray(histogram_arg, dtype=counts.dtype)
+    return counts.tolist()
+def _update_stats(stats_arg: dict, routed_arg: dict, compiled_primers_arg: list) -> None:
+    """
+    Function adds a routed batch to the demultiplexing statistics of a sample.
+
+    Parameters:
+        stats_arg (dict): statistics from _new_stats()
+        routed_arg (dict): routed batch from _route_batch()
+        compiled_primers_arg (list): (region, forward, reverse) compiled primers, in matching order
+
+    Returns:
+        None
+    """
+    for region_index, (region, forward_primer, reverse_primer) in enumerate(compiled_primers_arg):
+        kept = (routed_arg['regions'] == region_index) & ~routed_arg['too_short']
+        region_stats = stats_arg[region]
+        region_stats['read_pairs'] += int(kept.sum())
+        region_stats['orphaned_r1'] += int((routed_arg['r1_orphans'] == region_index).sum())
+        region_stats['orphaned_r2'] += int((routed_arg['r2_orphans'] == region_index).sum())
+        region_stats['r1_primer_offsets'] = _add_histogram(region_stats['r1_primer_offsets'], np.maximum(routed_arg['r1_ends'][kept] - forward_primer['length'], 0))
+        region_stats['r2_primer_offsets'] = _add_histogram(region_stats['r2_primer_offsets'], np.maximum(routed_arg['r2_ends'][kept] - reverse_primer['length'], 0))
+        region_stats['r1_lengths'] = _add_histogram(region_stats['r1_lengths'], (routed_arg['r1_lengths'] - routed_arg['r1_ends'])[kept])
+        region_stats['r2_lengths'] = _add_histogram(region_stats['r2_lengths'], (routed_arg['r2_lengths'] - routed_arg['r2_ends'])[kept])
+    stats_arg['ungrouped']['read_pairs'] += int((routed_arg['regions'] < 0).sum())
+    stats_arg['too_short']['read_pairs'] += int(routed_arg['too_short'].sum())
+def _histogram_quantile(histogram_arg: list, quantile_arg: float) -> str:
+    """ Return a quantile of a histogram of counts indexed by value ('' if empty). """
+    total = sum(histogram_arg)
+    if not total:
+        return ''
+    return str(int(np.searchsorted(np.cumsum(histogram_arg), quantile_arg * total)))
+def _write_stats(manifest_arg: dict, output_path_arg: Path) -> None:
+    """
+    Function writes the statistics of every completed sample to demultiplex_stats.json and .tsv.
+
+    Parameters:
+        manifest_arg (dict): completion manifest
         output_path_arg (Path): path to the output directory
-        demux_primers_dict_arg (dict): dictionary of primers to use in demultiplexing
 
     Returns:
         None
     """
-    start_time = time.time()
-    print_runtime(f'Demultiplexing {file_arg.name} with {list(demux_primers_dict_arg)} ...')
-
-    for index, primer_info in enumerate(demux_primers_dict_arg.items()):
-        primer_name, primer_seqs = primer_info
-
-        file_variables: dict = {'r1_path': file_arg}
-        file_variables['r1_intermediate_file'] = output_path_arg.joinpath(f'{Path(file_variables["r1_path"].stem).stem}_intermediate_{index}.fastq.gz')
-        file_variables['r1_prev_intermediate_file'] = Path(str(file_variables['r1_intermediate_file']).replace(f"_intermediate_{index}", f"_intermediate_{index-1}"))
-        if file_variables['r1_prev_intermediate_file'].exists():
-            file_variables['r1_path'] = file_variables['r1_prev_intermediate_file']
-        r1_output_raw = str(f'{Path(file_variables["r1_path"].stem).stem}').split('_')
-        r1_output_raw.insert(3, primer_name)
-        r1_output_processed = f"{'_'.join(r1_output_raw)}.fastq.gz".replace(f"_intermediate_{index-1}", "")
-        file_variables['r1_output'] = output_path_arg.joinpath(r1_output_processed)
-
-        if len(demux_primers_dict_arg) == 1:
-            r1_output_raw = str(f'{Path(file_variables["r1_path"].stem).stem}').split('_')
-            r1_output_raw.insert(3, 'ungrouped')
-            r1_output_processed = f"{'_'.join(r1_output_raw)}.fastq.gz".replace(f"_intermediate_{index-1}", "")
-            file_variables['r1_intermediate_file'] = output_path_arg.joinpath(r1_output_processed)
-
-        r2_file_variables: dict = {}
-        for r1_file_variable_key, r1_file_variable_value in file_variables.items():
-            r2_file_variables[r1_file_variable_key.replace('r1', 'r2')] = Path(str(r1_file_variable_value).replace('R1', 'R2'))
-        file_variables.update(r2_file_variables)
-
-        parallel_str = f"\
-            cutadapt \
-            --minimum-length 1 \
-            --pair-adapters \
-            --pair-filter any \
-            --match-read-wildcards \
-            -g {primer_seqs['forward']} \
-            -G {primer_seqs['reverse']} \
-            -o {file_variables['r1_output']} \
-            -p {file_variables['r2_output']} \
-            --untrimmed-output {file_variables['r1_intermediate_file']} \
-            --untrimmed-paired-output {file_variables['r2_intermediate_file']}" + '\
-            {1} {2}'
-
-        with subprocess.Popen([
-                'parallel',
-                '--link',
-                '-j', f'{args.jobs}',
-                f'{parallel_str}',
-                ':::', f"{file_variables['r1_path']}", ':::', f"{file_variables['r2_path']}"], stdout=subprocess.PIPE) as output:
-            pass
-
-    for index, output_file in enumerate(output_path_arg.glob(f'{str(Path(file_arg.stem).stem)}_intermediate_*.fastq.gz')):
-        r1_intermediate_file = output_file
-        r2_intermediate_file = Path(str(output_file).replace('R1', 'R2'))
-        if index < len(demux_primers_dict_arg):
-            os.remove(r1_intermediate_file)
-            os.remove(r2_intermediate_file)
-        else:
-            old_name_replaced = str(Path(r1_intermediate_file.stem).stem).replace(f"_intermediate_{index}", "")
-            old_name_raw = old_name_replaced.split('_')
-            old_name_raw.insert(3, 'ungrouped')
-            r1_new_name = f"{'_'.join(old_name_raw)}.fastq.gz"
-            r2_new_name = r1_new_name.replace('R1', 'R2')
-            os.rename(r1_intermediate_file, r1_intermediate_file.parent.joinpath(r1_new_name))
-            os.rename(r2_intermediate_file, r1_intermediate_file.parent.joinpath(r2_new_name))
-    end_time = time.time()
-    print_runtime(f'Demultiplexed {file_arg.name} with {list(demux_primers_dict_arg)} in {round(end_time - start_time, 3)} s.')
-def condense_files(file_arg: Path, intermediate_output_path_arg: Path, output_path_arg: Path) -> None:
+    all_stats: dict = {sample: record['stats'] for sample, record in sorted(manifest_arg['samples'].items())}
+    with open(output_path_arg.joinpath('demultiplex_stats.json'), 'w', encoding='utf8') as stats_json_file:
+        json.dump(all_stats, stats_json_file)
+
+    header: list = [
+        'sample', 'region', 'read_pairs', 'percent_of_sample', 'orphaned_r1', 'orphaned_r2',
+        'r1_primer_offset_median', 'r2_primer_offset_median',
+        'r1_length_p05', 'r1_length_median', 'r1_length_p95',
+        'r2_length_p05', 'r2_length_median', 'r2_length_p95']
+    with open(output_path_arg.joinpath('demultiplex_stats.tsv'), 'w', encoding='utf8') as stats_tsv_file:
+        stats_tsv_file.write('\t'.join(header) + '\n')
+        for sample, sample_stats in all_stats.items():
+            sample_total = sum(region_stats['read_pairs'] for region_stats in sample_stats.values())
+            for region, region_stats in sample_stats.items():
+                row: list = [sample, region, str(region_stats['read_pairs']), str(round(100 * region_stats['read_pairs'] / sample_total, 3)) if sample_total else '']
+                if 'r1_lengths' in region_stats:
+                    row += [
+                        str(region_stats['orphaned_r1']), str(region_stats['orphaned_r2']),
+                        _histogram_quantile(region_stats['r1_primer_offsets'], 0.5), _histogram_quantile(region_stats['r2_primer_offsets'], 0.5)]
+                    for read in ('r1', 'r2'):
+                        row += [_histogram_quantile(region_stats[f'{read}_lengths'], quantile) for quantile in (0.05, 0.5, 0.95)]
+                else:
+                    row += [''] * (len(header) - len(row))
+                stats_tsv_file.write('\t'.join(row) + '\n')
+def _partial_path(path_arg: Path) -> Path:
+    """ Return the path an output is written to until the sample is complete. """
+    return path_arg.parent.joinpath(f'{path_arg.name}.partial')
+def _open_output_pair(args: Namespace, stack_arg: ExitStack, executor_arg: ThreadPoolExecutor, r1_path_arg: Path, output_paths_arg: list) -> tuple:
+    """
+    Function opens a pair of R1/R2 .fastq.gz (BGZF) outputs (as .partial files until the sample is complete).
+
+    Parameters:
+        stack_arg (ExitStack): stack that closes the files
+        executor_arg (ThreadPoolExecutor): compression threads shared by the outputs of the sample
+        r1_path_arg (Path): path of the R1 output, the R2 output is named the same with R2
+        output_paths_arg (list): list of final output paths, extended with the pair
+
+    Returns:
+        (tuple): R1 and R2 output file handles
+    """
+    r2_path = r1_path_arg.parent.joinpath(r1_path_arg.name.replace('R1', 'R2'))
+    output_paths_arg += [r1_path_arg, r2_path]
+    return (
+        stack_arg.enter_context(BgzfWriter(_partial_path(r1_path_arg), args.compression_level, executor_arg=executor_arg)),
+        stack_arg.enter_context(BgzfWriter(_partial_path(r2_path), args.compression_level, executor_arg=executor_arg)))
+def _input_fingerprint(file_arg: Path) -> dict:
+    """
+    Function fingerprints the R1/R2 inputs of a sample so a rerun can tell whether they changed.
+
+    Parameters:
+        file_arg (Path): path of the R1 input
+
+    Returns:
+        (dict): size and mtime (ns) of each input, keyed by file name
+    """
+    fingerprint: dict = {}
+    for input_file in (file_arg, file_arg.parent.joinpath(file_arg.name.replace('R1', 'R2'))):
+        input_stat = input_file.stat()
+        fingerprint[input_file.name] = {'size': input_stat.st_size, 'mtime_ns': input_stat.st_mtime_ns}
+    return fingerprint
+def _remove_leftovers(file_arg: Path, output_dirs_arg: list, sample_record_arg: dict) -> None:
+    """
+    Function removes partial outputs of a sample left behind by an interrupted run, and the outputs an earlier
+    run recorded for it (a run with other settings may not write all of them again, e.g. with --cat-only).
+
+    Parameters:
+        file_arg (Path): path of the R1 input
+        output_dirs_arg (list): output directories of the run
+        sample_record_arg (dict): manifest record of the sample from an earlier run (None if there is none)
+
+    Returns:
+        None
+    """
+    for output_path in (sample_record_arg or {}).get('outputs', []):
+        Path(output_path).unlink(missing_ok=True)
+    name_parts: list = str(Path(file_arg.stem).stem).split('_')
+    for output_dir in output_dirs_arg:
+        for read in ('R1', 'R2'):
+            sample_prefix = '_'.join(name_parts[:3]).replace('R1', read)
+            leftovers = list(output_dir.glob(f'{sample_prefix}_*.partial')) \
+                + list(output_dir.glob(f'{str(Path(file_arg.stem).stem).replace("R1", read)}_intermediate_*.fastq.gz'))
+            for leftover in leftovers:
+                leftover.unlink()
+def _load_manifest(manifest_path_arg: Path) -> dict:
+    """
+    Function loads the completion manifest of previous runs.
+
+    Parameters:
+        manifest_path_arg (Path): path of the manifest (.json)
+
+    Returns:
+        (dict): manifest, empty if there is no (readable) manifest
+    """
+    try:
+        with open(manifest_path_arg, 'r', encoding='utf8') as manifest_file:
+            manifest = json.load(manifest_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {'version': MANIFEST_VERSION, 'samples': {}}
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {'version': MANIFEST_VERSION, 'samples': {}}
+    return manifest
+def _save_manifest(manifest_path_arg: Path, manifest_arg: dict) -> None:
+    """
+    Function atomically writes the completion manifest.
+
+    Parameters:
+        manifest_path_arg (Path): path of the manifest (.json)
+        manifest_arg (dict): manifest to write
+
+    Returns:
+        None
+    """
+    temp_path = _partial_path(manifest_path_arg)
+    with open(temp_path, 'w', encoding='utf8') as manifest_file:
+        json.dump(manifest_arg, manifest_file, indent=2)
+    os.replace(temp_path, manifest_path_arg)
+def _is_complete(manifest_arg: dict, file_arg: Path, settings_arg: dict) -> bool:
     """
-    Function concatenates files together to make it easier to process with qiime2.
+    Function checks whether a sample was already completed with the same inputs and settings.
 
     Parameters:
-        file_arg (Path): path of input sample
-        intermediate_output_path_arg (Path): path of primer-trimmed output
-        output_path_arg (Path): path to output concatenated primer-trimmed files
+        manifest_arg (dict): completion manifest
+        file_arg (Path): path of the R1 input
+        settings_arg (dict): settings that change the outputs
+
+    Returns:
+        (bool): True if the sample can be skipped
+    """
+    sample_record = manifest_arg['samples'].get(file_arg.name)
+    if not sample_record or sample_record.get('status') != 'complete':
+        return False
+    return all((
+        sample_record['settings'] == settings_arg,
+        sample_record['inputs'] == _input_fingerprint(file_arg),
+        all(Path(output_path).exists() for output_path in sample_record['outputs'])))
+def _write_pairs(output_pair_arg: tuple, r1_batch_arg: FastqBatch, r2_batch_arg: FastqBatch, routed_arg: dict, selected_arg: np.ndarray) -> None:
+    """
+    Function writes some read pairs of a batch, primer-trimmed, to a pair of outputs.
+
+    Parameters:
+        output_pair_arg (tuple): (R1, R2) outputs from _open_output_pair()
+        r1_batch_arg (FastqBatch): R1 records
+        r2_batch_arg (FastqBatch): R2 records, in the same order
+        routed_arg (dict): routed batch from _route_batch()
+        selected_arg (np.ndarray): indexes of the read pairs to write, in writing order
 
     Returns:
         None
     """
-    file_prefix = file_arg.stem.split('_')[0]
+    if not selected_arg.size:
+        return None
+    r1_output, r2_output = output_pair_arg
+    r1_output.write(r1_batch_arg.to_fastq(selected_arg, routed_arg['r1_ends'][selected_arg]))
+    r2_output.write(r2_batch_arg.to_fastq(selected_arg, routed_arg['r2_ends'][selected_arg]))
+    return None
+def perform_trim(args: Namespace, file_arg: Path, output_path_arg: Path, compiled_panel_arg: dict) -> tuple:
+    """
+    Function demultiplexes and primer-trims a pair of .fastq.gz files in a single pass.
+
+    Each read pair is tested against every primer pair in order and written to the first region where
+    R1 matches the forward primer and R2 matches the reverse primer (same as the old cutadapt cascade),
+    otherwise it is written untouched to the ungrouped files. With --cat, 16S pairs are also (or, with
+    --cat-only, only) written to the concatenated files in the same pass. Outputs are written as .partial
+    files and only renamed once the whole sample is done. Per-region statistics are collected on the way.
+
+    Parameters:
+        file_arg (Path): path to the input .fastq(.gz) file
+        output_path_arg (Path): path to the output directory
+        compiled_panel_arg (dict): compiled primer panel of the regions to demultiplex, from compile_panel()
+
+    Returns:
+        (tuple): progress message, manifest record of the completed sample
+    """
     start_time = time.time()
-    for read in ('R1', 'R2'):
-        files_to_combine = [str(file) for file in intermediate_output_path_arg.glob(f'{file_prefix}*{read}*') if (('ungrouped' not in file.name) and ('ITS' not in file.name))]
-        concat_arg = ['cat'] + files_to_combine + ['>'] + [str(output_path_arg.joinpath(str(file_arg.name).replace('R1', read)))]
-        subprocess.call(' '.join(concat_arg), shell=True)
+
+    compiled_primers: list = compiled_panel_arg['primers']
+    prefix_index: dict = compiled_panel_arg['prefix_index']
+    panel_regions: list = [primer_name for primer_name, _, _ in compiled_primers]
+    region_names: list = panel_regions + ['ungrouped']
+    r2_file = file_arg.parent.joinpath(file_arg.name.replace('R1', 'R2'))
+    input_fingerprint: dict = _input_fingerprint(file_arg)
+    output_paths: list = []
+    stats: dict = _new_stats(compiled_primers)
+
+    with ExitStack() as stack:
+        # the executor is entered first so it outlives (is shut down after) the writers using it
+        executor = stack.enter_context(ThreadPoolExecutor(max_workers=args.threads))
+        # every region writes its own (R1, R2) files, 16S regions may also go to the concatenated files
+        concatenated_regions: list = [region for region in panel_regions if 'ITS' not in region] if args.concatenate_path else []
+        output_files: dict = {}
+        for region in region_names:
+            if not (args.cat_only and region in concatenated_regions):
+                output_files[region] = _open_output_pair(args, stack, executor, output_path_arg.joinpath(_region_output_name(file_arg, region)), output_paths)
+        if concatenated_regions:
+            concatenated_output = _open_output_pair(args, stack, executor, args.concatenate_path.joinpath(file_arg.name), output_paths)
+            concatenated_indexes = np.array([panel_regions.index(region) for region in concatenated_regions])
+
+        for r1_batch, r2_batch in read_paired_fastq_batches(file_arg, r2_file, BATCH_SIZE):
+            routed = _route_batch(r1_batch, r2_batch, compiled_primers, prefix_index)
+            _update_stats(stats, routed, compiled_primers)
+            # --minimum-length 1: drop pairs where the primer was the whole read
+            kept_regions = np.where(routed['too_short'], -2, routed['regions'])
+            for region_index, region in enumerate(region_names):
+                if region not in output_files:
+                    continue
+                selected = np.flatnonzero(kept_regions == (region_index if region != 'ungrouped' else -1))
+                # ungrouped pairs are written untouched (their primer ends are 0)
+                _write_pairs(output_files[region], r1_batch, r2_batch, routed, selected)
+            # the concatenated files keep the input order of the reads across regions
+            if concatenated_regions:
+                _write_pairs(concatenated_output, r1_batch, r2_batch, routed, np.flatnonzero(np.isin(kept_regions, concatenated_indexes)))
+
+    for output_path in output_paths:
+        os.replace(_partial_path(output_path), output_path)
     end_time = time.time()
-    print_runtime(f'Concatenated {file_arg.name} in {round(end_time - start_time, 3)} s.')
+    sample_record: dict = {
+        'status': 'complete',
+        'inputs': input_fingerprint,
+        'outputs': [str(output_path) for output_path in output_paths],
+        'stats': stats}
+    return f'Demultiplexed {file_arg.name} with {panel_regions} in {round(end_time - start_time, 3)} s.', sample_record
 # --------------------------------------------------
 def main() -> None:
     """ Insert docstring here """
@@ -199,41 +610,62 @@ def main() -> None:
         if not args.concatenate_path.exists():
             Path(args.concatenate_path).mkdir(parents=False, exist_ok=True)
 
-    # constants
-    qiaseq_primers: dict = {
-        "V1V2": {'forward': "AGRGTTTGATYMTGGCTC",'reverse': "CTGCTGCCTYCCGTA"},
-        "V2V3": {'forward': "GGCGNACGGGTGAGTAA",'reverse': "WTTACCGCGGCTGCTGG"},
-        "V3V4": {'forward': "CCTACGGGNGGCWGCAG",'reverse': "GACTACHVGGGTATCTAATCC"},
-        "V4V5": {'forward': "GTGYCAGCMGCCGCGGTAA",'reverse': "CCGYCAATTYMTTTRAGTTT"},
-        "V5V7": {'forward': "GGATTAGATACCCBRGTAGTC",'reverse': "ACGTCRTCCCCDCCTTCCTC"},
-        "V7V9": {'forward': "YAACGAGCGMRACCC",'reverse': "TACGGYTACCTTGTTAYGACTT"},
-        "ITS1": {'forward': "CTTGGTCATTTAGAGGAAGTAA",'reverse': "GCTGCGTTCTTCATCGATGC"},
-        }
-    qiaseq_pools: dict = {
-        '1': ['V1V2', 'V4V5', 'ITS1'],
-        '2': ['V2V3', 'V5V7'],
-        '3': ['V3V4', 'V7V9']
-    }
-
-    demux_primers_dict: dict = []
+    demux_regions: list = []
     if args.specific_pools:
-        region_list: list = []
         for pool in args.specific_pools:
-            region_list += qiaseq_pools[pool]
-        demux_primers_dict = {key: qiaseq_primers[key] for key in region_list}
+            demux_regions += args.panel['pools'][pool]
     elif args.specific_regions:
-        demux_primers_dict = {key: qiaseq_primers[key] for key in args.specific_regions}
+        demux_regions = args.specific_regions
     else:
-        demux_primers_dict = {key: value for key, value in qiaseq_primers.items()}
-
-    for file in args.input_path.glob('*_R1_*.fastq.gz'):
-        perform_trim(
-            args=args,
-            file_arg=file,
-            output_path_arg=args.output_path,
-            demux_primers_dict_arg=demux_primers_dict)
-        if args.concatenate_path:
-            condense_files(file, args.output_path, args.concatenate_path)
+        demux_regions = list(args.panel['primers'])
+    demux_primers_dict: dict = {region: args.panel['primers'][region] for region in demux_regions}
+    compiled_panel: dict = select_regions(compile_panel(args.panel, MAX_ERROR_RATE, PREFIX_K, args.panel_cache_path), demux_regions)
+
+    # samples completed by an earlier run with the same inputs and settings are skipped
+    manifest_path: Path = args.output_path.joinpath('demultiplex_manifest.json')
+    # (the outputs recorded by the earlier run are removed before a sample is redone, --force included)
+    previous_manifest: dict = _load_manifest(manifest_path)
+    manifest: dict = {'version': MANIFEST_VERSION, 'samples': {}} if args.force else previous_manifest
+    settings: dict = {
+        'regions': demux_primers_dict,
+        'error_rate': MAX_ERROR_RATE,
+        'concatenate_path': str(args.concatenate_path) if args.concatenate_path else None,
+        'cat_only': args.cat_only,
+        'compression_level': args.compression_level}
+    output_dirs: list = [args.output_path] + ([args.concatenate_path] if args.concatenate_path else [])
+
+    sample_files: list = []
+    for file in sorted(args.input_path.glob('*_R1_*.fastq.gz')):
+        if _is_complete(manifest, file, settings):
+            print_runtime(f'Skipping {file.name}, already completed.')
+            continue
+        _remove_leftovers(file, output_dirs, previous_manifest['samples'].get(file.name))
+        manifest['samples'].pop(file.name, None)
+        sample_files.append(file)
+    _save_manifest(manifest_path, manifest)
+
+    # samples run in a worker pool, progress is reported in input order once each sample finishes
+    failed_samples: list = []
+    print_runtime(f'Demultiplexing {len(sample_files)} samples with {list(demux_primers_dict)} using {args.jobs} workers ...')
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(perform_trim, args, file, args.output_path, compiled_panel) for file in sample_files]
+        for file, future in zip(sample_files, futures):
+            try:
+                message, sample_record = future.result()
+            except Exception as error:
+                failed_samples.append(file.name)
+                print_runtime(f'ERROR: {file.name} failed ({type(error).__name__}: {error})')
+                continue
+            sample_record['settings'] = settings
+            manifest['samples'][file.name] = sample_record
+            _save_manifest(manifest_path, manifest)
+            print_runtime(message)
+
+    _write_stats(manifest, args.output_path)
+    print_runtime(f'Wrote per-region statistics of {len(manifest["samples"])} samples to {args.output_path.joinpath("demultiplex_stats.tsv")} .')
+    if failed_samples:
+        print_runtime(f'{len(failed_samples)}/{len(sample_files)} samples failed: {", ".join(failed_samples)}')
+        sys.exit(1)
 def print_runtime(action) -> None:
     """ Return the time and some defined action. """
     print(f'[{time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())}] {action}')
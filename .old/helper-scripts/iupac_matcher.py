@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+Purpose: Compiled IUPAC primer matcher with bit-parallel approximate search over batches of reads.
+
+Primers are compiled once into per-base bitmasks (one bit per primer position, up to 64 bases) and
+searched in every read of a batch at the same time, one read column per step:
+    edit distance (mismatches and indels): Myers' bit-vector algorithm
+    Hamming distance (mismatches only):    shift-and with one state vector per allowed mismatch
+
+Reads are held as a 2-D uint8 array (one padded row per read) with a separate array of read lengths,
+see encode_reads(). For larger panels, a prefix k-mer index (build_prefix_index()) narrows each read
+down to the few primers whose first k bases occur near the start of the read.
+"""
+__author__ = "Erick Samera"
+__version__ = "1.0.0"
+__comment__ = 'stable'
+
+# --------------------------------------------------
+import numpy as np
+# --------------------------------------------------
+IUPAC_CODES: dict = {
+    'A': 'A', 'C': 'C', 'G': 'G', 'T': 'T', 'U': 'T',
+    'R': 'AG', 'Y': 'CT', 'S': 'CG', 'W': 'AT', 'K': 'GT', 'M': 'AC',
+    'B': 'CGT', 'D': 'AGT', 'H': 'ACT', 'V': 'ACG', 'N': 'ACGT'}
+MAX_PRIMER_LENGTH: int = 64
+# 2-bit codes of A/C/G/T (and U) for k-mer lookups, anything else is 255
+_BASE_CODES = np.full(256, 255, dtype=np.uint8)
+for _code, _bases in enumerate(('Aa', 'Cc', 'Gg', 'TtUu')):
+    for _base in _bases:
+        _BASE_CODES[ord(_base)] = _code
+# --------------------------------------------------
+def compile_primer(primer_seq_arg: str, error_rate_arg: float = 0.1, max_errors_arg: int = None, indels_arg: bool = True, read_wildcards_arg: bool = True) -> dict:
+    """
+    Function compiles a (degenerate) primer into per-base bitmasks.
+
+    Parameters:
+        primer_seq_arg (str): primer sequence, IUPAC codes allowed
+        error_rate_arg (float): maximum fraction of errors allowed in a match (cutadapt -e)
+        max_errors_arg (int): maximum number of errors allowed in a match, overrides error_rate_arg
+        indels_arg (bool): count indels as errors (edit distance), otherwise only allow mismatches
+        read_wildcards_arg (bool): an N in the read matches any primer base (cutadapt --match-read-wildcards)
+
+    Returns:
+        (dict): compiled primer
+            sequence:   primer sequence
+            peq:        uint64 bitmask of matching primer positions for every read byte
+            length:     length of the primer
+            max_errors: maximum number of errors allowed in a match
+            indels:     whether indels are allowed
+    """
+    primer_seq = primer_seq_arg.upper()
+    if not 0 < len(primer_seq) <= MAX_PRIMER_LENGTH:
+        raise ValueError(f"Primer {primer_seq_arg} must be 1..{MAX_PRIMER_LENGTH} bases long.")
+
+    peq = np.zeros(256, dtype=np.uint64)
+    for position, primer_base in enumerate(primer_seq):
+        if primer_base not in IUPAC_CODES:
+            raise ValueError(f"Primer {primer_seq_arg} contains a non-IUPAC base ({primer_base}).")
+        for read_base in IUPAC_CODES[primer_base]:
+            peq[ord(read_base)] |= np.uint64(1 << position)
+            peq[ord(read_base.lower())] |= np.uint64(1 << position)
+    if read_wildcards_arg:
+        peq[ord('N')] = peq[ord('n')] = np.uint64((1 << len(primer_seq)) - 1)
+
+    max_errors = int(len(primer_seq) * error_rate_arg) if max_errors_arg is None else max_errors_arg
+    return {'sequence': primer_seq, 'peq': peq, 'length': len(primer_seq), 'max_errors': max_errors, 'indels': indels_arg}
+def encode_reads(seqs_arg: list, width_arg: int = None) -> tuple:
+    """
+    Function packs read sequences into a zero-padded uint8 array for batch matching.
+
+    Parameters:
+        seqs_arg (list): read sequences (bytes)
+        width_arg (int): number of columns to keep, longer reads are truncated (default: longest read)
+
+    Returns:
+        (tuple): (n_reads x width) uint8 array of reads, int32 array of read lengths
+    """
+    lengths = np.fromiter((len(seq) for seq in seqs_arg), dtype=np.int32, count=len(seqs_arg))
+    width = int(lengths.max(initial=0)) if width_arg is None else width_arg
+    lengths = np.minimum(lengths, width)
+    reads = np.zeros((len(seqs_arg), width), dtype=np.uint8)
+    for row, seq in enumerate(seqs_arg):
+        reads[row, :lengths[row]] = np.frombuffer(seq, dtype=np.uint8, count=lengths[row])
+    return reads, lengths
+def find_primer_ends(primer_arg: dict, reads_arg: np.ndarray, lengths_arg: np.ndarray = None, search_width_arg: int = None) -> tuple:
+    """
+    Function searches every read in a batch for a compiled primer.
+
+    The best match is the one with the fewest errors; among equally good matches the first one is kept,
+    but it may extend by one base if the score holds (so a mismatch in the last primer base is preferred
+    over deleting it).
+
+    Parameters:
+        primer_arg (dict): compiled primer from compile_primer()
+        reads_arg (np.ndarray): (n_reads x width) uint8 array of reads from encode_reads()
+        lengths_arg (np.ndarray): length of each read (default: every read fills the width)
+        search_width_arg (int): only search for primers ending in the first N bases of each read
+
+    Returns:
+        (tuple): int32 array of positions just past the best match (-1 if no match), int16 array of errors
+    """
+    n_reads, width = reads_arg.shape
+    if search_width_arg is not None:
+        width = min(width, search_width_arg)
+    lengths = np.full(n_reads, width, dtype=np.int32) if lengths_arg is None else lengths_arg
+
+    best_end = np.full(n_reads, -1, dtype=np.int32)
+    best_score = np.full(n_reads, primer_arg['max_errors'] + 1, dtype=np.int16)
+    if not n_reads:
+        return best_end, best_score
+
+    if primer_arg['indels']:
+        column_scores = _myers_columns(primer_arg, reads_arg, width)
+    else:
+        column_scores = _hamming_columns(primer_arg, reads_arg, width)
+
+    extendable = np.zeros(n_reads, dtype=bool)
+    for column, score in enumerate(column_scores):
+        in_read = column < lengths
+        improved = in_read & (score < best_score)
+        extended = in_read & ~improved & extendable & (score == best_score) & (best_end == column)
+        best_score[improved] = score[improved]
+        best_end[improved] = column + 1
+        best_end[extended] = column + 1
+        extendable = improved
+    best_score[best_end < 0] = -1
+    return best_end, best_score
+def _myers_columns(primer_arg: dict, reads_arg: np.ndarray, width_arg: int):
+    """
+    Function yields the edit distance of the best primer alignment ending at each read column (Myers, 1999).
+
+    Parameters:
+        primer_arg (dict): compiled primer from compile_primer()
+        reads_arg (np.ndarray): (n_reads x width) uint8 array of reads
+        width_arg (int): number of columns to search
+
+    Returns:
+        (np.ndarray): int16 array of edit distances, one per read, for each column
+    """
+    n_reads = reads_arg.shape[0]
+    one = np.uint64(1)
+    mask = np.uint64((1 << primer_arg['length']) - 1)
+    high_bit = np.uint64(1 << (primer_arg['length'] - 1))
+
+    positive_vector = np.full(n_reads, mask, dtype=np.uint64)
+    negative_vector = np.zeros(n_reads, dtype=np.uint64)
+    score = np.full(n_reads, primer_arg['length'], dtype=np.int16)
+    for column in range(width_arg):
+        eq = primer_arg['peq'][reads_arg[:, column]]
+        x_vertical = eq | negative_vector
+        x_horizontal = (((eq & positive_vector) + positive_vector) ^ positive_vector) | eq
+        positive_horizontal = negative_vector | (~(x_horizontal | positive_vector) & mask)
+        negative_horizontal = positive_vector & x_horizontal
+        score += (positive_horizontal & high_bit).astype(bool)
+        score -= (negative_horizontal & high_bit).astype(bool)
+        positive_horizontal = (positive_horizontal << one) & mask
+        negative_horizontal = (negative_horizontal << one) & mask
+        positive_vector = negative_horizontal | (~(x_vertical | positive_horizontal) & mask)
+        negative_vector = positive_horizontal & x_vertical
+        yield score
+def _hamming_columns(primer_arg: dict, reads_arg: np.ndarray, width_arg: int):
+    """
+    Function yields the mismatches of the best ungapped primer alignment ending at each read column (shift-and).
+
+    Parameters:
+        primer_arg (dict): compiled primer from compile_primer()
+        reads_arg (np.ndarray): (n_reads x width) uint8 array of reads
+        width_arg (int): number of columns to search
+
+    Returns:
+        (np.ndarray): int16 array of mismatches (max_errors + 1 if none are close enough), one per read, for each column
+    """
+    n_reads = reads_arg.shape[0]
+    one = np.uint64(1)
+    high_bit = np.uint64(1 << (primer_arg['length'] - 1))
+
+    # states[d] has bit i set if primer[:i+1] ends here with at most d mismatches
+    states = np.zeros((primer_arg['max_errors'] + 1, n_reads), dtype=np.uint64)
+    for column in range(width_arg):
+        eq = primer_arg['peq'][reads_arg[:, column]]
+        previous_state = np.zeros(n_reads, dtype=np.uint64)
+        score = np.full(n_reads, primer_arg['max_errors'] + 1, dtype=np.int16)
+        for errors in range(primer_arg['max_errors'] + 1):
+            shifted = (states[errors] << one) | one
+            states[errors] = (shifted & eq) | previous_state
+            previous_state = shifted
+            score[((states[errors] & high_bit) != 0) & (score > errors)] = errors
+        yield score
+def build_prefix_index(primers_arg: list, k_arg: int = 6) -> dict:
+    """
+    Function indexes the first k bases of each primer, expanded over IUPAC codes.
+
+    Parameters:
+        primers_arg (list): compiled primers from compile_primer()
+        k_arg (int): length of the indexed prefix (capped at the shortest primer)
+
+    Returns:
+        (dict): prefix index
+            k:      length of the indexed prefix
+            table:  (4**k x n_primers) bool array, True if the k-mer can start the primer
+    """
+    k = min([k_arg] + [primer['length'] for primer in primers_arg])
+    table = np.zeros((4 ** k, len(primers_arg)), dtype=bool)
+    for primer_index, primer in enumerate(primers_arg):
+        kmer_codes = np.zeros(1, dtype=np.int64)
+        for primer_base in primer['sequence'][:k]:
+            base_codes = np.array([_BASE_CODES[ord(base)] for base in IUPAC_CODES[primer_base]], dtype=np.int64)
+            kmer_codes = (kmer_codes[:, None] * 4 + base_codes[None, :]).ravel()
+        table[kmer_codes, primer_index] = True
+    return {'k': k, 'table': table}
+def prefix_candidates(index_arg: dict, reads_arg: np.ndarray, lengths_arg: np.ndarray = None, max_offset_arg: int = 8) -> np.ndarray:
+    """
+    Function looks up which primers could start at each of the first positions of every read.
+
+    A k-mer containing anything other than A/C/G/T (e.g. an N) could start any primer. Primers with an
+    error in their first k bases are not found, so callers should still fall back to the other primers
+    for reads that none of their candidates match.
+
+    Parameters:
+        index_arg (dict): prefix index from build_prefix_index()
+        reads_arg (np.ndarray): (n_reads x width) uint8 array of reads from encode_reads()
+        lengths_arg (np.ndarray): length of each read (default: every read fills the width)
+        max_offset_arg (int): largest primer start position to look up (ex: phasing spacer length)
+
+    Returns:
+        (np.ndarray): (n_reads x n_primers) bool array of candidate primers
+    """
+    k = index_arg['k']
+    n_reads, width = reads_arg.shape
+    lengths = np.full(n_reads, width, dtype=np.int32) if lengths_arg is None else lengths_arg
+    candidates = np.zeros((n_reads, index_arg['table'].shape[1]), dtype=bool)
+
+    base_codes = _BASE_CODES[reads_arg[:, :min(width, max_offset_arg + k)]]
+    for offset in range(min(max_offset_arg, width - k) + 1):
+        window = base_codes[:, offset:offset + k]
+        in_read = lengths >= offset + k
+        ambiguous = in_read & (window == 255).any(axis=1)
+        kmer_codes = np.zeros(n_reads, dtype=np.int64)
+        for column in range(k):
+            kmer_codes = kmer_codes * 4 + (window[:, column] & 3)
+        candidates[in_read & ~ambiguous] |= index_arg['table'][kmer_codes[in_read & ~ambiguous]]
+        candidates[ambiguous] = True
+    return candidates
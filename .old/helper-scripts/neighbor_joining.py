@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+"""
+Purpose: Neighbor joining (Saitou & Nei, 1987) on a condensed distance matrix, with a RapidNJ-style search.
+
+The Q-matrix minimum of every iteration is searched through rows of column indexes sorted by distance (built
+once per row, as in RapidNJ), so a row can be abandoned as soon as
+    d(i, j) * (n - 2) - sum(i) - max(sum)
+is larger than the best Q value found so far. Every sorted row is split into buckets of columns with similar
+distance sums, and a bucket is bounded with the largest sum of its own columns instead of max(sum) (a row sorted
+by distance alone is also sorted by sum when distances are mostly additive, and hardly prunes). All buckets are
+searched at once, a window of sorted columns at a time, on NumPy arrays. Joins update the condensed matrix in
+place, and the tree is written as Newick directly.
+
+Joins, branch lengths and tie-breaking follow skbio.tree.nj() (0.6.3+), so both give the same tree.
+"""
+__author__ = "Erick Samera"
+__version__ = "1.0.0"
+__comment__ = 'stable'
+
+# --------------------------------------------------
+import numpy as np
+# --------------------------------------------------
+# buckets (of columns with similar distance sums) every sorted row is split into
+SUM_BUCKETS: int = 8
+# sorted columns of every bucket examined at first, later windows of a bucket double in size
+SEARCH_WINDOW: int = 8
+# buckets with the lowest bounds, their nearest columns give a Q value to prune the other buckets with
+SEED_BUCKETS: int = 64
+# all rows are sorted again when the live taxa/clusters are down to this fraction of the last sort
+# (columns of joined taxa/clusters pile up in old rows, and their bucket sums get loose)
+REBUILD_FRACTION: float = 0.85
+# distances gathered at a time when rows are sorted
+SORT_BLOCK_CELLS: int = 1 << 22
+# characters that make a Newick label quoted (same as skbio)
+_NEWICK_OPERATORS: frozenset = frozenset(",:_;()[]")
+# --------------------------------------------------
+class _SortedRows:
+    """
+    Columns (slots) of every row of the distance matrix, in buckets of similar distance sums and sorted by
+    distance within a bucket. A column is current while its taxon/cluster is live and unchanged since the row
+    was built (columns of later clusters are only in the rows of the later clusters).
+
+    Parameters:
+        n_taxa_arg (int): number of taxa (slots)
+        columns_arg (np.ndarray): N x N array of sorted_columns_dtype() to keep the columns in, allocated if None
+    """
+    def __init__(self, n_taxa_arg: int, columns_arg: np.ndarray = None) -> None:
+        if columns_arg is None:
+            columns_arg = np.empty((n_taxa_arg, n_taxa_arg), dtype=sorted_columns_dtype(n_taxa_arg))
+        elif columns_arg.shape != (n_taxa_arg, n_taxa_arg) or columns_arg.dtype != sorted_columns_dtype(n_taxa_arg):
+            raise ValueError(f'Sorted columns of {n_taxa_arg} taxa must be a {n_taxa_arg} x {n_taxa_arg} {np.dtype(sorted_columns_dtype(n_taxa_arg)).name} array.')
+        self.columns = columns_arg
+        self.built_at = np.zeros(n_taxa_arg, dtype=np.int64)
+        # iteration all live rows were last built at (their pairs are in both rows)
+        self.rebuilt_at = 0
+        # sum decrease (see nj_linkage()) when every row was built
+        self.built_decrease = np.zeros(n_taxa_arg, dtype=np.float64)
+        # first column of every bucket that may still be current, end of every bucket
+        self.starts = np.zeros((n_taxa_arg, SUM_BUCKETS), dtype=np.int64)
+        self.ends = np.zeros((n_taxa_arg, SUM_BUCKETS), dtype=np.int64)
+        # distance no current column of a bucket is closer than, largest sum of its columns when it was built
+        self.floors = np.full((n_taxa_arg, SUM_BUCKETS), np.inf)
+        self.caps = np.full((n_taxa_arg, SUM_BUCKETS), -np.inf)
+    def build(self, slots_arg: np.ndarray, iteration_arg: int, column_slots_arg: np.ndarray, distances_arg: np.ndarray,
+              column_sums_arg: np.ndarray, sum_decrease_arg: float) -> None:
+        """
+        Function sorts the rows of taxa/clusters (their own column included, at an infinite distance).
+
+        Parameters:
+            slots_arg (np.ndarray): slots of the taxa/clusters
+            iteration_arg (int): number of joins so far
+            column_slots_arg (np.ndarray): slots of the live taxa/clusters
+            distances_arg (np.ndarray): rows x columns distances
+            column_sums_arg (np.ndarray): distance sums of the columns
+            sum_decrease_arg (float): sum decrease so far
+
+        Returns:
+            None
+        """
+        n_columns = column_slots_arg.size
+        buckets = np.empty(n_columns, dtype=np.int64)
+        buckets[np.argsort(column_sums_arg, kind='stable')] = np.arange(n_columns) * SUM_BUCKETS // n_columns
+        bucket_order = np.argsort(buckets, kind='stable')
+        counts = np.bincount(buckets, minlength=SUM_BUCKETS)
+        ends = np.cumsum(counts)
+        starts = ends - counts
+        caps = np.full(SUM_BUCKETS, -np.inf)
+        np.maximum.at(caps, buckets, column_sums_arg)
+
+        bucket_slots = column_slots_arg[bucket_order]
+        bucket_distances = distances_arg[:, bucket_order]
+        floors = np.full((slots_arg.size, SUM_BUCKETS), np.inf)
+        for bucket in np.flatnonzero(counts).tolist():
+            order = np.argsort(bucket_distances[:, starts[bucket]:ends[bucket]], axis=1)
+            self.columns[slots_arg[:, None], np.arange(starts[bucket], ends[bucket])] = bucket_slots[starts[bucket]:ends[bucket]][order]
+            floors[:, bucket] = np.take_along_axis(bucket_distances[:, starts[bucket]:ends[bucket]], order[:, :1], axis=1)[:, 0]
+        self.starts[slots_arg] = starts
+        self.ends[slots_arg] = ends
+        self.floors[slots_arg] = floors
+        self.caps[slots_arg] = caps
+        self.built_at[slots_arg] = iteration_arg
+        self.built_decrease[slots_arg] = sum_decrease_arg
+        return None
+# --------------------------------------------------
+def neighbor_joining(distances_arg: np.ndarray, ids_arg: list, negative_as_zero_arg: bool = True) -> str:
+    """
+    Function builds the neighbor joining tree of a condensed distance matrix.
+
+    Parameters:
+        distances_arg (np.ndarray): condensed distance matrix (see scipy.spatial.distance.squareform), left unchanged
+        ids_arg (list): taxon names, in matrix order
+        negative_as_zero_arg (bool): write negative branch lengths as 0
+
+    Returns:
+        (str): unrooted tree in Newick format
+    """
+    return linkage_to_newick(nj_linkage(np.array(distances_arg, dtype=np.float64)), ids_arg, negative_as_zero_arg)
+def sorted_columns_dtype(n_taxa_arg: int) -> type:
+    """ Integer type of the sorted columns of N taxa (the index nj_linkage() keeps, N x N of them). """
+    return np.uint16 if n_taxa_arg <= np.iinfo(np.uint16).max + 1 else np.int32
+def nj_linkage(distances_arg: np.ndarray, columns_arg: np.ndarray = None) -> np.ndarray:
+    """
+    Function joins the taxa of a condensed distance matrix, overwriting the matrix.
+
+    Taxa are numbered 0..N-1 and the cluster made by row k of the linkage is N + k. Like skbio, the last row
+    attaches taxon/cluster c0 to the root (the cluster of the row before it) and the tree is unrooted.
+
+    Parameters:
+        distances_arg (np.ndarray): float64 condensed distance matrix of N >= 3 taxa (used as working space)
+        columns_arg (np.ndarray): N x N array of sorted_columns_dtype() for the sorted rows (e.g. memory-mapped),
+            allocated in memory if None
+
+    Returns:
+        (np.ndarray): (N - 1) x 4 linkage matrix of (cluster 1, cluster 2, branch length 1, branch length 2)
+    """
+    n_taxa = _taxa_count(distances_arg.size)
+    if n_taxa < 3:
+        raise ValueError(f'Neighbor joining needs at least 3 taxa ({n_taxa} given).')
+    dist = distances_arg
+
+    # taxa and clusters live in slots (rows of the condensed matrix), positions follow skbio's square matrix
+    # (the last position moves into the one freed by a join)
+    slot_at_position = np.arange(n_taxa)
+    position_of_slot = np.arange(n_taxa)
+    cluster_of_slot = np.arange(n_taxa)
+    row_offsets = _row_offsets(n_taxa)
+    sums = _column_sums(dist, row_offsets)
+
+    # every join decreases every sum by at least the sum decrease (of that join), which keeps the largest sums
+    # of the buckets built before it bounding the current sums
+    sum_decrease = 0.0
+    sorted_rows = _SortedRows(n_taxa, columns_arg)
+    _sort_rows(dist, row_offsets, sorted_rows, slot_at_position, sums, 0, sum_decrease)
+    rebuilt_n = n_taxa
+
+    linkage = np.empty((n_taxa - 1, 4), dtype=np.float64)
+    n = n_taxa
+    while n > 3:
+        i, j = _find_pair(dist, row_offsets, n, sums, slot_at_position, position_of_slot, sorted_rows, sum_decrease)
+        slot_i, slot_j = int(slot_at_position[i]), int(slot_at_position[j])
+        live_slots = slot_at_position[:n]
+
+        # same arithmetic as skbio's square matrix, one position at a time
+        d_ij_ = dist[_pair_index(row_offsets, slot_i, slot_j)] / 2
+        half_sums = _row(dist, row_offsets, slot_i, live_slots, i) + _row(dist, row_offsets, slot_j, live_slots, j)
+        half_sums /= 2
+        delta_ = (sums[i] - sums[j]) / (2 * n - 4)
+        linkage[n_taxa - n] = cluster_of_slot[slot_i], cluster_of_slot[slot_j], d_ij_ + delta_, d_ij_ - delta_
+        sums[:n] -= half_sums
+        sums[:n] -= d_ij_
+        new_row = half_sums - d_ij_
+
+        # the cluster takes slot i, the last position moves to j
+        others = np.ones(n, dtype=bool)
+        others[[i, j]] = False
+        sum_decrease += (half_sums[others] + d_ij_).min()
+        dist[_pair_index(row_offsets, slot_i, live_slots[others])] = new_row[others]
+        new_row[j] = new_row[n - 1]
+        sums[j] = sums[n - 1]
+        sums[i] = new_row[:n - 1].sum()
+        slot_at_position[j] = slot_at_position[n - 1]
+        position_of_slot[slot_at_position[j]] = j
+        position_of_slot[slot_j] = -1
+        cluster_of_slot[slot_i] = 2 * n_taxa - n
+        n -= 1
+
+        if n <= rebuilt_n * REBUILD_FRACTION and n > 3:
+            _sort_rows(dist, row_offsets, sorted_rows, slot_at_position[:n], sums[:n], n_taxa - n, sum_decrease)
+            rebuilt_n = n
+        else:
+            new_row[i] = np.inf
+            sorted_rows.build(np.array([slot_i]), n_taxa - n, slot_at_position[:n], new_row[None, :n], sums[:n], sum_decrease)
+
+    # the last three taxa/clusters are joined at the root
+    slot_0, slot_1, slot_2 = slot_at_position[:3].tolist()
+    d_01, d_02, d_12 = (dist[_pair_index(row_offsets, slot_a, slot_b)] for slot_a, slot_b in ((slot_0, slot_1), (slot_0, slot_2), (slot_1, slot_2)))
+    l_0 = (d_01 + d_02 - d_12) / 2
+    linkage[n_taxa - 3] = cluster_of_slot[slot_1], cluster_of_slot[slot_2], d_01 - l_0, d_02 - l_0
+    linkage[n_taxa - 2] = cluster_of_slot[slot_0], 2 * n_taxa - 3, l_0, 0
+    return linkage
+def linkage_to_newick(linkage_arg: np.ndarray, ids_arg: list, negative_as_zero_arg: bool = True) -> str:
+    """
+    Function writes a neighbor joining linkage matrix (see nj_linkage()) as an unrooted Newick tree.
+
+    Labels and lengths are written the way skbio writes a TreeNode, so the output matches str(skbio.tree.nj()).
+
+    Parameters:
+        linkage_arg (np.ndarray): linkage matrix
+        ids_arg (list): taxon names
+        negative_as_zero_arg (bool): write negative branch lengths as 0
+
+    Returns:
+        (str): tree in Newick format
+    """
+    n_taxa = len(ids_arg)
+    if linkage_arg.shape[0] != n_taxa - 1:
+        raise ValueError(f'A linkage matrix of {linkage_arg.shape[0]} rows does not fit {n_taxa} taxa.')
+
+    def _length(length_arg: float) -> str:
+        return str(float(length_arg)) if length_arg >= 0 or not negative_as_zero_arg else '0.0'
+
+    # children (cluster, branch length) of every cluster, the root has three
+    children: dict = {
+        n_taxa + row: ((int(cluster_1), length_1), (int(cluster_2), length_2))
+        for row, (cluster_1, cluster_2, length_1, length_2) in enumerate(linkage_arg[:-2].tolist())}
+    (cluster_0, _, length_0, _), (cluster_1, cluster_2, length_1, length_2) = linkage_arg[-1].tolist(), linkage_arg[-2].tolist()
+    root_children = ((int(cluster_0), length_0), (int(cluster_1), length_1), (int(cluster_2), length_2))
+
+    # depth-first, without recursion (trees of thousands of taxa can be as deep), -1 closes a cluster
+    newick_parts: list = ['(']
+    stack: list = [(-1, None, True)] + [(child, length, index == 0) for index, (child, length) in reversed(list(enumerate(root_children)))]
+    while stack:
+        cluster, length, first_child = stack.pop()
+        if cluster < 0:
+            newick_parts.append(')' if length is None else f'):{_length(length)}')
+            continue
+        if not first_child:
+            newick_parts.append(',')
+        if cluster < n_taxa:
+            newick_parts.append(f'{_newick_label(str(ids_arg[cluster]))}:{_length(length)}')
+        else:
+            newick_parts.append('(')
+            stack.append((-1, length, True))
+            stack += [(child, child_length, index == 0) for index, (child, child_length) in reversed(list(enumerate(children[cluster])))]
+    return ''.join(newick_parts) + ';\n'
+# --------------------------------------------------
+def _find_pair(dist_arg: np.ndarray, row_offsets_arg: np.ndarray, n_arg: int, sums_arg: np.ndarray, slot_at_position_arg: np.ndarray,
+               position_of_slot_arg: np.ndarray, sorted_rows_arg: _SortedRows, sum_decrease_arg: float) -> tuple:
+    """
+    Function finds the positions (i < j) of the minimum of the Q-matrix
+        Q(i, j) = (n - 2) d(i, j) - sum(i) - sum(j)
+    among the live taxa/clusters. Pairs within rounding of the minimum are compared the way skbio's
+    nj_minq_cy() does, so ties and near-ties go to the same pair.
+
+    Parameters:
+        dist_arg (np.ndarray): condensed distance matrix (by slot)
+        row_offsets_arg (np.ndarray): condensed matrix offsets (see _row_offsets())
+        n_arg (int): number of live taxa/clusters
+        sums_arg (np.ndarray): distance sums (by position)
+        slot_at_position_arg, position_of_slot_arg (np.ndarray): slot of every position and position of every slot (-1 if joined)
+        sorted_rows_arg (_SortedRows): sorted rows
+        sum_decrease_arg (float): sum decrease so far
+
+    Returns:
+        (tuple): positions i, j
+    """
+    n_taxa = row_offsets_arg.size
+    n_2 = n_arg - 2.0
+    built_at = sorted_rows_arg.built_at
+    live_slots = slot_at_position_arg[:n_arg]
+    max_sum = sums_arg[:n_arg].max()
+    rounding = 16 * np.finfo(np.float64).eps
+    sums_scale = 4 * np.abs(sums_arg[:n_arg]).max()
+    best_q = np.inf
+    near_best: list = []
+
+    # bound of every bucket: its largest sum when it was built, less the sum decrease since
+    # (a pair of rows sorted together is in both rows and only counted in the one with the larger sum,
+    # so these rows can't reach a column with a larger sum than their own)
+    unit_sums = np.repeat(sums_arg[:n_arg], SUM_BUCKETS)
+    unit_originals = np.repeat(built_at[live_slots] == sorted_rows_arg.rebuilt_at, SUM_BUCKETS)
+    units = (live_slots[:, None] * SUM_BUCKETS + np.arange(SUM_BUCKETS)).ravel()
+    unit_caps = sorted_rows_arg.caps.ravel()[units] - (sum_decrease_arg - np.repeat(sorted_rows_arg.built_decrease[live_slots], SUM_BUCKETS))
+    unit_caps = np.minimum(unit_caps + n_taxa * rounding * sums_scale, max_sum)
+    unit_caps = np.where(unit_originals, np.minimum(unit_caps, unit_sums), unit_caps)
+    unit_bounds = sorted_rows_arg.floors.ravel()[units] * n_2 - unit_sums - unit_caps
+
+    # the nearest columns of the buckets with the lowest bounds give a Q value the search has to reach,
+    # buckets that can't reach it are skipped
+    seeds = np.argpartition(unit_bounds, SEED_BUCKETS)[:SEED_BUCKETS] if units.size > SEED_BUCKETS else np.arange(units.size)
+    seeds = seeds[np.isfinite(unit_bounds[seeds])]
+    seed_slots = units[seeds] // SUM_BUCKETS
+    seed_starts = sorted_rows_arg.starts.ravel()[units[seeds]]
+    seed_columns = sorted_rows_arg.columns[seed_slots, np.minimum(seed_starts, n_taxa - 1)].astype(np.int64)
+    seed_positions = position_of_slot_arg[seed_columns]
+    seed_current = (seed_positions >= 0) & (built_at[seed_columns] <= built_at[seed_slots]) & (seed_columns != seed_slots)
+    if seed_current.any():
+        seed_slots, seed_columns, seed_positions = seed_slots[seed_current], seed_columns[seed_current], seed_positions[seed_current]
+        best_q = (dist_arg[_pair_index(row_offsets_arg, seed_slots, seed_columns)] * n_2 - sums_arg[position_of_slot_arg[seed_slots]] - sums_arg[seed_positions]).min()
+        searched = np.flatnonzero(unit_bounds <= best_q + 2 * rounding * (abs(best_q) + sums_scale))
+    else:
+        searched = np.flatnonzero(np.isfinite(unit_bounds))
+    caps, originals, units = unit_caps[searched], unit_originals[searched], units[searched]
+    rows = units // SUM_BUCKETS
+    starts, ends = sorted_rows_arg.starts.ravel()[units], sorted_rows_arg.ends.ravel()[units]
+    width = SEARCH_WINDOW
+    first_window = True
+    while rows.size:
+        columns = starts[:, None] + np.arange(width)
+        in_bucket = columns < ends[:, None]
+        column_slots = sorted_rows_arg.columns.ravel()[rows[:, None] * n_taxa + np.minimum(columns, n_taxa - 1)].astype(np.int64)
+        # a column is current if its taxon/cluster is live and has not changed since the row was built
+        # (the distances of the others are read from somewhere in the matrix and ignored)
+        column_positions = position_of_slot_arg[column_slots]
+        current = in_bucket & (column_positions >= 0) & (built_at[column_slots] <= built_at[rows][:, None]) & (column_slots != rows[:, None])
+        distances = dist_arg[_pair_index(row_offsets_arg, rows[:, None], column_slots)]
+
+        row_positions = position_of_slot_arg[rows]
+        row_sums = sums_arg[row_positions][:, None]
+        column_sums = sums_arg[np.maximum(column_positions, 0)]
+        valid = current & (~originals[:, None] | (column_sums < row_sums) | ((column_sums == row_sums) & (column_slots < rows[:, None])))
+        low_positions = np.minimum(row_positions[:, None], column_positions)
+        high_positions = np.maximum(row_positions[:, None], column_positions)
+        q_values = distances * n_2
+        q_values -= sums_arg[high_positions]
+        q_values -= sums_arg[low_positions]
+        q_values[~valid] = np.inf
+        best_q = min(best_q, q_values.min())
+        tolerance = rounding * (abs(best_q) + sums_scale) if np.isfinite(best_q) else np.inf
+        near = valid & (q_values <= best_q + tolerance)
+        near_best.append((q_values[near], low_positions[near] * n_arg + high_positions[near], distances[near]))
+
+        if first_window:
+            # columns in front of the first current one are never current again, and the bucket never gets closer
+            any_current = current.any(axis=1)
+            first_current = current.argmax(axis=1)
+            sorted_rows_arg.starts.ravel()[units] += np.where(any_current, first_current, in_bucket.sum(axis=1))
+            sorted_rows_arg.floors.ravel()[units[any_current]] = distances[any_current, first_current[any_current]]
+            sorted_rows_arg.floors.ravel()[units[~any_current & (starts + width >= ends)]] = np.inf
+            first_window = False
+
+        # buckets whose later (farther) columns can still reach the best Q value
+        last_distances = distances.max(axis=1, where=current, initial=-np.inf)
+        bounds = last_distances * n_2 - row_sums[:, 0] - caps
+        has_more = (starts + width < ends) & (~current.any(axis=1) | (bounds <= best_q + 2 * tolerance))
+        rows, units, starts, ends, caps, originals = rows[has_more], units[has_more], starts[has_more] + width, ends[has_more], caps[has_more], originals[has_more]
+        width *= 2
+
+    q_values, keys, distances = (np.concatenate(values) for values in zip(*near_best))
+    near = q_values <= best_q + rounding * (abs(best_q) + sums_scale)
+    keys, first_keys = np.unique(keys[near], return_index=True)
+    if keys.size == 1:
+        return divmod(int(keys[0]), n_arg)
+
+    # same comparisons as skbio's row-major scan, which only ever changes its pick among these pairs
+    min_q, best_key, row = np.inf, None, -1
+    for key, distance in zip(keys.tolist(), distances[near][first_keys].tolist()):
+        low, high = divmod(key, n_arg)
+        if low != row:
+            min_q_plus, row = min_q + float(sums_arg[low]), low
+        q_plus = distance * n_2 - float(sums_arg[high])
+        if q_plus < min_q_plus:
+            min_q_plus, min_q, best_key = q_plus, q_plus - float(sums_arg[low]), key
+    return divmod(best_key, n_arg)
+def _sort_rows(dist_arg: np.ndarray, row_offsets_arg: np.ndarray, sorted_rows_arg: _SortedRows, live_slots_arg: np.ndarray,
+               live_sums_arg: np.ndarray, iteration_arg: int, sum_decrease_arg: float) -> None:
+    """
+    Function sorts the rows of all live taxa/clusters, a block of rows at a time.
+
+    Parameters:
+        dist_arg (np.ndarray): condensed distance matrix (by slot)
+        row_offsets_arg (np.ndarray): condensed matrix offsets (see _row_offsets())
+        sorted_rows_arg (_SortedRows): sorted rows
+        live_slots_arg, live_sums_arg (np.ndarray): slots and distance sums of the live taxa/clusters (by position)
+        iteration_arg (int): number of joins so far
+        sum_decrease_arg (float): sum decrease so far
+
+    Returns:
+        None
+    """
+    block_size = max(1, SORT_BLOCK_CELLS // live_slots_arg.size)
+    for block_start in range(0, live_slots_arg.size, block_size):
+        block_slots = live_slots_arg[block_start:block_start + block_size]
+        column_slots = np.where(block_slots[:, None] == live_slots_arg, (block_slots[:, None] + 1) % row_offsets_arg.size, live_slots_arg)
+        distances = dist_arg[_pair_index(row_offsets_arg, block_slots[:, None], column_slots)]
+        distances[block_slots[:, None] == live_slots_arg] = np.inf
+        sorted_rows_arg.build(block_slots, iteration_arg, live_slots_arg, distances, live_sums_arg, sum_decrease_arg)
+    sorted_rows_arg.rebuilt_at = iteration_arg
+    return None
+def _row(dist_arg: np.ndarray, row_offsets_arg: np.ndarray, slot_arg: int, live_slots_arg: np.ndarray, position_arg: int) -> np.ndarray:
+    """ Distances of a slot to the live slots, in position order (0 at its own position). """
+    others = live_slots_arg.copy()
+    others[position_arg] = 1 if slot_arg == 0 else 0
+    row = dist_arg[_pair_index(row_offsets_arg, slot_arg, others)]
+    row[position_arg] = 0.0
+    return row
+def _column_sums(dist_arg: np.ndarray, row_offsets_arg: np.ndarray) -> np.ndarray:
+    """ Distance sums of every taxon, added up row by row like the column sums of a square matrix. """
+    n_taxa = row_offsets_arg.size
+    sums = np.zeros(n_taxa, dtype=np.float64)
+    taxa = np.arange(n_taxa)
+    for slot in range(n_taxa):
+        row = dist_arg[_pair_index(row_offsets_arg, slot, np.where(taxa == slot, (slot + 1) % n_taxa, taxa))]
+        row[slot] = 0.0
+        sums += row
+    return sums
+def _pair_index(row_offsets_arg: np.ndarray, slot_a_arg, slot_b_arg):
+    """ Index of the distance between two (different) slots in a condensed matrix. """
+    return row_offsets_arg[np.minimum(slot_a_arg, slot_b_arg)] + np.maximum(slot_a_arg, slot_b_arg)
+def _row_offsets(n_taxa_arg: int) -> np.ndarray:
+    """ Offsets of the rows of a condensed matrix, so that the distance of slots a < b is at offset[a] + b. """
+    slots = np.arange(n_taxa_arg, dtype=np.int64)
+    return slots * n_taxa_arg - slots * (slots + 1) // 2 - slots - 1
+def _taxa_count(condensed_size_arg: int) -> int:
+    """ Number of taxa of a condensed matrix. """
+    n_taxa = int(round((1 + np.sqrt(1 + 8 * condensed_size_arg)) / 2))
+    if n_taxa * (n_taxa - 1) // 2 != condensed_size_arg:
+        raise ValueError(f'{condensed_size_arg} distances are not a condensed distance matrix.')
+    return n_taxa
+def _newick_label(label_arg: str) -> str:
+    """ Taxon name as a Newick label (quoted if it contains Newick operators, spaces as underscores otherwise). """
+    escaped = label_arg.replace("'", "''")
+    if any(character in _NEWICK_OPERATORS for character in label_arg):
+        return f"'{escaped}'"
+    return escaped.replace(' ', '_')
@@ -2,9 +2,15 @@
 __description__ =\
 """
 Purpose: To generate a distance matrix and tree.
+
+The summed distances are computed a block of samples at a time and written to a float32 condensed matrix
+on disk (.npy, memory-mapped), so only one block is held in memory. The tree is built from that file. The
+matrix is kept with -d, or next to the input when it is larger than --max-memory, and is a temporary file
+otherwise. The working copy and sorted rows of the built-in engine are memory-mapped (temporary files) when
+they don't fit in --max-memory.
 """
 __author__ = "Erick Samera"
-__version__ = "1.0.0"
+__version__ = "1.5.0"
 __comments__ = "stable"
 # =============================================================================
 from argparse import (
@@ -13,9 +19,22 @@ from argparse import (
     RawTextHelpFormatter)
 from pathlib import Path
 # =============================================================================
+import csv
+import tempfile
+# =============================================================================
 import numpy as np
-from skbio import DistanceMatrix
-from skbio.tree import nj
+from scipy.spatial.distance import cdist
+# =============================================================================
+from neighbor_joining import (
+    nj_linkage,
+    linkage_to_newick,
+    sorted_columns_dtype)
+# =============================================================================
+# bytes of memory a distance cell of a block takes (cdist float64, mask, selected float64, float32 copy)
+_BLOCK_CELL_BYTES: int = 24
+# samples from which the built-in neighbor joining engine is used instead of skbio (--engine auto), where it
+# got faster than skbio on clade-structured profiles (benchmark_neighbor_joining.py: 0.86x at 2500, 1.14x at 3000)
+ENGINE_MIN_SAMPLES: int = 3000
 # =============================================================================
 def get_args() -> Namespace:
     """ Get command-line arguments """
@@ -29,70 +48,160 @@ def get_args() -> Namespace:
         metavar="PATH",
         type=Path,
         help=f"input summary .csv file")
+    parser.add_argument('-d', '--distances',
+        dest='distances_path',
+        metavar="PATH",
+        type=Path,
+        default=None,
+        help=f"float32 condensed distance matrix .npy file to keep (default: a temporary file, or\n"
+             f"<input>.distances.npy if the matrix is larger than --max-memory)")
+    parser.add_argument('-m', '--max-memory',
+        dest='max_memory',
+        metavar="MB",
+        type=int,
+        default=1024,
+        help=f"memory the distance matrices may use, larger matrices are built in blocks and joined on disk\n"
+             f"(temporary files go to TMPDIR, or next to the kept distance matrix)")
+    parser.add_argument('-e', '--engine',
+        dest='engine',
+        choices=['auto', 'skbio', 'builtin'],
+        default='auto',
+        help=f"neighbor joining engine, auto: skbio below {ENGINE_MIN_SAMPLES} samples (or if it isn't installed),\n"
+             f"the built-in one from there (it is only faster on tree-like data, use skbio for unstructured profiles)")
 
     args = parser.parse_args()
     # parser errors and processing
     # --------------------------------------------------
+    if args.max_memory < 1: parser.error("--max-memory must be at least 1.")
 
     return args
 # =============================================================================
-def _sum_matrices(_input_summary_dict: dict) -> np.array:
+def _read_summary(_input_file: Path) -> tuple:
     """
-    Function sums the input and returns a summed aray.
-    """    
-    initialized_matrix: list = [[0*53]*53]
-    for matrix in _input_summary_dict.values():
-        initialized_matrix += matrix
-    return initialized_matrix
-def _create_distance_matrix(_input_dict: dict) -> list:
+    Function reads a summary .csv file (from summarize-amr-finder.py) in one pass.
+
+    Returns:
+        (tuple): list of samples, float32 array of (samples x genes) values
     """
-    Create a distance matrix from a dictionary of {sample: value}.
+    with open(_input_file, encoding='UTF-8', newline='') as input_file:
+        csv_reader = csv.reader(input_file)
+        header: list = next(csv_reader, [])
+        rows: list = [row for row in csv_reader if row and row[0]]
+    samples_list: list = [row[0] for row in rows]
+    summary_values = np.asarray([row[1:] for row in rows], dtype=np.float32).reshape(len(rows), max(len(header) - 1, 0))
+    return samples_list, summary_values
+def _summed_distances(_summary_values: np.ndarray, _distances_path: Path, _max_bytes: int) -> np.memmap:
     """
-    matrix = []
-    for key1, value1 in _input_dict.items():
-        distances = []
-        for key2, value2 in _input_dict.items():
-            distances.append(abs(float(value1)-float(value2)))
-        matrix.append(distances)
-    return np.array(matrix)
-def _get_samples(_input_file: Path) -> list:
+    Function sums the |a - b| distances of every gene between every pair of samples (the Manhattan distance),
+    a block of samples at a time, into a memory-mapped file.
+
+    Parameters:
+        _summary_values (np.ndarray): (samples x genes) values
+        _distances_path (Path): .npy file to write
+        _max_bytes (int): memory a block may use
+
+    Returns:
+        (np.memmap): float32 condensed distance matrix (see scipy.spatial.distance.squareform)
     """
-    Function returns a list of samples.
+    n_samples: int = len(_summary_values)
+    summed_distances = np.lib.format.open_memmap(_distances_path, mode='w+', dtype=np.float32, shape=(n_samples * (n_samples - 1) // 2,))
+    block_cells: int = max(_max_bytes // _BLOCK_CELL_BYTES, 1)
+
+    # the pairs of consecutive samples (rows) are consecutive in the condensed matrix
+    start, offset = 0, 0
+    while start < n_samples - 1:
+        stop: int = min(start + max(block_cells // (n_samples - start - 1), 1), n_samples - 1)
+        block = cdist(_summary_values[start:stop], _summary_values[start + 1:], metric='cityblock')
+        block = block[~np.tri(*block.shape, k=-1, dtype=bool)]
+        summed_distances[offset:offset + len(block)] = block
+        start, offset = stop, offset + len(block)
+    summed_distances.flush()
+    return summed_distances
+def _working_distances(_summed_distances: np.memmap, _working_path: Path, _max_bytes: int) -> np.ndarray:
     """
-    samples_list: list = []
-    with open(_input_file, encoding='UTF-8') as input_file:
-        for line in input_file.readlines():
-            sample_id: str = line.split(',')[0]
-            if sample_id: samples_list.append(sample_id)
-    return samples_list
-def _generate_summary_matrix(args: Namespace) -> dict:
+    Function copies the distances into the float64 matrix the tree is built in (overwritten while joining),
+    memory-mapped when it is larger than the memory cap.
+
+    Parameters:
+        _summed_distances (np.memmap): float32 condensed distance matrix
+        _working_path (Path): .npy file to map the matrix to
+        _max_bytes (int): memory the matrix may use
+
+    Returns:
+        (np.ndarray): float64 condensed distance matrix
+    """
+    if _summed_distances.size * 8 <= _max_bytes:
+        return np.array(_summed_distances, dtype=np.float64)
+
+    working_distances = np.lib.format.open_memmap(_working_path, mode='w+', dtype=np.float64, shape=_summed_distances.shape)
+    block_cells: int = max(_max_bytes // 12, 1)
+    for start in range(0, _summed_distances.size, block_cells):
+        working_distances[start:start + block_cells] = _summed_distances[start:start + block_cells]
+    return working_distances
+def _sorted_columns(_n_samples: int, _columns_path: Path, _max_bytes: int) -> np.ndarray:
+    """
+    Function allocates the (samples x samples) sorted rows of the built-in engine (see nj_linkage()),
+    memory-mapped when they are larger than the memory left.
+
+    Parameters:
+        _n_samples (int): number of samples
+        _columns_path (Path): .npy file to map the sorted rows to
+        _max_bytes (int): memory the sorted rows may use
+
+    Returns:
+        (np.ndarray): empty sorted rows
+    """
+    columns_dtype = sorted_columns_dtype(_n_samples)
+    if _n_samples ** 2 * np.dtype(columns_dtype).itemsize <= _max_bytes:
+        return np.empty((_n_samples, _n_samples), dtype=columns_dtype)
+    return np.lib.format.open_memmap(_columns_path, mode='w+', dtype=columns_dtype, shape=(_n_samples, _n_samples))
+def _skbio_tree(_summed_distances: np.ndarray, _samples_list: list) -> str:
     """
-    Generate a summary table.
+    Function builds the neighbor joining tree with skbio.tree.nj() (ImportError if scikit-bio isn't installed).
+
+    Returns:
+        (str): tree in Newick format
     """
+    import warnings
+    from skbio import DistanceMatrix
+    from skbio.tree import nj
 
-    matrices: dict = {}
-    with open(args.input_path, encoding='UTF-8') as input_file:
-        header = [header_value.strip() for header_value in input_file.readline().strip().split(',') if header_value]
-        values = [line.strip() for line in input_file.readlines()]
-        for i, header_name in enumerate(header):
-            input_distance_matrix_dict = {}
-            for line in values:
-                sample_id = line.split(',')[0]
-                sample_value = line.split(',')[i+1]
-                input_distance_matrix_dict[sample_id] = sample_value
-            matrices[header_name] = _create_distance_matrix(input_distance_matrix_dict)
-    return matrices
+    with warnings.catch_warnings():
+        # nj() is deprecated in favour of a new signature since skbio 0.6.3, its output is the same
+        warnings.simplefilter('ignore', DeprecationWarning)
+        return str(nj(DistanceMatrix(np.asarray(_summed_distances, dtype=np.float64), _samples_list)))
 # =============================================================================
 def main() -> None:
     """ Insert docstring here """
     args = get_args()
     
-    samples_list = _get_samples(args.input_path)
-    matrices_dict: dict = _generate_summary_matrix(args)
-    summated_matrix: np.matrix = _sum_matrices(matrices_dict)
+    max_bytes: int = args.max_memory * 1024 ** 2
+
+    samples_list, summary_values = _read_summary(args.input_path)
+    n_samples: int = len(samples_list)
+    # the distance matrix is only kept (without -d) when it is too large to compute again cheaply
+    if not args.distances_path and n_samples * (n_samples - 1) // 2 * 4 > max_bytes:
+        args.distances_path = args.input_path.with_suffix('.distances.npy')
+
+    with tempfile.TemporaryDirectory(dir=args.distances_path.parent if args.distances_path else None) as temp_dir:
+        temp_path = Path(temp_dir)
+        summed_distances: np.memmap = _summed_distances(summary_values, args.distances_path or temp_path / 'distances.npy', max_bytes)
 
-    distance_matrix_object = DistanceMatrix(summated_matrix, samples_list)
-    neighbor_joining_tree = nj(distance_matrix_object, result_constructor=str)
+        use_skbio: bool = args.engine == 'skbio' or (args.engine == 'auto' and n_samples < ENGINE_MIN_SAMPLES)
+        if use_skbio:
+            try:
+                neighbor_joining_tree: str = _skbio_tree(summed_distances, samples_list)
+            except ImportError:
+                if args.engine == 'skbio': raise
+                use_skbio = False
+        if not use_skbio:
+            # the working matrix is searched at random and gets the memory first, the sorted rows are read in runs
+            working_distances: np.ndarray = _working_distances(summed_distances, temp_path / 'working.npy', max_bytes)
+            sorted_columns: np.ndarray = _sorted_columns(n_samples, temp_path / 'columns.npy',
+                max_bytes - (0 if isinstance(working_distances, np.memmap) else working_distances.nbytes))
+            neighbor_joining_tree: str = linkage_to_newick(nj_linkage(working_distances, sorted_columns), samples_list)
+            del working_distances, sorted_columns
+        del summed_distances
     print(neighbor_joining_tree)
     return None
 # =============================================================================
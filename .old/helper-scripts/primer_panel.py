@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Purpose: Load primer panels (.tsv/.toml) and compile them once into a cached binary (.npz) form.
+
+Panel files list one primer pair per region, in matching order:
+    .tsv:   header "region<TAB>forward<TAB>reverse<TAB>pool" (pool is optional), one region per line
+    .toml:  one table per region, ex:
+                [V1V2]
+                forward = "AGRGTTTGATYMTGGCTC"
+                reverse = "CTGCTGCCTYCCGTA"
+                pool = "1"
+
+Compiled panels (IUPAC bitmasks and prefix k-mer indexes from iupac_matcher.py) are cached by the
+sha256 of the panel content and the matching settings, so later runs only load a small .npz file.
+"""
+__author__ = "Erick Samera"
+__version__ = "1.0.0"
+__comment__ = 'stable'
+
+# --------------------------------------------------
+from pathlib import Path
+# --------------------------------------------------
+import hashlib
+import json
+import os
+# --------------------------------------------------
+import numpy as np
+from iupac_matcher import (
+    build_prefix_index,
+    compile_primer)
+# --------------------------------------------------
+# bump when the compiled layout (or anything in iupac_matcher that changes it) changes
+COMPILED_PANEL_VERSION: int = 1
+DEFAULT_CACHE_DIR: Path = Path(os.environ.get('XDG_CACHE_HOME', Path.home().joinpath('.cache'))).joinpath('metagenomics', 'primer-panels')
+# --------------------------------------------------
+def load_panel(panel_path_arg: Path) -> dict:
+    """
+    Function reads a primer panel from a .tsv or .toml file.
+
+    Parameters:
+        panel_path_arg (Path): path of the panel file
+
+    Returns:
+        (dict): primer panel
+            primers:    {region: {'forward': seq, 'reverse': seq}}, in matching order
+            pools:      {pool: [regions]}
+        (ValueError if a region is incomplete or a primer is not 1..64 IUPAC bases)
+    """
+    primers: dict = {}
+    pools: dict = {}
+    if panel_path_arg.suffix.lower() == '.toml':
+        import tomllib
+        with open(panel_path_arg, 'rb') as panel_file:
+            panel_entries = [dict(entry, region=region) for region, entry in tomllib.load(panel_file).items()]
+    else:
+        with open(panel_path_arg, 'r', encoding='utf8') as panel_file:
+            lines = [line.rstrip('\r\n').split('\t') for line in panel_file if line.strip() and not line.startswith('#')]
+        header = [column.strip().lower() for column in lines[0]]
+        panel_entries = [dict(zip(header, [value.strip() for value in line])) for line in lines[1:]]
+
+    for entry in panel_entries:
+        if not all(entry.get(column) for column in ('region', 'forward', 'reverse')):
+            raise ValueError(f"{panel_path_arg.name}: every region needs a region name, forward and reverse primer ({entry}).")
+        primers[entry['region']] = {'forward': entry['forward'].upper(), 'reverse': entry['reverse'].upper()}
+        for direction, primer_seq in primers[entry['region']].items():
+            try:
+                compile_primer(primer_seq)
+            except ValueError as error:
+                raise ValueError(f"{panel_path_arg.name}: {direction} primer of {entry['region']}: {error}") from error
+        if entry.get('pool'):
+            pools.setdefault(str(entry['pool']), []).append(entry['region'])
+    return {'primers': primers, 'pools': pools}
+def compile_panel(panel_arg: dict, error_rate_arg: float, prefix_k_arg: int, cache_dir_arg: Path = DEFAULT_CACHE_DIR) -> dict:
+    """
+    Function compiles every primer of a panel, or loads the compiled panel from the cache.
+
+    Parameters:
+        panel_arg (dict): primer panel from load_panel()
+        error_rate_arg (float): maximum fraction of errors allowed in a match
+        prefix_k_arg (int): length of the indexed primer prefixes
+        cache_dir_arg (Path): directory of cached compiled panels (None to disable caching)
+
+    Returns:
+        (dict): compiled panel
+            primers:        [(region, forward, reverse)] compiled primers, in matching order
+            prefix_index:   {'forward': ..., 'reverse': ...} prefix indexes from build_prefix_index()
+    """
+    panel_key = hashlib.sha256(json.dumps(
+        [COMPILED_PANEL_VERSION, panel_arg['primers'], error_rate_arg, prefix_k_arg]).encode()).hexdigest()
+    cache_path = cache_dir_arg.joinpath(f'{panel_key}.npz') if cache_dir_arg else None
+
+    if cache_path and cache_path.exists():
+        try:
+            return _load_compiled_panel(cache_path)
+        except (OSError, ValueError, KeyError):
+            pass
+
+    compiled_primers: list = [
+        (region, compile_primer(primer_seqs['forward'], error_rate_arg), compile_primer(primer_seqs['reverse'], error_rate_arg))
+        for region, primer_seqs in panel_arg['primers'].items()]
+    compiled_panel: dict = {
+        'primers': compiled_primers,
+        'prefix_index': {
+            'forward': build_prefix_index([forward_primer for _, forward_primer, _ in compiled_primers], prefix_k_arg),
+            'reverse': build_prefix_index([reverse_primer for _, _, reverse_primer in compiled_primers], prefix_k_arg)}}
+    if cache_path:
+        try:
+            _save_compiled_panel(cache_path, compiled_panel)
+        except OSError:
+            pass
+    return compiled_panel
+def select_regions(compiled_panel_arg: dict, regions_arg: list) -> dict:
+    """
+    Function narrows a compiled panel down to some of its regions.
+
+    Parameters:
+        compiled_panel_arg (dict): compiled panel from compile_panel()
+        regions_arg (list): regions to keep, in matching order
+
+    Returns:
+        (dict): compiled panel of the selected regions
+    """
+    panel_regions: list = [region for region, _, _ in compiled_panel_arg['primers']]
+    selected: list = [panel_regions.index(region) for region in regions_arg]
+    return {
+        'primers': [compiled_panel_arg['primers'][index] for index in selected],
+        'prefix_index': {
+            direction: {'k': prefix_index['k'], 'table': prefix_index['table'][:, selected]}
+            for direction, prefix_index in compiled_panel_arg['prefix_index'].items()}}
+def _save_compiled_panel(cache_path_arg: Path, compiled_panel_arg: dict) -> None:
+    """
+    Function writes a compiled panel to the cache (atomically, so parallel jobs can share it).
+
+    Parameters:
+        cache_path_arg (Path): path of the cached .npz
+        compiled_panel_arg (dict): compiled panel from compile_panel()
+
+    Returns:
+        None
+    """
+    arrays: dict = {}
+    metadata: dict = {'regions': [], 'prefix_k': {}}
+    for region, forward_primer, reverse_primer in compiled_panel_arg['primers']:
+        metadata['regions'].append({
+            'region': region,
+            'forward': {key: forward_primer[key] for key in ('sequence', 'length', 'max_errors', 'indels')},
+            'reverse': {key: reverse_primer[key] for key in ('sequence', 'length', 'max_errors', 'indels')}})
+    for direction in ('forward', 'reverse'):
+        arrays[f'{direction}_peq'] = np.stack([primers[1 if direction == 'forward' else 2]['peq'] for primers in compiled_panel_arg['primers']])
+        arrays[f'{direction}_prefix_table'] = compiled_panel_arg['prefix_index'][direction]['table']
+        metadata['prefix_k'][direction] = compiled_panel_arg['prefix_index'][direction]['k']
+
+    cache_path_arg.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = cache_path_arg.parent.joinpath(f'{cache_path_arg.stem}.{os.getpid()}.partial.npz')
+    np.savez(temp_path, metadata=np.array(json.dumps(metadata)), **arrays)
+    os.replace(temp_path, cache_path_arg)
+def _load_compiled_panel(cache_path_arg: Path) -> dict:
+    """
+    Function reads a compiled panel from the cache.
+
+    Parameters:
+        cache_path_arg (Path): path of the cached .npz
+
+    Returns:
+        (dict): compiled panel, same as compile_panel()
+    """
+    with np.load(cache_path_arg, allow_pickle=False) as cached:
+        metadata = json.loads(str(cached['metadata']))
+        compiled_primers: list = []
+        for index, entry in enumerate(metadata['regions']):
+            forward_primer = dict(entry['forward'], peq=cached['forward_peq'][index])
+            reverse_primer = dict(entry['reverse'], peq=cached['reverse_peq'][index])
+            compiled_primers.append((entry['region'], forward_primer, reverse_primer))
+        prefix_index: dict = {
+            direction: {'k': metadata['prefix_k'][direction], 'table': cached[f'{direction}_prefix_table']}
+            for direction in ('forward', 'reverse')}
+    return {'primers': compiled_primers, 'prefix_index': prefix_index}
@@ -2,9 +2,15 @@
 __description__ =\
 """
 Purpose: To generate a summative .csv file from amr-finder outputs.
+
+Each amr-finder .csv is read row by row (csv.reader), keeping only the sequence, coverage and identity
+columns, and the (coverage + identity) / 200 of each sequence is computed on those columns at once. The
+values are assembled into a sparse sample x sequence matrix. The values read from every file are kept in a
+cache next to the output, with the size and modification time of the file, so only new or changed files
+are read again.
 """
 __author__ = "Erick Samera"
-__version__ = "1.0.0"
+__version__ = "1.1.2"
 __comments__ = "stable"
 # =============================================================================
 from argparse import (
@@ -13,8 +19,20 @@ from argparse import (
     RawTextHelpFormatter)
 from pathlib import Path
 # =============================================================================
-import pandas as pd
 import csv
+import json
+import os
+# =============================================================================
+import numpy as np
+import pandas as pd
+from scipy import sparse
+# =============================================================================
+SEQUENCE_COLUMN: str = 'Sequence name'
+COVERAGE_COLUMN: str = '% Coverage of reference sequence'
+IDENTITY_COLUMN: str = '% Identity to reference sequence'
+CACHE_NAME: str = 'output.cache.json'
+# bump when the cached values change, older caches are ignored
+CACHE_VERSION: int = 1
 # =============================================================================
 def get_args() -> Namespace:
     """ Get command-line arguments """
@@ -33,6 +51,10 @@ def get_args() -> Namespace:
         type=Path,
         default=None,
         help=f"output dir of csv file")
+    parser.add_argument('--no-cache',
+        dest='use_cache',
+        action='store_false',
+        help=f"read every .csv file, without reading or writing {CACHE_NAME}")
 
     args = parser.parse_args()
     # parser errors and processing
@@ -45,21 +67,96 @@ def _generate_summary(args: Namespace) -> None:
     """
     Generate a summary table.
     """
-    summary_data: dict = {}
+    cache_path: Path = args.output_dir.joinpath(CACHE_NAME)
+    cached_files: dict = _load_cache(cache_path) if args.use_cache else {}
 
-    for file in [file for file in args.input_dir.glob('*.csv') if '_mut' not in file.stem]:
-        sample_id: str = file.stem
-        summary_data[sample_id] = {}
-        with open(file) as csv_file:
-            csv_reader = csv.DictReader(csv_file)
-            for row in csv_reader:
-                sample_value = (
-                    float(row['% Coverage of reference sequence'])
-                  + float(row['% Identity to reference sequence'])) / 200
-                characteristic = row['Sequence name']
-                summary_data[sample_id][characteristic] = sample_value
+    input_files: list = [file for file in args.input_dir.glob('*.csv') if '_mut' not in file.stem]
+    fingerprints: list = [[file_stat.st_size, file_stat.st_mtime_ns] for file_stat in (file.stat() for file in input_files)]
+    file_entries: list = [
+        cached_files.get(file.name) if cached_files.get(file.name, {}).get('fingerprint') == fingerprint else None
+        for file, fingerprint in zip(input_files, fingerprints)]
 
-    pd.DataFrame.from_dict(summary_data, orient='index').fillna(0).to_csv(args.output_dir.joinpath('output.csv'))
+    # read the new and changed files
+    changed_files: list = [i for i, file_entry in enumerate(file_entries) if file_entry is None]
+    for i in changed_files:
+        sequences, values = _read_amr_csv(input_files[i])
+        file_entries[i] = {'fingerprint': fingerprints[i], 'sequences': sequences, 'values': values}
+    if args.use_cache and (changed_files or len(cached_files) != len(input_files)):
+        _save_cache(cache_path, {file.name: file_entry for file, file_entry in zip(input_files, file_entries)})
+
+    # sample x sequence matrix; samples without hits are left out and sequences keep their order of appearance
+    sample_ids: list = []
+    sequence_columns: dict = {}
+    rows: list = []
+    columns: list = []
+    values: list = []
+    for file, file_entry in zip(input_files, file_entries):
+        if not file_entry['sequences']:
+            continue
+        rows += [len(sample_ids)] * len(file_entry['sequences'])
+        columns += [sequence_columns.setdefault(sequence, len(sequence_columns)) for sequence in file_entry['sequences']]
+        values += file_entry['values']
+        sample_ids.append(file.stem)
+    rows_array = np.asarray(rows, dtype=np.int64)
+    columns_array = np.asarray(columns, dtype=np.int64)
+    summary_matrix = sparse.csr_matrix(
+        (np.asarray(values, dtype=np.float64), (rows_array, columns_array)),
+        shape=(len(sample_ids), len(sequence_columns)))
+
+    # samples in order of appearance going through the sequences column by column,
+    # the order DataFrame.from_dict(orient='index') gave them
+    column_major_rows = rows_array[np.lexsort((rows_array, columns_array))]
+    _, first_positions = np.unique(column_major_rows, return_index=True)
+    sample_order = column_major_rows[np.sort(first_positions)]
+
+    pd.DataFrame(
+        summary_matrix[sample_order].toarray(),
+        index=[sample_ids[i] for i in sample_order.tolist()],
+        columns=list(sequence_columns)).to_csv(args.output_dir.joinpath('output.csv'))
+def _read_amr_csv(file_arg: Path) -> tuple:
+    """
+    Function reads the (coverage + identity) / 200 of every sequence of an amr-finder .csv file.
+
+    Rows are read with csv.reader and only the three columns used are kept, the values are then computed on
+    those columns at once.
+
+    Parameters:
+        file_arg (Path): amr-finder .csv file
+
+    Returns:
+        (tuple): sequence names (in order of appearance), their values (the last row of a repeated sequence wins)
+    """
+    with open(file_arg, newline='') as csv_file:
+        csv_reader = csv.reader(csv_file)
+        header: list = next(csv_reader, [])
+        if not header:
+            return [], []
+        used_columns: list = [header.index(column) for column in (SEQUENCE_COLUMN, COVERAGE_COLUMN, IDENTITY_COLUMN)]
+        used_values: list = [tuple(row[column] for column in used_columns) for row in csv_reader if row]
+    if not used_values:
+        return [], []
+    sequences, coverages, identities = zip(*used_values)
+    sample_values = (np.asarray(coverages, dtype=np.float64) + np.asarray(identities, dtype=np.float64)) / 200
+    sequence_values: dict = dict(zip(sequences, sample_values.tolist()))
+    return list(sequence_values), list(sequence_values.values())
+def _load_cache(cache_path_arg: Path) -> dict:
+    """
+    Function loads the values cached for every file (empty if there is no usable cache).
+    """
+    try:
+        with open(cache_path_arg, encoding='UTF-8') as cache_file:
+            cache: dict = json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+    return cache.get('files', {}) if cache.get('version') == CACHE_VERSION else {}
+def _save_cache(cache_path_arg: Path, files_arg: dict) -> None:
+    """
+    Function writes the values of every file to the cache (atomically).
+    """
+    temp_path: Path = cache_path_arg.with_name(f'{cache_path_arg.name}.{os.getpid()}.partial')
+    with open(temp_path, 'w', encoding='UTF-8') as cache_file:
+        cache_file.write(json.dumps({'version': CACHE_VERSION, 'files': files_arg}))
+    os.replace(temp_path, cache_path_arg)
 # =============================================================================
 def main() -> None:
     """ Insert docstring here """
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Purpose: Regression tests for demultiplex_phased.py (run with pytest).
+"""
+__author__ = "Erick Samera"
+__version__ = "1.0.0"
+__comment__ = 'stable'
+
+# --------------------------------------------------
+from pathlib import Path
+# --------------------------------------------------
+import random
+# --------------------------------------------------
+import numpy as np
+import pytest
+from iupac_matcher import (
+    IUPAC_CODES,
+    encode_reads,
+    find_primer_ends)
+from fastq_reader import read_paired_fastq_batches
+from primer_panel import (
+    compile_panel,
+    load_panel)
+from demultiplex_phased import (
+    MAX_ERROR_RATE,
+    PREFIX_K,
+    QIASEQ_PANEL,
+    _panel_keys,
+    _remove_leftovers,
+    _route_batch)
+# --------------------------------------------------
+COMPILED_PANEL: dict = compile_panel(QIASEQ_PANEL, MAX_ERROR_RATE, PREFIX_K, None)
+REGIONS: list = [region for region, _, _ in COMPILED_PANEL['primers']]
+# --------------------------------------------------
+def _route_pairs(tmp_path: Path, pairs_arg: list) -> dict:
+    """
+    Function writes read pairs to .fastq files and routes them in one batch.
+
+    Parameters:
+        tmp_path (Path): directory to write the .fastq files to
+        pairs_arg (list): (R1, R2) read sequences
+
+    Returns:
+        (dict): routed batch from _route_batch()
+    """
+    for mate, mate_path in enumerate((tmp_path / 'R1.fastq', tmp_path / 'R2.fastq')):
+        with open(mate_path, 'w', encoding='UTF-8') as fastq_file:
+            for index, pair in enumerate(pairs_arg):
+                fastq_file.write(f'@read{index}\n{pair[mate]}\n+\n{"I" * len(pair[mate])}\n')
+    r1_batch, r2_batch = next(read_paired_fastq_batches(tmp_path / 'R1.fastq', tmp_path / 'R2.fastq'))
+    return _route_batch(r1_batch, r2_batch, COMPILED_PANEL['primers'], COMPILED_PANEL['prefix_index'])
+def _cascade_regions(pairs_arg: list) -> tuple:
+    """
+    Function routes read pairs the way the per-region cascade did: the first region (in panel order) whose
+    primers are found anywhere in both reads.
+
+    Parameters:
+        pairs_arg (list): (R1, R2) read sequences
+
+    Returns:
+        (tuple): region index of every pair (-1 for ungrouped), R1 and R2 primer ends (0 for ungrouped)
+    """
+    r1_reads, r1_lengths = encode_reads([r1.encode() for r1, _ in pairs_arg])
+    r2_reads, r2_lengths = encode_reads([r2.encode() for _, r2 in pairs_arg])
+    regions = np.full(len(pairs_arg), -1)
+    r1_ends = np.zeros(len(pairs_arg), dtype=np.int64)
+    r2_ends = np.zeros(len(pairs_arg), dtype=np.int64)
+    for region_index, (_, forward_primer, reverse_primer) in reversed(list(enumerate(COMPILED_PANEL['primers']))):
+        forward_ends, _ = find_primer_ends(forward_primer, r1_reads, r1_lengths)
+        reverse_ends, _ = find_primer_ends(reverse_primer, r2_reads, r2_lengths)
+        routed = (forward_ends >= 0) & (reverse_ends >= 0)
+        regions[routed] = region_index
+        r1_ends[routed] = forward_ends[routed]
+        r2_ends[routed] = reverse_ends[routed]
+    return regions.tolist(), r1_ends.tolist(), r2_ends.tolist()
+def _random_bases(rng_arg: random.Random, length_arg: int) -> str:
+    """ Return random A/C/G/T bases. """
+    return ''.join(rng_arg.choice('ACGT') for _ in range(length_arg))
+def _random_primer(rng_arg: random.Random, region_arg: str, direction_arg: str) -> str:
+    """ Return a primer of the default panel as A/C/G/T bases, with a substitution in about a third of them. """
+    primer = [rng_arg.choice(IUPAC_CODES[code]) for code in QIASEQ_PANEL['primers'][region_arg][direction_arg]]
+    if rng_arg.random() < 0.3:
+        primer[rng_arg.randrange(len(primer))] = rng_arg.choice('ACGT')
+    return ''.join(primer)
+# --------------------------------------------------
+def test_late_primer_after_spurious_prefix(tmp_path: Path) -> None:
+    """ R2 starts like the V1V2 reverse primer, but the primer itself is further into the read """
+    rng = random.Random(1)
+    r1 = 'AGAGTTTGATCCTGGCTC' + _random_bases(rng, 120)
+    r2 = 'CTGCTG' + _random_bases(rng, 14) + 'CTGCTGCCTCCCGTA' + _random_bases(rng, 100)
+    routed = _route_pairs(tmp_path, [(r1, r2)])
+    assert REGIONS[routed['regions'][0]] == 'V1V2'
+    assert routed['r1_ends'][0] == 18
+    assert routed['r2_ends'][0] == 35
+def test_late_primers_without_prefix_hit(tmp_path: Path) -> None:
+    """ Both primers past the phasing spacer are only found by the full-read search """
+    rng = random.Random(2)
+    r1 = _random_bases(rng, 20) + 'GTGCCAGCAGCCGCGGTAA' + _random_bases(rng, 100)
+    r2 = _random_bases(rng, 20) + 'CCGTCAATTCCTTTAAGTTT' + _random_bases(rng, 100)
+    routed = _route_pairs(tmp_path, [(r1, r2)])
+    assert REGIONS[routed['regions'][0]] == 'V4V5'
+def test_overlapping_primers_follow_panel_order(tmp_path: Path) -> None:
+    """ A pair with the primers of two regions goes to the first one in panel order, even if it is further in """
+    rng = random.Random(4)
+    r1 = 'CCTACGGGAGGCAGCAG' + _random_bases(rng, 20) + 'AGAGTTTGATCCTGGCTC' + _random_bases(rng, 100)
+    r2 = 'GACTACCAGGGTATCTAATCC' + _random_bases(rng, 20) + 'CTGCTGCCTCCCGTA' + _random_bases(rng, 100)
+    routed = _route_pairs(tmp_path, [(r1, r2)])
+    assert REGIONS[routed['regions'][0]] == 'V1V2'
+    assert (routed['r1_ends'][0], routed['r2_ends'][0]) == (55, 56)
+def test_routing_matches_cascade(tmp_path: Path) -> None:
+    """ Pairs with primers (of one or two regions) at the start, further in, mismatched or missing go where the
+    per-region cascade put them, trimmed at the same ends """
+    rng = random.Random(3)
+    pairs: list = []
+    for _ in range(600):
+        regions = rng.sample(list(QIASEQ_PANEL['primers']), rng.choice((1, 1, 2)))
+        mates: list = []
+        for direction in ('forward', 'reverse'):
+            mate = ''
+            for region in regions:
+                mate += _random_bases(rng, rng.choice((0, 3, 7, 20, 40))) + (_random_primer(rng, region, direction) if rng.random() < 0.9 else '')
+            mates.append(mate + _random_bases(rng, 100))
+        pairs.append(tuple(mates))
+    routed = _route_pairs(tmp_path, pairs)
+    regions, r1_ends, r2_ends = _cascade_regions(pairs)
+    assert routed['regions'].tolist() == regions
+    assert routed['r1_ends'].tolist() == r1_ends
+    assert routed['r2_ends'].tolist() == r2_ends
+def test_selection_ignores_case() -> None:
+    """ Regions and pools are selected whatever their case in the panel or on the command line """
+    panel_regions: dict = {'v1v2': {}, 'ITS1': {}, 'Its1': {}}
+    assert _panel_keys('V1V2; its1;Its1;V9', panel_regions) == ['v1v2', 'ITS1', 'Its1']
+    assert _panel_keys('a', {'A': [], 'b': []}) == ['A']
+def test_panel_with_invalid_primer(tmp_path: Path) -> None:
+    """ A primer that is not IUPAC bases is reported when the panel is loaded """
+    panel_path = tmp_path / 'panel.tsv'
+    panel_path.write_text('region\tforward\treverse\tpool\nv1v2\tAGRGTTTGATYMTGGCTC\tCTGCTGCCTYCCGTJ\t1\n', encoding='utf8')
+    with pytest.raises(ValueError, match='reverse primer of v1v2'):
+        load_panel(panel_path)
+def test_leftovers_include_recorded_outputs(tmp_path: Path) -> None:
+    """ Outputs recorded for a sample by an earlier run are removed with its partial files before it is redone """
+    input_file = tmp_path / 'A_S1_L001_R1_001.fastq.gz'
+    output_dir, concatenated_dir = tmp_path / 'out', tmp_path / 'cat'
+    recorded = [output_dir / 'A_S1_L001_V1V2_R1_001.fastq.gz', concatenated_dir / input_file.name, output_dir / 'A_S1_L001_V3V4_R2_001.fastq.gz']
+    partial = output_dir / 'A_S1_L001_ITS1_R1_001.fastq.gz.partial'
+    other_sample = output_dir / 'B_S2_L001_V1V2_R1_001.fastq.gz'
+    for file in recorded[:2] + [partial, other_sample]:
+        file.parent.mkdir(exist_ok=True)
+        file.touch()
+    _remove_leftovers(input_file, [output_dir, concatenated_dir], {'outputs': [str(file) for file in recorded]})
+    assert sorted(file.name for file in tmp_path.rglob('*.fastq.gz*')) == [other_sample.name]